@@ -129,8 +129,12 @@ eu27 = ['at',
         ]
 
 # Pull in the targets
+# Optionally, the person_patent map directory as the second input
 inputs = [i for idx, i in enumerate(sys.argv) if idx > 0]
 root_dir = inputs[0]
+person_patent_dir = '~/Documents/psClean/data/dedupe_input/person_patent/'
+if len(inputs) > 1:
+    person_patent_dir = inputs[1]
 
 cluster_id = 'cluster_id'
 
@@ -156,7 +160,7 @@ for country in eu27:
     # Define the input filenames
     dedupe_han = input_dir + '%s_dedupe_han_map.csv' % country
     dedupe_leuven = input_dir + '%s_dedupe_leuven_map.csv' % country
-    person_patent = os.path.expanduser('~/Documents/psClean/data/dedupe_input/person_patent/' + country + '_person_patent_map.csv')
+    person_patent = os.path.expanduser(person_patent_dir + country + '_person_patent_map.csv')
     # cluster_id = 'cluster_id_r2'
 
     # Load the input files
@@ -0,0 +1,121 @@
+import cPickle
+import math
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+
+"""
+Chunked reading of the cleaned_output_<CC>.tsv files written by
+extract_patstat_data.py, for files too large to load in one go.
+
+The files are read in chunks sized to a memory budget, with only the
+columns needed downstream and with integer / categorical dtypes.
+Per-person consolidation is then done as a two-pass external
+aggregation: partition_chunks spills each chunk to on-disk partitions
+keyed on person_id, and read_partitions loads one partition at a time.
+Since every record for a person lands in the same partition, aggregating
+each partition separately gives the same result as aggregating the
+whole file.
+"""
+
+# Rough ratio of in-memory DataFrame size to on-disk TSV size
+expansion = 4
+
+def detect_header(f_in, file_header, sep='\t'):
+    """
+    Checks the first line of f_in for the column names in file_header.
+    Returns the read_csv header arguments to use for the file.
+    """
+    with open(f_in, 'rb') as f:
+        first_line = f.readline().rstrip('\r\n').split(sep)
+    named_cols = set(h for h in file_header if h != '')
+    if len(set(first_line) & named_cols) == 0:
+        return {'header': None, 'names': file_header}
+    return {'header': 0}
+
+def chunk_rows(f_in, memory_mb, sample_bytes=2 ** 20):
+    """
+    Estimates how many rows of f_in fit in a quarter of memory_mb,
+    from the average line length of the first sample_bytes
+    """
+    with open(f_in, 'rb') as f:
+        sample = f.read(sample_bytes)
+    n_lines = max(sample.count('\n'), 1)
+    bytes_per_row = len(sample) / float(n_lines)
+    chunk_bytes = memory_mb * 2 ** 20 / (4.0 * expansion)
+    return max(int(chunk_bytes / bytes_per_row), 1000)
+
+def n_partitions(f_in, memory_mb):
+    """
+    Number of partitions needed so that one partition of f_in
+    fits in half of memory_mb
+    """
+    file_mb = os.path.getsize(f_in) / 2.0 ** 20
+    return max(int(math.ceil(2 * expansion * file_mb / memory_mb)), 1)
+
+def read_chunks(f_in, file_header, typedict, memory_mb,
+                usecols=None, categories=None, sep='\t'):
+    """
+    Returns an iterator over DataFrame chunks of f_in, each sized to fit
+    in memory_mb. The header is detected once for the whole file.
+    Columns in categories are read as pandas categoricals.
+    """
+    header_args = detect_header(f_in, file_header, sep)
+    dtypes = dict(typedict)
+    for c in categories or []:
+        dtypes[c] = 'category'
+    if usecols:
+        dtypes = dict((k, v) for k, v in dtypes.items() if k in usecols)
+    return pd.read_csv(f_in,
+                       sep=sep,
+                       dtype=dtypes,
+                       usecols=usecols,
+                       chunksize=chunk_rows(f_in, memory_mb),
+                       **header_args
+                       )
+
+def partition_chunks(chunks, key, n_parts, tmp_dir=None):
+    """
+    Writes every row of every chunk in chunks to one of n_parts
+    partition files, chosen by the integer column key modulo n_parts.
+    Returns the list of partition file paths; remove them with
+    remove_partitions once done.
+    """
+    part_dir = tempfile.mkdtemp(prefix='psclean_partitions_', dir=tmp_dir)
+    paths = [os.path.join(part_dir, 'part_%d.pkl' % i) for i in range(n_parts)]
+    handles = [open(p, 'wb') for p in paths]
+    try:
+        for chunk in chunks:
+            part_id = chunk[key].values % n_parts
+            order = np.argsort(part_id, kind='mergesort')
+            bounds = np.searchsorted(part_id[order], np.arange(n_parts + 1))
+            for i in range(n_parts):
+                if bounds[i + 1] > bounds[i]:
+                    part = chunk.take(order[bounds[i]:bounds[i + 1]])
+                    cPickle.dump(part, handles[i], 2)
+    finally:
+        for h in handles:
+            h.close()
+    return paths
+
+def read_partitions(paths):
+    """
+    Yields one DataFrame per partition written by partition_chunks,
+    skipping empty partitions
+    """
+    for p in paths:
+        parts = []
+        with open(p, 'rb') as f:
+            while True:
+                try:
+                    parts.append(cPickle.load(f))
+                except EOFError:
+                    break
+        if len(parts) > 0:
+            yield pd.concat(parts)
+
+def remove_partitions(paths):
+    if len(paths) > 0:
+        shutil.rmtree(os.path.dirname(paths[0]), ignore_errors=True)
@@ -8,6 +8,7 @@
 ############################
 
 import AsciiDammit
+import itertools
 import numpy as np
 import pandas as pd
 import re
@@ -35,13 +36,13 @@ def do_all(fullframe):
     allcolnames = fullframe.columns.tolist()
     allcolnames.pop(allcolnames.index('Name'))
     colnames  = allcolnames
-    criterion = fullframe['Name'].map(lambda x: len(x)>60)
+    criterion = fullframe['Name'].str.len() > 60
     multinames = fullframe[criterion]
     max_id = max(fullframe.Unique_Record_ID)
     splitnames = get_multi_names(multinames, colnames, max_id) 
     
-    name1 = fullframe.drop(multinames.index.tolist())
-    mynames = name1.append(splitnames)
+    name1 = fullframe[~criterion]
+    mynames = pd.concat([name1, splitnames])
 
     end = time.time()
     runtime = end - start
@@ -57,21 +58,44 @@ def split_multi_names(multiname, name_delim=','):
         names = [multiname]
     return names
 
-def get_multi_names(myframe, colnames, max_id):
-    """ get data frame of split names with associated information """
-    all_names = list()    
-    for idx in myframe.index.tolist():
-        dd = dict( [ (col, myframe.get_value(idx, col))
-                     for col in colnames] )
-        names = split_multi_names(myframe.get_value(idx, 'Name'))
-        data = [ dict( dd.items()+ [('Name', name)]) for name in names]
-    
-        all_names += data
-    
-    split_names = pd.DataFrame(all_names)
-    max_unique_id = max(myframe.Unique_Record_ID)
-    new_unique_ids = range(max_id + 1, max_id + 1 + split_names.shape[0])
-    split_names['Unique_Record_ID'] = new_unique_ids
+def get_multi_names(myframe, colnames, max_id, name_delim=','):
+    """
+    get data frame of split names with associated information
+
+    Vectorised version of split_multi_names over the whole frame: names are
+    split in one pass, rows with any single-word fragment keep their
+    original name, and the other columns are repeated once per output name.
+    """
+    names = myframe['Name'].values
+    fragments = myframe['Name'].str.split(name_delim).values
+    n_frag = np.array([len(f) for f in fragments], dtype=np.int64)
+    offsets = np.cumsum(n_frag) - n_frag
+
+    flat = np.array(list(itertools.chain.from_iterable(fragments)),
+                    dtype=object
+                    )
+    has_space = pd.Series(flat).str.contains(' ', regex=False).values
+
+    # A row is only split if every fragment holds more than one word
+    if len(flat) > 0:
+        is_split = np.logical_and.reduceat(has_space, offsets)
+    else:
+        is_split = np.zeros(0, dtype=bool)
+
+    # Rows that stay whole keep a single slot holding the original name
+    keep = np.repeat(is_split, n_frag)
+    keep[offsets] = True
+    flat[offsets[~is_split]] = names[~is_split]
+
+    n_out = np.where(is_split, n_frag, 1)
+    row_pos = np.repeat(np.arange(len(names)), n_out)
+
+    split_names = myframe[colnames].take(row_pos)
+    split_names.reset_index(drop=True, inplace=True)
+    split_names['Name'] = flat[keep]
+    split_names['Unique_Record_ID'] = np.arange(max_id + 1,
+                                                max_id + 1 + split_names.shape[0]
+                                                )
     return split_names
          
 
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import re
 import math
@@ -13,11 +14,23 @@ E.g., this is an address: Jon Doe, 1234 Bond St, Boston, MA, US
 
 filter_name first searches for possible addresses in the
 latter half of the string.
+
+parse_names does the same work as filter_name and parse_name for a whole
+array of names at once, and also splits off the trailing country code.
 """
 
 re_name = re.compile('(?<=\w)\s+[0-9]{2,}\s+(?=\w)')
 re_test = re.compile('\s+[0-9]{2,}\s+(?=\w)')
 
+## Single scanner for name / address / trailing country. The lazy name
+## group makes the split happen at the first separator, as in parse_name.
+re_scan = re.compile('^(?P<name>.*?)(?<=\w)\s+[0-9]{2,}\s+(?=\w)'
+                     '(?P<address>.*?)(?:\s(?P<country>[a-z]{2}))?$',
+                     re.S
+                     )
+re_digits = '[0-9]{2}'
+re_space = re.compile('\s+')
+
 def parse_name(name):
     name_split = re_name.split(name, maxsplit=1)
     try:
@@ -34,3 +47,40 @@ def filter_name(name):
     if re_test.search(name_sub):
         return True
     return False
+
+def parse_names(names, default_country=None):
+    """
+    Batch version of filter_name and parse_name.
+
+    Takes an array of names and returns three aligned object arrays:
+    name_part, address_part and country. For names without an address
+    (per filter_name), name_part is the input name and address_part and
+    country are None. Otherwise the address has its trailing two-letter
+    country code removed, as well as all whitespace, and country holds
+    that code or default_country if there was none. The address and
+    country arrays can be passed directly to the geocoder.
+    """
+    names = np.asarray(names, dtype=object)
+    n = names.shape[0]
+    name_parts = names.copy()
+    address_parts = np.empty(n, dtype=object)
+    countries = np.empty(n, dtype=object)
+
+    # Cheap prefilter: no pair of digits means no address
+    is_str = np.array([isinstance(s, str) for s in names], dtype=bool)
+    candidates = np.zeros(n, dtype=bool)
+    candidates[is_str] = pd.Series(names[is_str]).str.contains(re_digits).values
+
+    for idx in np.flatnonzero(candidates):
+        s = names[idx]
+        if not re_test.search(s, len(s) - int(math.ceil(len(s) / 2.0))):
+            continue
+        m = re_scan.match(s)
+        if m is None:
+            continue
+        name_parts[idx] = m.group('name')
+        address_parts[idx] = re_space.sub('', m.group('address'))
+        country = m.group('country')
+        countries[idx] = country if country else default_country
+
+    return name_parts, address_parts, countries
@@ -1,8 +1,10 @@
+import chunked_reader as cr
 import consolidate_df as cd
 import csv
 import modifications as md
 import name_address_parser as nap
 import numpy as np
+import optparse
 import os
 import pandas as pd
 import re
@@ -13,20 +15,59 @@ import unidecode
 sys.path.append('/home/markhuberty/Documents/fuzzygeo')
 import fuzzygeo
 
-def nan_helper(val):
-    try:
-        out = np.isnan(val)
-    except TypeError:
-        out = False
-    return out
+def clean_chunk(df, file_stats):
+    """
+    Row-level cleaning for one chunk of a cleaned_output file. Records the
+    row count, country and distinct addresses in file_stats along the way.
+    """
+    text_cols = ['person_name', 'person_address', 'coauthors', 'ipc_code']
+    df[text_cols] = df[text_cols].fillna('')
 
+    if file_stats['country'] is None and df.shape[0] > 0:
+        file_stats['country'] = str(df.person_ctry_code.values[0]).lower()
+    file_stats['rows'] += df.shape[0]
+    file_stats['addresses'].update(df.person_address.values)
+
+    # Clean up the names and ascii-ize them
+    df['person_name'] = md.asciidammit(df['person_name'])
+
+    # Shorten the IPC codes to 4-digit
+    ipc_codes = [md.sort_class(c, 4) for c in df['ipc_code']]
+    df['ipc_code'] = ipc_codes
+
+    # ascii and lowercase the coauthor data
+    coauthors = md.asciidammit(df['coauthors'])
+    coauthors = [c.lower() for c in coauthors]
+    df['coauthors'] = coauthors
+    return df
+
+## Optional command-line inputs, in order:
+## 1. The directory containing the cleaned_output_<CC>.tsv files
+## 2. The dedupe_input output directory
+## 3+. Country codes to prepare; defaults to all files in the directory
+## -m / --memory sets the memory budget in MB for each file. Files are
+## read in chunks and consolidated one person_id partition at a time
+## to stay within it.
+optp = optparse.OptionParser()
+optp.add_option('-m', '--memory', dest='memory', type='float', default=4000,
+                help='Memory budget in MB for reading and consolidating each file'
+                )
+(opts, inputs) = optp.parse_args()
 source_dir = '/mnt/db_master/patstat_raw/fleming_inputs/'
+output_dir = '../data/dedupe_input/'
+if len(inputs) > 0:
+    source_dir = inputs[0]
+if len(inputs) > 1:
+    output_dir = inputs[1]
+
 re_file = re.compile('cleaned_output_[A-Z]{2}.tsv$')
 file_list = os.listdir(source_dir)
 files = [f for f in file_list if re_file.match(f)]
 file_header = ['', 'appln_id','person_id','person_name','person_address','person_ctry_code','firm_legal_id','coauthors','ipc_code','year']
 dtypes = [np.int32, np.int32, np.int32, object, object, object, object, object, object, np.int32]
 typedict = dict(zip(file_header, dtypes))
+read_cols = ['appln_id', 'person_id', 'person_name', 'person_address',
+             'person_ctry_code', 'coauthors', 'ipc_code']
 
 city_latlong = pd.read_csv('latlong_dict.csv')
 city_latlong.columns = ['city', 'country', 'lat', 'lng', 'population', 'region']
@@ -38,46 +79,43 @@ geocoders = dict((c, fuzzygeo.fuzzygeo(city_latlong[city_latlong.country==c]))
                  for c in countries if c in city_latlong.country.values
                  )
 
+if len(inputs) > 2:
+    run_countries = [c.lower() for c in inputs[2:]]
+    files = [f for f in files if f.split('.')[0][-2:].lower() in run_countries]
+
     
 for f in files:
     print f
     f_in = source_dir + f
-    df = pd.read_csv(f_in, sep='\t', dtype=typedict)
-    column_check = set(df.columns) & set(file_header)
-    if len(column_check) == 0:
-        df = pd.read_csv(f_in,
-                         sep='\t',
-                         header=None,
-                         names=file_header,
-                         dtype=typedict
-                         )
+
+    # First pass: clean each chunk and spill it to person_id partitions
+    file_stats = {'rows': 0, 'country': None, 'addresses': set()}
+    chunks = cr.read_chunks(f_in, file_header, typedict, opts.memory,
+                            usecols=read_cols,
+                            categories=['person_ctry_code']
+                            )
+    part_paths = cr.partition_chunks((clean_chunk(c, file_stats) for c in chunks),
+                                     'person_id',
+                                     cr.n_partitions(f_in, opts.memory)
+                                     )
 
     ## Skip countries with only one record, no dedupe needed
-    if len(df.shape) == 1 or df.shape[0] in [0, 1]:
+    if file_stats['rows'] in [0, 1]:
         print 'Skipping ' + f
+        cr.remove_partitions(part_paths)
         continue
-    
-    df.fillna('', inplace=True)
- 
-    person_patent_map = df[['person_id', 'appln_id']].drop_duplicates()
-    person_patent_map.columns = ['Person', 'Patent']
-    
-    country = df.person_ctry_code.values[0].lower()
+
+    country = file_stats['country']
 
     if country in geocoders:
         geocode = True
     else:
         geocode = False
 
-    # Clean up the names and ascii-ize them
-    # First clean up names and find addresses
-    ascii_names = md.asciidammit(df['person_name'])
-    df['person_name'] = ascii_names
-
     # Then geocode the addresses
     if geocode:
         print 'geocoding'
-        addresses = df.person_address.dropna().drop_duplicates()
+        addresses = pd.Series(sorted(file_stats['addresses']))
         addresses = addresses[addresses != '']
         clean_addresses = [unidecode.unidecode(addr).strip() for addr in addresses.values]
 
@@ -95,102 +133,114 @@ for f in files:
         locales = [g[0] for g in geocoded_locales]
         lats = [g[1] for g in geocoded_locales]
         lngs = [g[2] for g in geocoded_locales]
-        addr_df = pd.DataFrame({'person_address': addresses,
+        addr_df = pd.DataFrame({'person_address': addresses.values,
                                 'locale': locales,
                                 'lat': lats,
                                 'lng': lngs
                                 }
                                )
-        df = pd.merge(df, addr_df, on='person_address', how='left')
-
-        # test for missing addresses
-        df_name_addr = df[['person_name', 'person_address', 'lat']].drop_duplicates()
-        nan_addr = np.array([nan_helper(l) for l in df_name_addr.lat])
-        none_addr = np.equal(df_name_addr.lat, None)
-        bool_without_addresses = np.logical_or(nan_addr, none_addr)
-
-        # check names for address data
-        names_without_addresses = df_name_addr.person_name[bool_without_addresses].dropna().drop_duplicates()
-        names_without_addresses = [re.sub('A14', 'U', n) for n in names_without_addresses]
-        names_without_addresses = [n for n in names_without_addresses if nap.filter_name(n)]
-        geocoded_names = []
-        name_fields = ['name', 'clean_name', 'locale', 'lat', 'lng']
-
-        start_time = time.time()
-        incr_time = start_time
-        for idx, n in enumerate(names_without_addresses):
-            if isinstance(n, str):
-                if idx > 0 and idx % 1000 == 0:
-                    print idx
-                    print (time.time() - start_time) / idx
-
-                    incr_time = time.time()
-
-                name, address = nap.parse_name(n)
-        
-                if address:
-                    try:
-                        this_country = re.search('\s[a-z]{2}$', address).group().strip()
-                    except AttributeError:
-                        this_country = country
-                        
-                    address = re.sub('\s+', '', re.sub('\s[a-z]{2}$', '', address))
+    del file_stats
+
+    # Second pass: geocode names and consolidate one partition at a time
+    person_patent_out = output_dir + 'person_patent/' + country + '_person_patent_map.csv'
+    f_out = output_dir + 'person_records/dedupe_input_' + country + '.csv'
+    first_part = True
+    fragment_geocodes = {}
+    for df in cr.read_partitions(part_paths):
+        person_patent_map = df[['person_id', 'appln_id']].drop_duplicates()
+        person_patent_map.columns = ['Person', 'Patent']
+
+        if geocode:
+            df = pd.merge(df, addr_df, on='person_address', how='left')
+
+            # Names of records without a geocoded address, by integer code
+            name_codes, unique_names = pd.factorize(df.person_name)
+            without_address = pd.isnull(df.lat.values)
+            name_missing = np.zeros(len(unique_names), dtype=bool)
+            name_missing[name_codes[without_address]] = True
+            missing_idx = np.flatnonzero(name_missing)
+
+            # check names for address data
+            names_without_addresses = [re.sub('A14', 'U', n)
+                                       for n in unique_names[missing_idx]]
+            name_parts, name_addresses, name_countries = nap.parse_names(names_without_addresses,
+                                                                         country
+                                                                         )
+            has_address = np.not_equal(name_addresses, None)
+
+            # Geocode each distinct (address, country) fragment once per file
+            fragments = pd.Series(name_addresses[has_address]) + '|' + \
+                        pd.Series(name_countries[has_address])
+            fragment_codes, unique_fragments = pd.factorize(fragments)
+            fragment_geo = np.empty((len(unique_fragments), 3), dtype=object)
+
+            start_time = time.time()
+            n_geocoded = 0
+            for fdx, fragment in enumerate(unique_fragments):
+                if fragment not in fragment_geocodes:
+                    address, this_country = fragment.rsplit('|', 1)
                     if this_country in geocoders:
                         gl = geocoders[this_country](address, this_country, 0.5)
                     else:
                         gl = geocoders[country](address, this_country, 0.5)
-                    name_locale = [n, name]
-                    name_locale.extend(gl)
-                    d_locale = dict(zip(name_fields, name_locale))
-                    geocoded_names.append(d_locale)
-
-        name_addr_df = pd.DataFrame(geocoded_names)
-        if name_addr_df.shape[0] != 0:
-            df = pd.merge(df, name_addr_df, left_on='person_name', right_on='name', how='left')
-            lat = [l[0] if nan_helper(l[1]) else l[1] for l in zip(df.lat_x, df.lat_y)]
-            lng = [l[0] if nan_helper(l[1]) else l[1] for l in zip(df.lng_x, df.lng_y)]
-            locale = [l[0] if isinstance(l[0], str) else l[1] for l in zip(df.locale_x, df.locale_y)]
-        
-            df = df[['appln_id', 'person_id', 'person_name', 'person_address',
-                     'person_ctry_code', 'coauthors', 'ipc_code', 'year', 'clean_name']
-                    ]
-            df['lat'] = lat
-            df['lng'] = lng
-            df['locale'] = locale
-
-
-    # Return the reformatted names and latlng pairs as two lists
-    else:
-        lats = [0.0] * df.shape[0]
-        lngs = [0.0] * df.shape[0]
-        df['lat'] = lats
-        df['lng'] = lngs
-
-    # Shorten the IPC codes to 4-digit
-    ipc_codes = [md.sort_class(c, 4) for c in df['ipc_code']]
-    df['ipc_code'] = ipc_codes
-
-    # ascii and lowercase the coauthor data
-    coauthors = md.asciidammit(df['coauthors'])
-    coauthors = [c.lower() for c in coauthors]
-    df['coauthors'] = coauthors
-
-    df = df[['person_id', 'person_name', 'coauthors', 'ipc_code', 'lat', 'lng']]
-    df.columns = ['Person', 'Name', 'Coauthor', 'Class', 'Lat', 'Lng']
-    # Consolidate the records at the person_id level
-    consolidate_dict = {'Name': cd.consolidate_unique,
-                        'Lat': cd.consolidate_geo,
-                        'Lng': cd.consolidate_geo,
-                        'Class': cd.consolidate_set,
-                        'Coauthor': cd.consolidate_set
-                        }
-
-    df_consolidated = cd.consolidate(df, 'Person', consolidate_dict)
-
-    df_consolidated['patent_ct'] = df.groupby('Person').size()
-
-    # Write out
-    person_patent_out = '../data/dedupe_input/person_patent/' + country + '_person_patent_map.csv'
-    f_out = '../data/dedupe_input/person_records/dedupe_input_' + country + '.csv'
-    person_patent_map.to_csv(person_patent_out, index=False)
-    df_consolidated.to_csv(f_out)
+                    fragment_geocodes[fragment] = gl
+                    n_geocoded += 1
+                    if n_geocoded % 1000 == 0:
+                        print n_geocoded
+                        print (time.time() - start_time) / n_geocoded
+                fragment_geo[fdx] = fragment_geocodes[fragment]
+
+            # Map back to names, then to records. The name-based location
+            # takes precedence over the address-based one where it exists.
+            name_lat = np.empty(len(unique_names))
+            name_lat.fill(np.nan)
+            name_lng = name_lat.copy()
+            name_locale = np.empty(len(unique_names), dtype=object)
+            name_idx = missing_idx[has_address]
+            name_locale[name_idx] = fragment_geo[fragment_codes, 0]
+            name_lat[name_idx] = fragment_geo[fragment_codes, 1].astype(float)
+            name_lng[name_idx] = fragment_geo[fragment_codes, 2].astype(float)
+
+            record_lat = name_lat[name_codes]
+            record_lng = name_lng[name_codes]
+            record_locale = name_locale[name_codes]
+            df['lat'] = np.where(np.isnan(record_lat), df.lat.values, record_lat)
+            df['lng'] = np.where(np.isnan(record_lng), df.lng.values, record_lng)
+            df['locale'] = np.where(pd.isnull(df.locale.values),
+                                    record_locale,
+                                    df.locale.values
+                                    )
+
+        # Return the reformatted names and latlng pairs as two lists
+        else:
+            lats = [0.0] * df.shape[0]
+            lngs = [0.0] * df.shape[0]
+            df['lat'] = lats
+            df['lng'] = lngs
+
+        df = df[['person_id', 'person_name', 'coauthors', 'ipc_code', 'lat', 'lng']]
+        df.columns = ['Person', 'Name', 'Coauthor', 'Class', 'Lat', 'Lng']
+        # Consolidate the records at the person_id level
+        consolidate_dict = {'Name': cd.consolidate_unique,
+                            'Lat': cd.consolidate_geo,
+                            'Lng': cd.consolidate_geo,
+                            'Class': cd.consolidate_set,
+                            'Coauthor': cd.consolidate_set
+                            }
+
+        df_consolidated = cd.consolidate(df, 'Person', consolidate_dict)
+
+        df_consolidated['patent_ct'] = df.groupby('Person').size()
+
+        # Write out; the first partition creates the files
+        if first_part:
+            write_mode = 'w'
+        else:
+            write_mode = 'a'
+        person_patent_map.to_csv(person_patent_out, index=False,
+                                 mode=write_mode, header=first_part
+                                 )
+        df_consolidated.to_csv(f_out, mode=write_mode, header=first_part)
+        first_part = False
+
+    cr.remove_partitions(part_paths)
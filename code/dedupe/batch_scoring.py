@@ -0,0 +1,241 @@
+## batch_scoring.py
+## Vectorised scoring of record pairs with a learned dedupe data model
+
+import itertools
+import numpy as np
+import pandas as pd
+
+import dedupe
+from record_store import field_positions
+import sparse_cosine
+
+"""
+dedupe.core.fieldDistances calls a Python comparator for every field of
+every pair. PairScorer computes each field's distance column for a whole
+list of pairs at once, from the RecordStore arrays:
+
+- LatLong: haversine distance in km on the lat / lng arrays, missing
+  (nan) where either location is (0.0, 0.0)
+- Custom integer_diff: 1 / (|a - b| + 1) on the patent_ct array
+- Custom SparseCosine: row-wise products of the TF-IDF vectors
+- String, and any other comparator: the field's own comparator (the C
+  affine gap distance for Name), called once per distinct pair of values
+
+The columns are laid out as dedupe does: comparator fields, then
+Interaction fields (products of their fields), then a not-missing
+indicator for each field with missing data; missing distances are set
+to 0. Scores are the logistic of the dot product with the learned
+weights plus the bias.
+
+Each vectorised column is checked against the field's comparator, and
+the scores against dedupe.core.scorePairs, on a sample of the first
+pairs scored (see check). A column that disagrees falls back to the
+comparator; if the scores disagree, PairScorer should not be used.
+"""
+
+earth_radius = 6371.0
+
+def haversine(lat_1, lng_1, lat_2, lng_2):
+    """
+    Great circle distance in km; nan where either point is (0.0, 0.0)
+    """
+    lat_1, lng_1, lat_2, lng_2 = [np.radians(a) for a in (lat_1, lng_1, lat_2, lng_2)]
+    a = np.sin((lat_2 - lat_1) / 2) ** 2 + \
+        np.cos(lat_1) * np.cos(lat_2) * np.sin((lng_2 - lng_1) / 2) ** 2
+    distance = earth_radius * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    missing = ((lat_1 == 0) & (lng_1 == 0)) | ((lat_2 == 0) & (lng_2 == 0))
+    distance[missing] = np.nan
+    return distance
+
+def integer_diff(a, b):
+    return 1.0 / (np.abs(a - b) + 1)
+
+def distinct_pair_distances(comparator, values_1, values_2):
+    """
+    comparator(values_1[k], values_2[k]) for every k, calling comparator
+    once per distinct pair of values. Values must be hashable.
+    """
+    codes, uniques = pd.factorize(np.concatenate([values_1, values_2]))
+    n = len(values_1)
+    keys = codes[:n].astype(np.int64) * len(uniques) + codes[n:]
+    distinct_keys, inverse = np.unique(keys, return_inverse=True)
+    distances = np.array([comparator(uniques[k // len(uniques)], uniques[k % len(uniques)])
+                          for k in distinct_keys.tolist()
+                          ],
+                         dtype=np.float64
+                         )
+    return distances[inverse]
+
+class PairScorer(object):
+    """
+    Scores pairs of records of a RecordStore with the data model of a
+    trained deduper
+    """
+
+    def __init__(self, deduper, data_d):
+        self.data_d = data_d
+        fields = deduper.data_model['fields']
+        self.bias = deduper.data_model['bias']
+        self.comparator_fields = [f for f, v in fields.items()
+                                  if v['type'] not in ('Missing Data',
+                                                       'Interaction',
+                                                       'Higher Categories')
+                                  ]
+        self.interactions = [(f, v['Interaction Fields']) for f, v in fields.items()
+                             if v['type'] == 'Interaction'
+                             ]
+        self.missing_fields = [f for f, v in fields.items() if v.get('Has Missing')]
+        self.definitions = fields
+        self.vectorised = dict((f, True) for f in self.comparator_fields)
+
+        missing_weights = []
+        for f in self.missing_fields:
+            name = f + ': not_missing'
+            missing_weights.append(fields[name]['weight'] if name in fields else 0.0)
+        self.weights = np.array([fields[f]['weight'] for f in self.comparator_fields] +
+                                [fields[f]['weight'] for f, i in self.interactions] +
+                                missing_weights
+                                )
+
+    def values(self, field, positions):
+        """
+        The values of field for the records at positions, as an object
+        array
+        """
+        d = self.data_d
+        if field == 'Name':
+            return d.names[positions]
+        values = np.empty(len(positions), dtype=object)
+        if field == 'LatLong':
+            values[:] = zip(d.lats[positions].tolist(), d.lngs[positions].tolist())
+        elif field == 'patent_ct':
+            values[:] = d.patent_cts[positions].tolist()
+        elif field in ('Class', 'Coauthor'):
+            token_sets = d.classes if field == 'Class' else d.coauthors
+            values[:] = [token_sets.get(p) for p in positions.tolist()]
+        else:
+            i = field_positions[field]
+            values[:] = [d.row(p)[i] for p in positions.tolist()]
+        return values
+
+    def vectorised_column(self, field, positions_1, positions_2):
+        """
+        The distance column of field from the store arrays, or None if
+        there is no vectorised version of its comparator
+        """
+        definition = self.definitions[field]
+        comparator = definition.get('comparator')
+        d = self.data_d
+        if definition['type'] == 'LatLong':
+            return haversine(d.lats[positions_1], d.lngs[positions_1],
+                             d.lats[positions_2], d.lngs[positions_2]
+                             )
+        if isinstance(comparator, sparse_cosine.SparseCosine) and \
+           comparator.token_sets is not None:
+            return comparator.pair_cosines(positions_1, positions_2)
+        if field == 'patent_ct' and getattr(comparator, '__name__', None) == 'integer_diff':
+            return integer_diff(d.patent_cts[positions_1], d.patent_cts[positions_2])
+        return None
+
+    def comparator_column(self, field, positions_1, positions_2):
+        """
+        The distance column of field from its comparator, called once
+        per distinct pair of values
+        """
+        comparator = self.definitions[field]['comparator']
+        values_1 = self.values(field, positions_1)
+        values_2 = self.values(field, positions_2)
+        if field == 'Name':
+            return distinct_pair_distances(comparator, values_1, values_2)
+        return np.array([comparator(a, b) for a, b in itertools.izip(values_1, values_2)],
+                        dtype=np.float64
+                        )
+
+    def field_distances(self, id1, id2):
+        """
+        The field distance matrix of the pairs (id1[k], id2[k])
+        """
+        positions_1 = self.data_d.positions(id1)
+        positions_2 = self.data_d.positions(id2)
+        columns = {}
+        for f in self.comparator_fields:
+            column = None
+            if self.vectorised[f]:
+                column = self.vectorised_column(f, positions_1, positions_2)
+            if column is None:
+                column = self.comparator_column(f, positions_1, positions_2)
+            columns[f] = column.astype(np.float32)
+        distances = [columns[f] for f in self.comparator_fields]
+        for f, interaction_fields in self.interactions:
+            distances.append(np.prod([columns[i] for i in interaction_fields], axis=0))
+        distances = np.column_stack(distances)
+        missing = np.isnan(distances)
+        distances[missing] = 0
+        not_missing = np.column_stack([~np.isnan(columns[f]) for f in self.missing_fields] or
+                                      [np.zeros((len(id1), 0))]
+                                      )
+        return np.hstack([distances, not_missing.astype(np.float32)])
+
+    def score(self, id1, id2):
+        """
+        Match probability of the pairs (id1[k], id2[k])
+        """
+        z = np.dot(self.field_distances(id1, id2), self.weights) + self.bias
+        return (1 / (1 + np.exp(-z))).astype(np.float32)
+
+    def score_block(self, record_ids):
+        """
+        Scores all pairs of a block of records. Returns (id1, id2,
+        scores) arrays.
+        """
+        record_ids = np.asarray(record_ids, dtype=np.int64)
+        i, j = np.triu_indices(len(record_ids), 1)
+        return record_ids[i], record_ids[j], self.score(record_ids[i], record_ids[j])
+
+    def check(self, deduper, id1, id2, sample_size=2000, tolerance=1e-4):
+        """
+        Compares the vectorised columns with the fields' comparators and
+        the scores with dedupe.core.scorePairs on the first sample_size
+        pairs. Columns that disagree are computed with their comparator
+        from then on. Returns True if the scores agree.
+        """
+        id1 = np.asarray(id1[:sample_size])
+        id2 = np.asarray(id2[:sample_size])
+        if len(id1) == 0:
+            return True
+        positions_1 = self.data_d.positions(id1)
+        positions_2 = self.data_d.positions(id2)
+        for f in self.comparator_fields:
+            column = self.vectorised_column(f, positions_1, positions_2)
+            if column is None:
+                continue
+            expected = self.comparator_column(f, positions_1, positions_2)
+            agree = np.allclose(column, expected, atol=tolerance, equal_nan=True)
+            if not agree:
+                print 'Vectorised %s distances differ from its comparator; using the comparator' % f
+            self.vectorised[f] = agree
+
+        d = self.data_d
+        pairs = [(d[i], d[j]) for i, j in itertools.izip(id1.tolist(), id2.tolist())]
+        expected = dedupe.core.scorePairs(dedupe.core.fieldDistances(pairs, deduper.data_model),
+                                          deduper.data_model
+                                          )
+        agree = np.allclose(self.score(id1, id2), expected, atol=tolerance)
+        if not agree:
+            print 'Vectorised scores differ from dedupe.core.scorePairs'
+        return agree
+
+def pair_scorer(deduper, data_d, id1, id2):
+    """
+    A PairScorer for deduper and data_d, checked on the first of the
+    pairs (id1, id2); None if the data model is not one PairScorer can
+    reproduce
+    """
+    try:
+        scorer = PairScorer(deduper, data_d)
+    except (KeyError, AttributeError) as e:
+        print 'No vectorised scoring for this data model (missing %s)' % e
+        return None
+    if not scorer.check(deduper, id1, id2):
+        return None
+    return scorer
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""
+Compares the clustering methods of pair_scores.cluster_pair_scores on
+the pair scores stored by a dedupe_engine run with score_cache set:
+hierarchical (centroid linkage, as dedupe does), components (connected
+components by union-find) and components with a maximum cluster size.
+For each method and threshold it reports the time taken and the person
+id precision and recall against the Leuven level 2 ids, computed as in
+code/analyze/compute_precision_recall.py.
+
+The script is invoked from the command line as:
+
+python benchmark_clustering.py <scores_file> <input_file> <leuven_map_file> <max_cluster_size> <threshold> [<threshold> ...]
+
+input_file is the dedupe_input_<cc>.csv file the round 1 scores were
+computed on, and leuven_map_file the <cc>_dedupe_leuven_map.csv file
+written by code/postprocess/map_dedupe_han_leuven.py.
+"""
+
+import numpy as np
+import pandas as pd
+import sys
+import time
+
+import pair_scores
+import patent_util
+
+def id_precision_recall(df):
+    """
+    Person id precision and recall of the cluster_id column of df
+    against its leuven_id column
+    """
+    counts = df.groupby(['leuven_id', 'cluster_id']).size()
+    total = float(counts.sum())
+    recall = counts.groupby(level=0).max().sum() / total
+    precision = counts.groupby(level=1).max().sum() / total
+    return precision, recall
+
+inputs = [i for idx, i in enumerate(sys.argv) if idx > 0]
+scores_file = inputs[0]
+input_file = inputs[1]
+leuven_map_file = inputs[2]
+max_cluster_size = int(inputs[3])
+thresholds = [float(t) for t in inputs[4:]]
+
+id1, id2, scores = pair_scores.load_pair_scores(scores_file)
+input_df = pd.read_csv(input_file, usecols=['Person'])
+df_leuven = pd.read_csv(leuven_map_file, usecols=['person_id', 'leuven_id', 'leuven_ld_level'])
+df_leuven = df_leuven[df_leuven.leuven_ld_level == 2].drop_duplicates('person_id')
+print 'Pairs: %s, records: %s, Leuven level 2 persons: %s' % (len(scores),
+                                                               input_df.shape[0],
+                                                               df_leuven.shape[0]
+                                                               )
+
+methods = [('hierarchical', 'hierarchical', None),
+           ('components', 'components', None),
+           ('components <= %s' % max_cluster_size, 'components', max_cluster_size)
+           ]
+
+print '%10s  %-20s %10s %10s %10s %10s %10s' % ('threshold', 'method', 'seconds',
+                                               'clusters', 'largest', 'precision',
+                                               'recall'
+                                               )
+for threshold in thresholds:
+    for label, method, size in methods:
+        time_start = time.time()
+        clustered_dupes = pair_scores.cluster_pair_scores(id1, id2, scores, threshold,
+                                                          method, size
+                                                          )
+        time_cluster = time.time() - time_start
+
+        input_df['cluster_id'] = patent_util.cluster_index(input_df.index, clustered_dupes)
+        df = pd.merge(df_leuven, input_df, left_on='person_id', right_on='Person')
+        precision, recall = id_precision_recall(df)
+        largest = max([len(c) for c in clustered_dupes] or [0])
+        print '%10.4f  %-20s %10.2f %10s %10s %10.4f %10.4f' % (threshold, label, time_cluster,
+                                                               len(clustered_dupes), largest,
+                                                               precision, recall
+                                                               )
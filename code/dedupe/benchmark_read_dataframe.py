@@ -0,0 +1,52 @@
+#!/usr/bin/python
+"""
+Compares patent_util.readDataFrame (column-wise) with
+patent_util.readDataFrameIterrows (row-by-row) on a dedupe input file:
+checks that both produce the same records and reports the time taken
+by each, and the memory held by readDataFrame's record store.
+
+The script is invoked from the command line as:
+
+python benchmark_read_dataframe.py <dedupe_input_file> [<n_rows>]
+
+If n_rows is given, only the first n_rows records are used.
+"""
+
+import pandas as pd
+import sys
+import time
+
+import patent_util
+
+inputs = [i for idx, i in enumerate(sys.argv) if idx > 0]
+input_file = inputs[0]
+
+input_df = pd.read_csv(input_file)
+if len(inputs) > 1:
+    input_df = input_df[:int(inputs[1])]
+input_df.Class.fillna('', inplace=True)
+input_df.Coauthor.fillna('', inplace=True)
+input_df.Lat.fillna('0.0', inplace=True)
+input_df.Lng.fillna('0.0', inplace=True)
+input_df.Name.fillna('', inplace=True)
+print 'Records: %s' % input_df.shape[0]
+
+time_start = time.time()
+data_iterrows = patent_util.readDataFrameIterrows(input_df)
+time_iterrows = time.time() - time_start
+print 'readDataFrameIterrows: %0.2f seconds' % time_iterrows
+
+# Start from an empty cache so the timing includes preprocessing
+patent_util.preprocess_cache.clear()
+time_start = time.time()
+data_columns = patent_util.readDataFrame(input_df)
+time_columns = time.time() - time_start
+print 'readDataFrame: %0.2f seconds' % time_columns
+print 'Speedup: %0.1fx' % (time_iterrows / max(time_columns, 1e-9))
+print 'Record store size: %0.1f MB' % (data_columns.nbytes / 2.0 ** 20)
+
+mismatches = [k for k in data_iterrows if data_iterrows[k] != data_columns.get(k)]
+if len(data_iterrows) != len(data_columns) or mismatches:
+    print 'Records differ: %s mismatched records' % len(mismatches)
+    sys.exit(1)
+print 'Records identical'
@@ -0,0 +1,389 @@
+## block_index.py
+## Compact block:[record_id] index for the blocking output
+
+import array
+import numpy as np
+import random
+
+class BlockIndex(object):
+    """
+    Stores the output of blocking in compressed sparse row form: the
+    record ids of all blocks concatenated in one integer array, with
+    block i in record_ids[offsets[i]:offsets[i + 1]]. The key of block i
+    is key_list[i], and keys map to block positions through a single
+    dict.
+
+    Compared with a defaultdict of lists this holds one machine integer
+    per (block, record) entry instead of a Python list per block and a
+    Python int per entry, and block sizes are available as an array for
+    fast scans.
+
+    Supports the read-only dict interface used on the old block maps
+    (block_map[key], key in block_map, len, keys() and iteration over
+    keys), with blocks returned as array views rather than copies.
+    """
+
+    def __init__(self, keys, offsets, record_ids):
+        self.key_list = keys
+        self.offsets = offsets
+        self.record_ids = record_ids
+        self.sizes = np.diff(offsets)
+        self.key_positions = dict((k, i) for i, k in enumerate(keys))
+
+    @classmethod
+    def from_blocker(cls, d, b):
+        """
+        Blocks the data d with the blocker b and builds the index.
+        Record ids in d must be integers.
+        """
+        key_positions = {}
+        keys = []
+        block_codes = array.array('l')
+        block_records = array.array('l')
+        for record_id, record in d.iteritems():
+            for block_id in b((record_id, record)):
+                code = key_positions.get(block_id)
+                if code is None:
+                    code = len(keys)
+                    key_positions[block_id] = code
+                    keys.append(block_id)
+                block_codes.append(code)
+                block_records.append(record_id)
+        del key_positions
+        if len(block_codes) == 0:
+            return cls.from_codes(keys,
+                                  np.zeros(0, dtype=np.int64),
+                                  np.zeros(0, dtype=np.int64)
+                                  )
+        return cls.from_codes(keys,
+                              np.frombuffer(block_codes, dtype=np.dtype('l')),
+                              np.frombuffer(block_records, dtype=np.dtype('l'))
+                              )
+
+    @classmethod
+    def from_blocks(cls, blocks, keys=None):
+        """
+        Builds the index from a sequence of lists of record ids,
+        e.g. a dict-of-lists block map's values. Keys default to the
+        block positions.
+        """
+        blocks = list(blocks)
+        if keys is None:
+            keys = range(len(blocks))
+        sizes = np.array([len(block) for block in blocks], dtype=np.int64)
+        codes = np.repeat(np.arange(len(blocks)), sizes)
+        records = np.fromiter((i for block in blocks for i in block),
+                              dtype=np.int64,
+                              count=sizes.sum()
+                              )
+        return cls.from_codes(list(keys), codes, records)
+
+    @classmethod
+    def from_codes(cls, keys, block_codes, block_records):
+        """
+        Builds the index from aligned arrays of block positions and
+        record ids, one entry per (block, record) pair. Records keep
+        their order within each block.
+        """
+        order = np.argsort(block_codes, kind='mergesort')
+        if len(block_records) > 0 and block_records.max() < 2 ** 31:
+            id_dtype = np.int32
+        else:
+            id_dtype = np.int64
+        record_ids = block_records[order].astype(id_dtype)
+        counts = np.bincount(block_codes, minlength=len(keys))
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(keys, offsets, record_ids)
+
+    def __len__(self):
+        return len(self.key_list)
+
+    def __iter__(self):
+        return iter(self.key_list)
+
+    def __contains__(self, key):
+        return key in self.key_positions
+
+    def __getitem__(self, key):
+        return self.block(self.key_positions[key])
+
+    def keys(self):
+        return list(self.key_list)
+
+    def iterkeys(self):
+        return iter(self.key_list)
+
+    def iteritems(self):
+        for i, k in enumerate(self.key_list):
+            yield k, self.block(i)
+
+    def block(self, i):
+        """
+        Record ids of the block at position i, as a view
+        """
+        return self.record_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def positions(self, min_size=1, max_size=None):
+        """
+        Positions of the blocks with between min_size and max_size records
+        """
+        mask = self.sizes >= min_size
+        if max_size is not None:
+            mask &= self.sizes <= max_size
+        return np.flatnonzero(mask)
+
+    def keys_with_size(self, min_size=1, max_size=None):
+        """
+        Keys of the blocks with between min_size and max_size records
+        """
+        return [self.key_list[i] for i in self.positions(min_size, max_size)]
+
+    def sample(self, n, min_size=1):
+        """
+        Positions of n blocks sampled at random, without replacement,
+        from the blocks with at least min_size records
+        """
+        candidates = self.positions(min_size)
+        n = min(n, len(candidates))
+        return candidates[sorted(random.sample(xrange(len(candidates)), n))]
+
+    def sample_pairs(self, n_pairs, min_size=2, seed=None):
+        """
+        Samples about n_pairs of the record pairs compared within the
+        blocks with at least min_size records, stratified by block size.
+        Blocks are put into strata by the power of two of their size, and
+        each stratum gets a share of n_pairs equal to its share of all
+        pairs. Within a stratum, blocks are drawn in proportion to their
+        pair counts and a random pair is drawn from each, so every pair
+        is equally likely and no single block can take the whole sample.
+        Pairs drawn twice from the same block are kept once. If there
+        are no more than n_pairs pairs in all, every pair is returned.
+        Returns (id1, id2) arrays.
+        """
+        rng = np.random.RandomState(seed)
+        candidates = self.positions(max(min_size, 2))
+        sizes = self.sizes[candidates].astype(np.int64)
+        pairs = sizes * (sizes - 1) / 2
+        total = pairs.sum()
+        if total <= n_pairs:
+            id1 = []
+            id2 = []
+            for ids in self.iterblocks(candidates):
+                i, j = np.triu_indices(len(ids), 1)
+                id1.append(ids[i])
+                id2.append(ids[j])
+            if not id1:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            return np.concatenate(id1).astype(np.int64), np.concatenate(id2).astype(np.int64)
+
+        strata = np.floor(np.log2(sizes)).astype(np.int64)
+        stratum_pairs = np.bincount(strata, weights=pairs)
+        # Largest remainder shares of n_pairs
+        shares = stratum_pairs * n_pairs / float(total)
+        quota = np.floor(shares).astype(np.int64)
+        short = n_pairs - quota.sum()
+        quota[np.argsort(quota - shares)[:short]] += 1
+
+        blocks = []
+        for stratum in np.flatnonzero(quota):
+            in_stratum = np.flatnonzero(strata == stratum)
+            cumulative = np.cumsum(pairs[in_stratum])
+            drawn = np.searchsorted(cumulative,
+                                    rng.uniform(0, cumulative[-1], quota[stratum]),
+                                    side='right'
+                                    )
+            blocks.append(in_stratum[drawn])
+        blocks = np.concatenate(blocks)
+
+        block_sizes = sizes[blocks]
+        i = (rng.uniform(size=len(blocks)) * block_sizes).astype(np.int64)
+        j = (i + 1 + (rng.uniform(size=len(blocks)) * (block_sizes - 1)).astype(np.int64)) % block_sizes
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        keys = (blocks * sizes.max() + i) * sizes.max() + j
+        first = np.unique(keys, return_index=True)[1]
+        starts = self.offsets[candidates[blocks[first]]]
+        return (self.record_ids[starts + i[first]].astype(np.int64),
+                self.record_ids[starts + j[first]].astype(np.int64)
+                )
+
+    def iterblocks(self, positions=None):
+        """
+        Yields the blocks at positions (all blocks by default) as views
+        """
+        if positions is None:
+            positions = xrange(len(self.key_list))
+        for i in positions:
+            yield self.record_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def pair_counts(self):
+        """
+        Number of record pairs compared within each block
+        """
+        sizes = self.sizes.astype(np.int64)
+        return sizes * (sizes - 1) / 2
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the offset and record id arrays
+        """
+        return self.offsets.nbytes + self.record_ids.nbytes
+
+
+def _split_block(key, ids, d, max_block_pairs, sub_predicates, depth=0):
+    """
+    Recursively splits the block ids with sub_predicates[depth:] until
+    each part has at most max_block_pairs pairs or the predicates run
+    out. Yields (key, ids) for each part with at least 2 records.
+    """
+    n = len(ids)
+    if n * (n - 1) / 2 <= max_block_pairs or depth >= len(sub_predicates):
+        yield key, ids
+        return
+    predicate = sub_predicates[depth]
+    groups = {}
+    for i in ids:
+        groups.setdefault(predicate(d[i]), []).append(i)
+    for sub_key in sorted(groups):
+        sub_ids = groups[sub_key]
+        if len(sub_ids) > 1:
+            for part in _split_block('%s|%s' % (key, sub_key), sub_ids, d,
+                                     max_block_pairs, sub_predicates, depth + 1):
+                yield part
+
+
+def chunked_pair_count(sizes, chunk_size):
+    """
+    Number of pairs left in blocks of the given sizes once each is cut
+    into chunks of at most chunk_size records (see chunk_block)
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    n_chunks = -(-sizes // chunk_size)
+    small = sizes // np.maximum(n_chunks, 1)
+    large = small + 1
+    n_large = sizes - small * n_chunks
+    return (n_large * large * (large - 1) / 2 +
+            (n_chunks - n_large) * small * (small - 1) / 2).sum()
+
+def budget_chunk_size(sizes, max_total_pairs):
+    """
+    The largest chunk size at which blocks of the given sizes hold at
+    most max_total_pairs pairs; None if they already do, and 2 if even
+    that does not fit
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if len(sizes) == 0 or chunked_pair_count(sizes, sizes.max()) <= max_total_pairs:
+        return None
+    lo = 2
+    hi = sizes.max()
+    while lo < hi:
+        mid = (lo + hi + 1) / 2
+        if chunked_pair_count(sizes, mid) <= max_total_pairs:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def chunk_block(key, ids, d, chunk_size):
+    """
+    Sorts the block ids by name and cuts it into consecutive chunks of
+    near-equal size, at most chunk_size records each. Yields (key, ids)
+    for each chunk.
+    """
+    ids = sorted(ids, key=lambda i: d[i]['Name'])
+    n_chunks = -(-len(ids) // chunk_size)
+    for k, chunk in enumerate(np.array_split(np.array(ids, dtype=np.int64), n_chunks)):
+        yield '%s|%d' % (key, k), chunk.tolist()
+
+def split_oversized_blocks(block_map, d, max_block_pairs, sub_predicates,
+                           max_total_pairs=None):
+    """
+    Post-processes a BlockIndex so that no block, and optionally not the
+    whole index, holds more record pairs than the given budgets.
+
+    Blocks with more than max_block_pairs pairs are split recursively
+    with sub_predicates, a list of functions mapping a record to a
+    secondary key, applied in order. Pairs that fall in different
+    sub-blocks are no longer compared. Blocks that are still oversized
+    once the predicates run out are kept whole.
+
+    If max_total_pairs is set and the blocks still hold more pairs than
+    that, the largest blocks are cut into chunks: each is sorted by name
+    and cut into consecutive chunks of at most chunk_size records, with
+    chunk_size the largest at which the total fits (see
+    budget_chunk_size). Every record of a chunked block is still
+    compared with its neighbours by name. The pairs dropped from each
+    chunked block are printed.
+
+    Returns the new BlockIndex.
+    """
+    pair_counts = block_map.pair_counts()
+    pairs_before = pair_counts.sum()
+    oversized = np.flatnonzero(pair_counts > max_block_pairs)
+
+    new_keys = []
+    new_blocks = []
+    for pos in oversized:
+        for sub_key, ids in _split_block(block_map.key_list[pos],
+                                         block_map.block(pos).tolist(),
+                                         d,
+                                         max_block_pairs,
+                                         sub_predicates
+                                         ):
+            new_keys.append(sub_key)
+            new_blocks.append(ids)
+    print 'Split %s oversized blocks into %s sub-blocks' % (len(oversized),
+                                                            len(new_blocks)
+                                                            )
+
+    keep = pair_counts <= max_block_pairs
+    if max_total_pairs is not None:
+        new_sizes = np.array([len(ids) for ids in new_blocks], dtype=np.int64)
+        sizes = np.concatenate([block_map.sizes[keep], new_sizes])
+        chunk_size = budget_chunk_size(sizes, max_total_pairs)
+        if chunk_size is not None:
+            chunk_old = np.flatnonzero(keep & (block_map.sizes > chunk_size))
+            chunk_new = set(np.flatnonzero(new_sizes > chunk_size).tolist())
+            to_chunk = [(block_map.key_list[pos], block_map.block(pos).tolist()) for pos in chunk_old]
+            to_chunk += [(new_keys[k], new_blocks[k]) for k in sorted(chunk_new)]
+            keep[chunk_old] = False
+            new_keys = [k for i, k in enumerate(new_keys) if i not in chunk_new]
+            new_blocks = [b for i, b in enumerate(new_blocks) if i not in chunk_new]
+
+            dropped = []
+            for key, ids in to_chunk:
+                kept = 0
+                for chunk_key, chunk in chunk_block(key, ids, d, chunk_size):
+                    new_keys.append(chunk_key)
+                    new_blocks.append(chunk)
+                    kept += len(chunk) * (len(chunk) - 1) / 2
+                dropped.append((len(ids) * (len(ids) - 1) / 2 - kept, key, len(ids)))
+            print 'Cut %s blocks into chunks of at most %s records to stay within %s pairs' % (
+                len(to_chunk), chunk_size, max_total_pairs)
+            if chunked_pair_count(sizes, chunk_size) > max_total_pairs:
+                print 'Pairs are still over %s with chunks of 2 records' % max_total_pairs
+            for n_dropped, key, size in sorted(dropped, reverse=True):
+                print 'Block %s: %s records, %s pairs dropped' % (key, size, n_dropped)
+
+    # Blocks that were not split are carried over as array slices
+    entry_block = np.repeat(np.arange(len(block_map)), block_map.sizes)
+    entry_keep = keep[entry_block]
+    block_codes = np.cumsum(keep) - 1
+    codes = [block_codes[entry_block[entry_keep]]]
+    records = [block_map.record_ids[entry_keep].astype(np.int64)]
+    n_kept = keep.sum()
+    for code, ids in enumerate(new_blocks):
+        codes.append(np.repeat(n_kept + code, len(ids)))
+        records.append(np.array(ids, dtype=np.int64))
+    keys = [block_map.key_list[i] for i in np.flatnonzero(keep)] + new_keys
+    out = BlockIndex.from_codes(keys,
+                                np.concatenate(codes).astype(np.int64),
+                                np.concatenate(records)
+                                )
+
+    pairs_after = out.pair_counts().sum()
+    print 'Pairs before splitting: %s' % pairs_before
+    print 'Pairs after splitting: %s' % pairs_after
+    print 'Pairs saved: %s' % (pairs_before - pairs_after)
+    return out
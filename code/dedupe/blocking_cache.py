@@ -0,0 +1,244 @@
+## blocking_cache.py
+## Predicate coverage of the training pairs, computed once per deduper
+
+import collections
+import itertools
+import numpy as np
+
+import dedupe
+
+"""
+Dedupe.blockingFunction(ppc, uncovered_dupes) learns blocking rules in
+two steps. First it finds, for every candidate predicate, the training
+pairs whose two records share a block key. Then it picks predicates
+greedily (Chvatal's set cover), best ratio of duplicate to distinct
+pairs covered first, until at most uncovered_dupes duplicate pairs are
+left uncovered. Predicates that put ppc of the distinct pairs or more
+into one block are skipped. When no rules are found,
+patent_util.blockingSettingsWrapper retries with a larger ppc and fewer
+uncovered dupes, and each retry computed the coverage again.
+
+The first attempt is always dedupe's own blockingFunction. If it finds
+no rules, PredicateCoverage computes the coverage once for the retries:
+
+- candidate predicates as dedupe generates them: each blocking function
+  of a field's type paired with the field, and conjunctions of two of
+  those on different fields
+- a duplicate-by-predicate coverage matrix, the number of distinct pairs
+  each predicate covers, and the size of each predicate's largest block
+  of distinct pairs
+
+- the distinct pairs are the training pairs plus one batch of
+  semi-supervised non-duplicates from the data sample, as
+  blockingFunction draws them
+
+learn(ppc, uncovered_dupes) then runs the greedy cover on those arrays,
+which costs next to nothing, so every retry reuses the same coverage.
+The learned rules are given to Dedupe.blockingFunction through
+deduper.predicates, as when they are read from a settings file.
+
+The greedy cover follows the description of dedupe's blockTraining but
+has not been checked step by step against the fork, so rules found on a
+retry may differ from those dedupe would learn for the same setting;
+blockingSettingsWrapper logs a warning when a retry produced the rules.
+report_predicates prints the rules in use on every run, whichever way
+they were found.
+
+Only the simple predicates are candidates. dedupe's TF-IDF canopy
+predicates need canopies built over the data sample, so rules found on
+a retry never include them, where dedupe's own retry could.
+"""
+
+default_string_predicates = ('wholeFieldPredicate',
+                             'tokenFieldPredicate',
+                             'commonIntegerPredicate',
+                             'sameThreeCharStartPredicate',
+                             'sameFiveCharStartPredicate',
+                             'sameSevenCharStartPredicate',
+                             'nearIntegersPredicate',
+                             'commonFourGram',
+                             'commonSixGram'
+                             )
+
+def predicate_name(predicate):
+    return ' & '.join('%s(%s)' % (getattr(f, '__name__', f), field) for f, field in predicate)
+
+def candidate_predicates(deduper):
+    """
+    Basic (function, field) predicates for the fields of the deduper's
+    data model, and their conjunctions on two different fields
+    """
+    blocker_types = dict(getattr(deduper, 'blocker_types', {}))
+    if 'String' not in blocker_types:
+        blocker_types['String'] = tuple(getattr(dedupe.predicates, name)
+                                        for name in default_string_predicates
+                                        if hasattr(dedupe.predicates, name)
+                                        )
+    basic = []
+    for field, definition in sorted(deduper.data_model['fields'].items()):
+        for f in blocker_types.get(definition['type'], ()):
+            basic.append((f, field))
+    conjunctions = [(p, q) for p, q in itertools.combinations(basic, 2) if p[1] != q[1]]
+    return basic, [(p,) for p in basic] + conjunctions
+
+def shared_keys(predicate, pair):
+    """
+    Block keys the records of pair share under a basic predicate
+    """
+    f, field = predicate
+    try:
+        keys_1 = f(pair[0][field])
+        if not keys_1:
+            return frozenset()
+        keys_2 = f(pair[1][field])
+        if not keys_2:
+            return frozenset()
+    except (TypeError, ValueError, AttributeError):
+        return frozenset()
+    return frozenset(keys_1) & frozenset(keys_2)
+
+def record_keys(predicate, record):
+    """
+    Block keys of a record under a compound predicate
+    """
+    parts = []
+    for f, field in predicate:
+        try:
+            keys = f(record[field])
+        except (TypeError, ValueError, AttributeError):
+            return ()
+        if not keys:
+            return ()
+        parts.append(set(keys))
+    return list(itertools.product(*parts))
+
+class PredicateCoverage(object):
+    """
+    Coverage of the training pairs of a trained deduper by every
+    candidate predicate; see the module docstring
+    """
+
+    def __init__(self, deduper, data_sample=None):
+        dupes = list(deduper.training_pairs[1])
+        distinct = list(deduper.training_pairs[0])
+        if data_sample is None:
+            data_sample = getattr(deduper, 'data_sample', None)
+        if data_sample and hasattr(dedupe.training, 'semiSupervisedNonDuplicates'):
+            distinct.extend(dedupe.training.semiSupervisedNonDuplicates(data_sample,
+                                                                        deduper.data_model,
+                                                                        sample_size=32000
+                                                                        ))
+        self.n_dupes = len(dupes)
+        self.n_distinct = len(distinct)
+
+        basic, self.predicates = candidate_predicates(deduper)
+        self.basic = set(basic)
+        dupe_keys = dict((p, [shared_keys(p, pair) for pair in dupes]) for p in basic)
+        distinct_keys = dict((p, [shared_keys(p, pair) for pair in distinct]) for p in basic)
+
+        dupe_covered = dict((p, np.array([bool(k) for k in dupe_keys[p]], dtype=bool))
+                            for p in basic)
+        distinct_covered = dict((p, np.array([bool(k) for k in distinct_keys[p]], dtype=bool))
+                                for p in basic)
+
+        self.dupe_cover = np.zeros((len(self.predicates), self.n_dupes), dtype=bool)
+        self.distinct_counts = np.zeros(len(self.predicates), dtype=np.int64)
+        self.max_distinct_block = np.zeros(len(self.predicates), dtype=np.int64)
+        for k, predicate in enumerate(self.predicates):
+            self.dupe_cover[k] = np.logical_and.reduce([dupe_covered[p] for p in predicate])
+            covered = np.flatnonzero(np.logical_and.reduce([distinct_covered[p]
+                                                            for p in predicate
+                                                            ]))
+            self.distinct_counts[k] = len(covered)
+            if len(covered) == 0:
+                continue
+            block_counts = collections.Counter()
+            for i in covered.tolist():
+                block_counts.update(itertools.product(*[distinct_keys[p][i] for p in predicate]))
+            self.max_distinct_block[k] = max(block_counts.itervalues())
+
+    def learn(self, ppc, uncovered_dupes):
+        """
+        Greedy predicate cover for a (ppc, uncovered_dupes) setting.
+        Returns the chosen predicates; raises ValueError if there are
+        none, as Dedupe.blockingFunction does.
+        """
+        allowed = self.dupe_cover.any(axis=1) & \
+                  (self.max_distinct_block < ppc * self.n_distinct)
+        uncovered = np.ones(self.n_dupes, dtype=bool)
+        chosen = []
+        while uncovered.sum() > uncovered_dupes:
+            dupes = np.where(allowed, self.dupe_cover[:, uncovered].sum(axis=1), 0)
+            if not dupes.any():
+                break
+            cover = np.where(dupes > 0, (dupes + 1.0) / (self.distinct_counts + 1.0), 0)
+            best = int(np.argmax(cover))
+            chosen.append(best)
+            allowed[best] = False
+            uncovered &= ~self.dupe_cover[best]
+        if not chosen:
+            raise ValueError('No predicate found for ppc %s, uncovered_dupes %s'
+                             % (ppc, uncovered_dupes))
+        return [self.predicates[k] for k in chosen]
+
+    def coverage_line(self, predicate):
+        """
+        The training pairs a candidate predicate covers, as printed by
+        report_predicates; None for predicates that are not candidates
+        here (TF-IDF canopies)
+        """
+        if not all(p in self.basic for p in predicate):
+            return None
+        k = self.predicates.index(predicate)
+        return '%s of %s dupes, %s of %s distinct' % (self.dupe_cover[k].sum(),
+                                                      self.n_dupes,
+                                                      self.distinct_counts[k],
+                                                      self.n_distinct
+                                                      )
+
+def estimable(predicate):
+    """
+    Whether the block keys of a predicate can be computed record by
+    record, which is not so for TF-IDF canopy predicates
+    """
+    return all(callable(f) for f, field in predicate)
+
+def report_predicates(chosen, data_d=None, coverage=None, sample_size=20000, seed=0):
+    """
+    Prints the chosen blocking predicates and, if the records data_d are
+    given, the number of comparisons each is estimated to make over them.
+    That estimate counts the within-block pairs of a random sample of
+    sample_size records and scales it up to all records. With a
+    PredicateCoverage, the training pairs each predicate covers are
+    printed too. TF-IDF canopy predicates are printed by name only.
+    """
+    ids = None
+    if data_d is not None and len(data_d) > 1:
+        ids = np.asarray(data_d.keys())
+        n = len(ids)
+        if n > sample_size:
+            ids = ids[np.random.RandomState(seed).choice(n, sample_size, replace=False)]
+        scale = n * (n - 1.0) / (len(ids) * (len(ids) - 1.0))
+    total = 0
+    not_estimated = 0
+    for predicate in chosen:
+        parts = []
+        if coverage is not None:
+            parts.append(coverage.coverage_line(predicate))
+        if ids is not None and estimable(predicate):
+            counts = collections.Counter()
+            for i in ids.tolist():
+                counts.update(record_keys(predicate, data_d[i]))
+            comparisons = int(scale * sum(c * (c - 1) / 2 for c in counts.itervalues()))
+            total += comparisons
+            parts.append('~%s comparisons' % comparisons)
+        elif ids is not None:
+            not_estimated += 1
+            parts.append('not estimated')
+        parts = [part for part in parts if part]
+        print '%s%s' % (predicate_name(predicate), (': ' + ', '.join(parts)) if parts else '')
+    if ids is not None:
+        line = 'Estimated comparisons, all predicates: at most %s' % total
+        if not_estimated:
+            line += ' (plus %s predicates not estimated)' % not_estimated
+        print line
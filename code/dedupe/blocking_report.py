@@ -0,0 +1,251 @@
+## blocking_report.py
+## Blocking diagnostics per country: pair counts, reduction ratio,
+## pair completeness and the heaviest blocks
+
+import cgi
+import csv
+import json
+import numpy as np
+import pandas as pd
+import time
+
+import dedupe
+import blocking_cache
+
+"""
+compute_block_summary prints the number of blocks and their max, median
+and mean size. blocking_report computes, from the BlockIndex arrays:
+
+- candidate pairs: the pairs compared within blocks of 2 or more
+  records, counted once per block they share, as duplicateClusters
+  compares them
+- reduction ratio: 1 - candidate pairs / (n * (n - 1) / 2)
+- pair completeness: the share of benchmark match pairs (records with
+  the same Leuven or HAN id) whose records share a block
+- the top_k heaviest blocks by pair count, with their key and the
+  blocking predicate that made them, and candidate pairs by predicate
+- projected scoring time: candidate pairs times the time per pair of
+  dedupe.core.fieldDistances and scorePairs on a sample of candidate
+  pairs
+
+write_report writes the report as <file_root>.json, the summary and
+heaviest blocks as <file_root>.html, and the heaviest blocks as
+<file_root>.csv. dedupe_engine writes them to
+blocking_report_r<r>_<cc>.* in the output directory.
+"""
+
+def size_histogram(sizes):
+    """
+    Number of blocks and candidate pairs per block size class 2-3,
+    4-7, 8-15, ...
+    """
+    sizes = sizes[sizes > 1].astype(np.int64)
+    if len(sizes) == 0:
+        return []
+    classes = np.floor(np.log2(sizes)).astype(np.int64)
+    blocks = np.bincount(classes)
+    pairs = np.bincount(classes, weights=sizes * (sizes - 1) / 2)
+    return [{'min_size': 2 ** c, 'max_size': 2 ** (c + 1) - 1,
+             'blocks': int(blocks[c]), 'pairs': int(pairs[c])}
+            for c in np.flatnonzero(blocks).tolist()
+            ]
+
+def key_text(key):
+    if isinstance(key, str):
+        return key.decode('utf-8', 'replace')
+    return unicode(key)
+
+def key_predicates(keys, predicates):
+    """
+    Index of the blocking predicate of each block key, -1 where it is
+    not known. dedupe ends each key with ':<predicate index>';
+    split blocks (see block_index.split_oversized_blocks) add
+    '|<sub key>' parts after it.
+    """
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+    suffixes = pd.Series([key_text(k) for k in keys]).str.split('|').str[0].str.rsplit(':', n=1).str[-1]
+    codes = pd.to_numeric(suffixes, errors='coerce').fillna(-1).values.astype(np.int64)
+    codes[(codes < 0) | (codes >= len(predicates or ()))] = -1
+    return codes
+
+def pair_completeness(block_map, id1, id2):
+    """
+    Share of the record pairs (id1[k], id2[k]) whose records share at
+    least one block of block_map. For every pair, the blocks of id1[k]
+    are looked up in the sorted (block, record) entries of the index.
+    """
+    if len(id1) == 0:
+        return None
+    block_codes = np.repeat(np.arange(len(block_map.sizes)), block_map.sizes)
+    records = block_map.record_ids.astype(np.int64)
+    keep = block_map.sizes[block_codes] > 1
+    block_codes = block_codes[keep]
+    records = records[keep]
+    n = max(records.max() if len(records) else 0, np.max(id1), np.max(id2)) + 1
+    entries = np.sort(block_codes * n + records)
+
+    order = np.argsort(records, kind='mergesort')
+    sorted_records = records[order]
+    sorted_blocks = block_codes[order]
+    start = np.searchsorted(sorted_records, id1, side='left')
+    counts = np.searchsorted(sorted_records, id1, side='right') - start
+    pair_index = np.repeat(np.arange(len(id1)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    queries = sorted_blocks[np.repeat(start, counts) + offsets] * n + id2[pair_index]
+    if len(entries) == 0:
+        return 0.0
+    found = np.minimum(np.searchsorted(entries, queries), len(entries) - 1)
+    hit = entries[found] == queries
+    covered = np.bincount(pair_index, weights=hit, minlength=len(id1)) > 0
+    return float(covered.mean())
+
+def benchmark_pairs(input_df, labels):
+    """
+    All pairs of records of input_df (by index label) whose persons
+    have the same label in the person_id: label series labels
+    """
+    labelled = input_df.Person.isin(labels.index).values
+    record_ids = input_df.index.values[labelled].astype(np.int64)
+    codes = pd.factorize(labels.reindex(input_df.Person.values[labelled]).values)[0]
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) \
+        if len(codes) else np.zeros(0, dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(codes)])
+    id1 = [np.zeros(0, dtype=np.int64)]
+    id2 = [np.zeros(0, dtype=np.int64)]
+    # All groups of one size at once
+    for size in np.unique(sizes[sizes > 1]).tolist():
+        group_starts = starts[sizes == size]
+        i, j = np.triu_indices(size, 1)
+        id1.append(record_ids[order[(group_starts[:, None] + i).ravel()]])
+        id2.append(record_ids[order[(group_starts[:, None] + j).ravel()]])
+    return np.concatenate(id1), np.concatenate(id2)
+
+def time_per_pair(deduper, data_d, block_map, n_pairs=2000):
+    """
+    Seconds per pair of dedupe's per-pair field distances and scoring,
+    timed on a sample of candidate pairs
+    """
+    id1, id2 = block_map.sample_pairs(n_pairs, seed=0)
+    if len(id1) == 0:
+        return None
+    pairs = [(data_d[i], data_d[j]) for i, j in zip(id1.tolist(), id2.tolist())]
+    time_start = time.time()
+    dedupe.core.scorePairs(dedupe.core.fieldDistances(pairs, deduper.data_model),
+                           deduper.data_model
+                           )
+    return (time.time() - time_start) / len(pairs)
+
+def blocking_report(country, block_map, n_records, predicates=None, benchmark=None,
+                    deduper=None, data_d=None, top_k=20):
+    """
+    Diagnostics of a BlockIndex over n_records records as a dict; see
+    the module docstring. predicates are the deduper's blocking
+    predicates, benchmark an (id1, id2) tuple of benchmark match pairs,
+    and deduper and data_d are used to time scoring. Parts whose inputs
+    are not given are None.
+    """
+    sizes = block_map.sizes.astype(np.int64)
+    pairs = sizes * (sizes - 1) / 2
+    total_pairs = int(pairs.sum())
+    all_pairs = n_records * (n_records - 1) / 2
+    blocked = sizes > 1
+
+    predicate_codes = key_predicates(block_map.key_list, predicates)
+    predicate_pairs = []
+    if predicates:
+        by_predicate = np.bincount(predicate_codes + 1, weights=pairs,
+                                   minlength=len(predicates) + 1
+                                   )
+        predicate_pairs = [{'predicate': blocking_cache.predicate_name(p),
+                            'pairs': int(by_predicate[k + 1])}
+                           for k, p in enumerate(predicates)
+                           ]
+
+    def predicate_of(position):
+        code = predicate_codes[position]
+        return blocking_cache.predicate_name(predicates[code]) if code >= 0 else None
+
+    top = np.argsort(-pairs, kind='mergesort')[:top_k]
+    top = top[pairs[top] > 0]
+    heaviest = [{'key': key_text(block_map.key_list[b]),
+                 'predicate': predicate_of(b),
+                 'size': int(sizes[b]),
+                 'pairs': int(pairs[b]),
+                 'share_of_pairs': float(pairs[b]) / total_pairs}
+                for b in top.tolist()
+                ]
+
+    report = {'country': country,
+              'records': int(n_records),
+              'blocks': int(blocked.sum()),
+              'max_block_size': int(sizes.max()) if len(sizes) else 0,
+              'median_block_size': float(np.median(sizes[blocked])) if blocked.any() else 0,
+              'mean_block_size': float(np.mean(sizes[blocked])) if blocked.any() else 0,
+              'candidate_pairs': total_pairs,
+              'reduction_ratio': 1 - float(total_pairs) / all_pairs if all_pairs else None,
+              'size_histogram': size_histogram(sizes),
+              'pairs_by_predicate': predicate_pairs,
+              'heaviest_blocks': heaviest,
+              'benchmark_pairs': None,
+              'pair_completeness': None,
+              'seconds_per_pair': None,
+              'projected_scoring_seconds': None
+              }
+    if benchmark is not None:
+        report['benchmark_pairs'] = len(benchmark[0])
+        report['pair_completeness'] = pair_completeness(block_map, benchmark[0], benchmark[1])
+    if deduper is not None and data_d is not None:
+        seconds = time_per_pair(deduper, data_d, block_map)
+        if seconds is not None:
+            report['seconds_per_pair'] = seconds
+            report['projected_scoring_seconds'] = seconds * total_pairs
+    return report
+
+summary_fields = ['records', 'blocks', 'max_block_size', 'median_block_size',
+                  'mean_block_size', 'candidate_pairs', 'reduction_ratio',
+                  'benchmark_pairs', 'pair_completeness', 'seconds_per_pair',
+                  'projected_scoring_seconds'
+                  ]
+block_fields = ['key', 'predicate', 'size', 'pairs', 'share_of_pairs']
+
+def html_table(rows, fields):
+    header = ''.join('<th>%s</th>' % f for f in fields)
+    body = ''.join('<tr>%s</tr>' % ''.join('<td>%s</td>' % cgi.escape(unicode(row[f]))
+                                           for f in fields)
+                   for row in rows
+                   )
+    return '<table border="1"><tr>%s</tr>%s</table>' % (header, body)
+
+def write_report(report, file_root):
+    """
+    Writes the report to <file_root>.json, <file_root>.html and
+    <file_root>.csv. Returns the JSON file name.
+    """
+    with open(file_root + '.json', 'wt') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    with open(file_root + '.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank'] + block_fields)
+        for rank, block in enumerate(report['heaviest_blocks'], 1):
+            writer.writerow([rank] + [unicode(block[k]).encode('utf-8') for k in block_fields])
+
+    summary = [{'statistic': k, 'value': report[k]} for k in summary_fields]
+    html = ['<html><head><meta charset="utf-8"><title>Blocking report: %s</title></head><body>'
+            % report['country'],
+            '<h1>Blocking report: %s</h1>' % report['country'],
+            html_table(summary, ['statistic', 'value']),
+            '<h2>Block sizes</h2>',
+            html_table(report['size_histogram'], ['min_size', 'max_size', 'blocks', 'pairs']),
+            '<h2>Candidate pairs by predicate</h2>',
+            html_table(report['pairs_by_predicate'], ['predicate', 'pairs']),
+            '<h2>Heaviest blocks</h2>',
+            html_table(report['heaviest_blocks'], block_fields),
+            '</body></html>'
+            ]
+    with open(file_root + '.html', 'wt') as f:
+        f.write('\n'.join(html).encode('utf-8'))
+    return file_root + '.json'
@@ -0,0 +1,514 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Single dedupe engine for all countries. This replaces the per-country
+<cc>_weighted/patent_example_twostage_<cc>.py copies, which differed
+only in a few constants; those constants now live in
+dedupe_config.json and are read with load_config.
+
+Each country runs one or more rounds. In round n > 1 the data is first
+consolidated on the cluster ids from round n - 1. With twostage set, only
+the top 500 patenters and the records with similar names are deduped in
+that round.
+
+Per-country settings (see dedupe_config.json; "defaults" applies to every
+country unless overridden):
+- rounds, recall_weights, ppcs, dupes, twostage: one entry per round
+- sample_size: number of record pairs sampled for training, or
+- sample_multiple: sample this many pairs per input record instead,
+  up to max_sample_size (null for no limit). The pairs are drawn mostly
+  from within cheap blocking keys, stratified by name similarity, and
+  cached in the model cache (see training_sample.py)
+- label_file, label_column, label_level, label_pairs: benchmark labels
+  (e.g. Leuven hrm_l2_id or HAN han_id per person_id) to train from
+  when there is no training file. label_pairs match and as many
+  non-match pairs are written to the training file of the first round
+  (see label_training.py), and the country trains without prompting.
+  null for no labels
+- input_cleaners: names of functions in input_cleaners below, applied to
+  the input data frame before the first round
+- max_block_pairs, max_total_pairs: pair budgets for a single block and
+  for all blocks; oversized blocks are split with secondary predicates,
+  and over max_total_pairs the largest are cut into chunks of records
+  sorted by name (see patent_util.limit_block_pairs). null turns the
+  limits off
+- blocking_report, blocking_report_top: write blocking diagnostics
+  (candidate pairs, reduction ratio, pair completeness on the label_file
+  benchmark pairs, the blocking_report_top heaviest blocks, projected
+  scoring time) to blocking_report_r<r>_<cc>.json / .html / .csv in
+  the output directory (see blocking_report.py)
+- threshold_pairs: number of candidate pairs, sampled stratified by
+  block size, that goodThreshold scores to pick the threshold (see
+  BlockIndex.sample_pairs)
+- score_cache: score all candidate pairs once, write them to
+  patstat_scores_r<r>_<cc>.npz in the output directory and cluster from
+  the stored scores (see pair_scores.py and sweep_recall_weights.py)
+- cluster_method, max_cluster_size: with score_cache or
+  cluster_processes, how the scored
+  pairs are clustered: "hierarchical" (centroid linkage, as dedupe does)
+  or "components" (connected components, splitting only components over
+  max_cluster_size records; null for no limit)
+- cluster_processes: number of processes used to score the blocked
+  pairs, which are then clustered once (see
+  patent_util.parallelDuplicateClusters)
+- cluster_parity_check: with cluster_processes, also cluster the blocks
+  serially and print how many records' clusters differ
+
+Learned settings are cached in <settings_dir>/model_cache under a hash of
+the fields, training pairs, input schema and run settings (see
+model_cache.py), and training files are named patstat_training_<cc>_r<r>.json,
+so later runs reuse both.
+
+Use run_dedupe_countries.py to run several countries at once.
+"""
+
+import collections
+import datetime
+import json
+import os
+import re
+import sys
+import time
+
+import blocking_report
+import label_training
+import model_cache
+import pair_scores
+import pandas as pd
+import patent_util
+import sparse_cosine
+import training_sample
+
+# Finally load dedupe
+import dedupe
+from dedupe.distance import cosine
+sys.modules['cosine'] = cosine
+
+def integer_diff(a, b):
+    r = 1.0 / (abs(a-b) + 1)
+    return r
+
+# Input cleaners, referenced by name from dedupe_config.json
+def strip_co(input_df):
+    """
+    Drops everything after 'c/o' in the names
+    """
+    input_df['Name'] = [n.lower().split('c/o')[0] for n in input_df.Name.values]
+    return input_df
+
+re_mid = re.compile(' (ing|phd) ')
+re_end = re.compile(' (phd|ing)$')
+re_end_coauthor = re.compile('\s(phd|ing)?=*')
+
+def strip_titles(input_df):
+    """
+    Drops 'ing' and 'phd' titles from names and coauthors
+    """
+    ing_names = [re_mid.sub(' ', n) for n in input_df.Name]
+    ing_names = [re_end.sub(' ', n) for n in ing_names]
+    ing_coauthors = [re_end_coauthor.sub(' ', c) for c in input_df.Coauthor]
+    input_df['Name'] = ing_names
+    input_df['Coauthor'] = ing_coauthors
+    return input_df
+
+input_cleaners = {'strip_co': strip_co,
+                  'strip_titles': strip_titles
+                  }
+
+
+def load_config(config_file):
+    """
+    Reads the engine configuration file and returns a dict of
+    country: settings, with the defaults filled in for each country
+    """
+    with open(config_file, 'rt') as f:
+        config = json.load(f)
+    country_settings = {}
+    for country, settings in config['countries'].items():
+        this_settings = dict(config['defaults'])
+        this_settings.update(settings)
+        country_settings[country] = this_settings
+    return country_settings
+
+
+def read_input(input_file):
+    input_df = pd.read_csv(input_file)
+    input_df.Class.fillna('', inplace=True)
+    input_df.Coauthor.fillna('', inplace=True)
+    input_df.Lat.fillna('0.0', inplace=True)
+    input_df.Lng.fillna('0.0', inplace=True)
+    input_df.Name.fillna('', inplace=True)
+    return input_df
+
+
+def run_country(country, settings, input_file_dir, patent_file_dir,
+                output_file_dir, settings_dir='.', interactive=True):
+    """
+    Runs all rounds of disambiguation for one country and writes one
+    output file per round. If interactive is False and a round has no
+    saved settings or training file, the country is skipped rather than
+    prompting for labels. With a label_file setting, the first round
+    trains from the benchmark labels and never prompts.
+
+    Returns a dict summarising the run.
+    """
+    time_start = time.time()
+    this_date = datetime.datetime.now().strftime('%Y-%m-%d')
+
+    input_file = input_file_dir + '/' + 'dedupe_input_' + country + '.csv'
+    output_file_root = output_file_dir + '/' + 'patstat_output_' + this_date + '_r'
+    model_cache_dir = settings_dir + '/' + 'model_cache'
+    training_file_root = settings_dir + '/' + 'patstat_training_' + country + '_r'
+    patent_file = patent_file_dir + '/' + country + '_person_patent_map.csv'
+
+    summary = {'country': country,
+               'status': 'done',
+               'output_files': [],
+               'scores_files': [],
+               'blocking_reports': [],
+               'model_cache': []
+               }
+
+    print 'importing data for %s ...' % country
+    input_df = read_input(input_file)
+    for cleaner in settings.get('input_cleaners', []):
+        input_df = input_cleaners[cleaner](input_df)
+
+    rounds = settings['rounds']
+    recall_weights = settings['recall_weights']
+    ppcs = settings['ppcs']
+    dupes = settings['dupes']
+    twostage = settings['twostage']
+
+    ## Start the by-round labeling
+    for idx, r in enumerate(rounds):
+
+        r_twostage = twostage[idx]
+        r_recall_wt = recall_weights[idx]
+        r_ppc = ppcs[idx]
+        r_uncovered_dupes = dupes[idx]
+
+        r_output_file = output_file_root + str(r) + '_' + country + '.csv'
+        r_training_file = training_file_root + str(r) + '.json'
+        r_scores_file = output_file_dir + '/' + 'patstat_scores_r' + str(r) + '_' + country + '.npz'
+
+        # If this is the first round, take the native input
+        # If the nth round, consolidate data on the nth index
+        # and read in the resulting dataframe.
+        if idx == 0:
+            data_d = patent_util.readDataFrame(input_df)
+        else:
+            cluster_agg_dict = {'Name': patent_util.consolidate_unique,
+                                'Lat': patent_util.consolidate_geo,
+                                'Lng': patent_util.consolidate_geo,
+                                'Class': patent_util.consolidate_set,
+                                'Coauthor': patent_util.consolidate_set
+                                }
+            consolidated_input = patent_util.consolidate(input_df,
+                                                         cluster_name,
+                                                         cluster_agg_dict
+                                                         )
+            if r_twostage:
+                # Here, first find the top N patenters, then reduce the consolidated
+                # data to those patenters, then append likely matches and just dedupe that
+                df_patent = pd.read_csv(patent_file)
+                # Merge in the consolidated data
+                invpat = pd.merge(input_df,
+                                  df_patent,
+                                  left_on='Person',
+                                  right_on='Person',
+                                  how='inner'
+                                  )
+                invpat_grouped = invpat.groupby(cluster_name)
+                top_idx = patent_util.subset_nth_quantile(invpat_grouped, 500)
+                del invpat, invpat_grouped
+                candidate_inputs = consolidated_input.drop(top_idx, axis=0)
+                consolidated_input = consolidated_input.ix[top_idx]
+
+                addl_idx = patent_util.find_potential_matches(consolidated_input.Name,
+                                                              candidate_inputs.Name,
+                                                              0.8
+                                                              )
+
+                addl_data = candidate_inputs.ix[addl_idx]
+                consolidated_input = pd.concat([consolidated_input,
+                                               addl_data],
+                                               axis=0
+                                               )
+
+                # Reset the index so that it is sequential. Then
+                # store the new:old map
+                consolidated_input.reset_index(inplace=True)
+                index_map = consolidated_input['index'].to_dict()
+
+            data_d = patent_util.readDataFrame(consolidated_input)
+            del consolidated_input
+            input_df.set_index(cluster_name, inplace=True)
+
+        ## Build the comparators
+        class_comparator = sparse_cosine.SparseCosine(data_d, 'Class')
+        coauthor_comparator = sparse_cosine.SparseCosine(data_d, 'Coauthor')
+
+        # Define the fields dedupe will pay attention to
+        fields = {
+            'Name': {'type': 'String', 'Has Missing':True},
+            'LatLong': {'type': 'LatLong', 'Has Missing':True},
+            'Class': {'type': 'Custom', 'comparator':class_comparator},
+            'Coauthor': {'type': 'Custom', 'comparator': coauthor_comparator},
+            'patent_ct':{'type': 'Custom', 'comparator': integer_diff},
+            'patent_ct_name': {'type': 'Interaction',
+                               'Interaction Fields': ['Name', 'patent_ct']
+                               }
+            }
+
+        if 'sample_multiple' in settings:
+            sample_size = int(settings['sample_multiple'] * input_df.shape[0])
+        else:
+            sample_size = settings['sample_size']
+        if settings['max_sample_size'] is not None:
+            sample_size = min(sample_size, settings['max_sample_size'])
+
+        # Without a training file, label pairs from the benchmark ids.
+        # Only in the first round: later rounds dedupe clusters, which
+        # the person labels do not map to
+        if idx == 0 and settings['label_file'] and not os.path.exists(r_training_file):
+            labels = label_training.read_labels(settings['label_file'],
+                                                settings['label_column'],
+                                                settings['label_level']
+                                                )
+            label_training.label_training(input_df, data_d, labels, r_training_file,
+                                          settings['label_pairs']
+                                          )
+            del labels
+        labelled = bool(settings['label_file']) and os.path.exists(r_training_file)
+
+        # Learned settings are cached under a hash of the fields, the
+        # training pairs, the input schema and the run settings
+        run_settings = {'round': r,
+                        'twostage': r_twostage,
+                        'ppc': r_ppc,
+                        'uncovered_dupes': r_uncovered_dupes,
+                        'sample_size': sample_size,
+                        'input_cleaners': settings['input_cleaners']
+                        }
+        model_key = model_cache.model_key(country, fields, r_training_file,
+                                          input_df, run_settings
+                                          )
+        r_settings_file, warm = model_cache.lookup(model_cache_dir, country, model_key)
+        summary['model_cache'].append('warm' if warm else 'cold')
+
+        ## Training
+        data_sample = None
+        if warm:
+            print 'reading from', r_settings_file
+            deduper = dedupe.Dedupe(r_settings_file)
+            sparse_cosine.attach_comparators(deduper, data_d)
+
+        else:
+            if not interactive and not os.path.exists(r_training_file):
+                print 'No settings or training file for %s, round %s; skipping' % (country, r)
+                summary['status'] = 'no training data'
+                break
+
+            # To train dedupe, we feed it a sample of record pairs, mostly
+            # from within cheap blocking keys
+            sample_file = model_cache_dir + '/' + 'training_sample_' + country + '_r' + str(r) + '.npz'
+            data_sample = training_sample.training_sample(data_d,
+                                                          sample_size,
+                                                          patent_util.sub_block_predicates,
+                                                          sample_file
+                                                          )
+
+            # Create a new deduper object and pass our data model to it.
+            deduper = dedupe.Dedupe(fields)
+
+            # If we have training data saved from a previous run of dedupe,
+            # look for it an load it in.
+            # __Note:__ if you want to train from scratch, delete the training_file
+            if os.path.exists(r_training_file):
+                print 'reading labeled examples from ', r_training_file
+                deduper.train(data_sample, r_training_file)
+
+            ## Active learning
+            # use 'y', 'n' and 'u' keys to flag duplicates
+            # press 'f' when you are finished
+            if interactive and not labelled:
+                print 'starting active labeling...'
+                deduper.train(data_sample, dedupe.training.consoleLabel)
+
+                # When finished, save our training away to disk, and
+                # cache the settings under the key for the new labels
+                deduper.writeTraining(r_training_file)
+                model_key = model_cache.model_key(country, fields, r_training_file,
+                                                  input_df, run_settings
+                                                  )
+                r_settings_file = model_cache.settings_file(model_cache_dir,
+                                                            country,
+                                                            model_key
+                                                            )
+
+        ## Blocking
+        deduper.blocker_types.update({'Custom': (dedupe.predicates.wholeSetPredicate,
+                                                 dedupe.predicates.commonSetElementPredicate),
+                                      'LatLong' : (dedupe.predicates.latLongGridPredicate,)
+                                      }
+                                     )
+        time_block_start = time.time()
+        print 'blocking...'
+        # Initialize our blocker, which determines our field weights and blocking
+        # predicates based on our training data
+        blocker, ppc_final, ucd_final = patent_util.blockingSettingsWrapper(r_ppc,
+                                                                            r_uncovered_dupes,
+                                                                            deduper,
+                                                                            data_d=data_d,
+                                                                            data_sample=data_sample
+                                                                            )
+
+        if not blocker:
+            print 'No valid blocking settings found'
+            print 'Starting ppc value: %s' % r_ppc
+            print 'Starting uncovered_dupes value: %s' % r_uncovered_dupes
+            print 'Ending ppc value: %s' % ppc_final
+            print 'Ending uncovered_dupes value: %s' % ucd_final
+            summary['status'] = 'no blocking settings'
+            break
+
+        time_block_weights = time.time()
+        print 'Learned blocking weights in', time_block_weights - time_block_start, 'seconds'
+
+        # Save our weights and predicates to disk.
+        # If the settings file exists, we will skip all the training and learning
+        deduper.writeSettings(r_settings_file)
+
+        # Generate the tfidf canopy as needed
+        print 'generating tfidf index'
+        full_data = ((k, data_d[k]) for k in data_d)
+        blocker.tfIdfBlocks(full_data)
+        del full_data
+
+        # Load all the original data in to memory and place
+        # them in to blocks. Return only the block_id: unique_id keys
+        blocking_map = patent_util.return_block_map(data_d, blocker)
+
+        if settings['max_block_pairs'] is not None or settings['max_total_pairs'] is not None:
+            max_block_pairs = settings['max_block_pairs']
+            if max_block_pairs is None:
+                max_block_pairs = float('inf')
+            blocking_map = patent_util.limit_block_pairs(blocking_map,
+                                                         data_d,
+                                                         max_block_pairs,
+                                                         settings['max_total_pairs']
+                                                         )
+
+        keys_to_block = blocking_map.keys_with_size(2)
+        print '# Blocks to be clustered: %s' % len(keys_to_block)
+
+        if settings['blocking_report']:
+            # Benchmark pairs are person pairs, so only the first
+            # round's records map to them
+            benchmark = None
+            if idx == 0 and settings['label_file']:
+                benchmark = blocking_report.benchmark_pairs(input_df,
+                                                            label_training.read_labels(settings['label_file'],
+                                                                                       settings['label_column'],
+                                                                                       settings['label_level']
+                                                                                       )
+                                                            )
+            report = blocking_report.blocking_report(country,
+                                                     blocking_map,
+                                                     len(data_d),
+                                                     deduper.predicates,
+                                                     benchmark,
+                                                     deduper,
+                                                     data_d,
+                                                     settings['blocking_report_top']
+                                                     )
+            r_report_root = output_file_dir + '/' + 'blocking_report_r' + str(r) + '_' + country
+            summary['blocking_reports'].append(blocking_report.write_report(report, r_report_root))
+            print 'Blocking report written to %s' % r_report_root
+            del benchmark, report
+
+        # Save the weights and predicates
+        time_block = time.time()
+        print 'Blocking rules learned in', time_block - time_block_weights, 'seconds'
+        print 'Writing out settings'
+        deduper.writeSettings(r_settings_file)
+
+        ## Clustering
+
+        # Find the threshold that will maximize a weighted average of our precision and recall.
+        # When we set the recall weight to 1, we are trying to balance recall and precision
+        threshold_data = patent_util.return_threshold_data(blocking_map, data_d,
+                                                           settings['threshold_pairs']
+                                                           )
+
+        print 'Computing threshold'
+        threshold = deduper.goodThreshold(threshold_data, recall_weight=r_recall_wt)
+        del threshold_data
+
+        # `duplicateClusters` will return sets of record IDs that dedupe
+        # believes are all referring to the same entity.
+        print 'clustering...'
+        if settings['score_cache']:
+            # Score every candidate pair once and keep the scores, so
+            # that other recall weights can be tried with
+            # sweep_recall_weights.py without rescoring
+            id1, id2 = pair_scores.candidate_pairs(blocking_map, keys_to_block)
+            scores = pair_scores.score_record_pairs(deduper, data_d, id1, id2)
+            pair_scores.save_pair_scores(r_scores_file, id1, id2, scores)
+            summary['scores_files'].append(r_scores_file)
+            clustered_dupes = pair_scores.cluster_pair_scores(id1, id2, scores, threshold,
+                                                              settings['cluster_method'],
+                                                              settings['max_cluster_size']
+                                                              )
+            del id1, id2, scores
+        elif settings['cluster_processes'] > 1:
+            clustered_dupes = patent_util.parallelDuplicateClusters(deduper,
+                                                                    data_d,
+                                                                    [blocking_map[k] for k in keys_to_block],
+                                                                    threshold,
+                                                                    settings['cluster_processes'],
+                                                                    method=settings['cluster_method'],
+                                                                    max_cluster_size=settings['max_cluster_size'],
+                                                                    check_parity=settings['cluster_parity_check']
+                                                                    )
+        else:
+            clustered_dupes = deduper.duplicateClusters(patent_util.candidates_gen(blocking_map,
+                                                                                   keys_to_block,
+                                                                                   data_d,
+                                                                                   sparse_cosine.block_comparators(deduper)
+                                                                                   ),
+                                                        threshold
+                                                        )
+
+        print '# duplicate sets', len(clustered_dupes)
+
+        # Write the cluster membership into the data frame as a
+        # sequential index for later use
+        if r_twostage:
+            r_cluster_index = patent_util.cluster_index(input_df.index,
+                                                        clustered_dupes,
+                                                        index_map
+                                                        )
+        else:
+            r_cluster_index = patent_util.cluster_index(input_df.index,
+                                                        clustered_dupes
+                                                        )
+
+        cluster_name = 'cluster_id_r' + str(r)
+        input_df[cluster_name] = r_cluster_index
+
+        # Write out the data frame
+        input_df.to_csv(r_output_file)
+        summary['output_files'].append(r_output_file)
+
+        # Then reindex and consolidate
+        if idx > 0:
+            input_df.reset_index(inplace=True)
+
+        print 'Round %s completed' % r
+        # END DEDUPE LOOP
+
+    summary['runtime'] = time.time() - time_start
+    print 'Dedupe of %s complete, ran in %s seconds' % (country, summary['runtime'])
+    return summary
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+"""
+Incremental disambiguation: matches the person records that are new in
+a PATSTAT edition against the clusters of a previous dedupe run, rather
+than clustering the whole country again.
+
+Each existing cluster is represented by one consolidated record (as in
+the twostage rounds), whose patent_ct is the median of its records', so
+that a cluster of many records of one person is still compared as one
+person. The representatives' blocking keys are kept in a
+representative index, saved next to the output, so a run only blocks and
+scores the new records:
+
+1. New records are the persons in the input file that are not in the
+   previous output file
+2. The new records are blocked with the learned blocking predicates and
+   paired with the representatives and the other new records sharing a
+   block key. Representative-representative pairs are never scored, so
+   existing clusters only change when a new record links them
+3. The pairs are scored with the learned data model and clustered (see
+   pair_scores.cluster_pair_scores). For each cluster of the result:
+   - no representative: the new records open a new cluster
+   - one representative: the new records attach to that cluster
+   - several representatives: the clusters merge into the one with the
+     smallest id, and the new records attach to it
+   New records in no cluster open a cluster of their own
+4. The updated output file, a change log and the updated representative
+   index are written
+
+The score threshold is, unless given with -t, the one saved in the
+representative index by the previous incremental run. On a first run it
+is estimated from the scores of this run's candidate pairs (see
+pair_scores.threshold_for_recall_weight), with the recall weight of the
+country's last round in the dedupe_engine config file, or the one given
+with -r.
+
+The first run on a given previous output builds the representative index,
+which costs one pass over the existing clusters; later runs reuse the
+index written by the previous incremental run. TF-IDF canopy keys are
+only comparable within a run, so they only link new records to each
+other.
+
+The script is invoked from the command line as:
+
+python incremental_dedupe.py [options] <country> <input_file> <previous_output_file> <settings_file> <output_dir>
+
+Options:
+-t, --threshold   score threshold for matches (default: see above)
+-r, --recall-weight  recall weight used to estimate the threshold
+                  (default: from the config file)
+--config          dedupe_engine config file (default dedupe_config.json)
+-c, --column      cluster id column of the previous output (default cluster_id)
+--ppc, --dupes    blocking parameters, as in patstat_dedupe.py
+
+Output files are written to <output_dir>:
+- patstat_output_<date>_incr_<cc>.csv: the previous output plus the new
+  records, with updated cluster ids
+- patstat_changes_<date>_<cc>.csv: one row per new record (action new or
+  attach) and per merged cluster (action merge)
+- patstat_repindex_<cc>.pkl: the representative index, with the
+  threshold used
+"""
+
+import cPickle
+import collections
+import datetime
+import hashlib
+import itertools
+import numpy as np
+import optparse
+import os
+import pandas as pd
+import sys
+import time
+
+import dedupe_engine
+import pair_scores
+import patent_util
+import sparse_cosine
+
+import dedupe
+from dedupe.distance import cosine
+sys.modules['cosine'] = cosine
+
+cluster_agg_dict = {'Name': patent_util.consolidate_unique,
+                    'Lat': patent_util.consolidate_geo,
+                    'Lng': patent_util.consolidate_geo,
+                    'Class': patent_util.consolidate_set,
+                    'Coauthor': patent_util.consolidate_set,
+                    'patent_ct': np.median
+                    }
+
+def file_stamp(path):
+    """
+    Identifies a file by name, size and modification time
+    """
+    stat = os.stat(path)
+    return (os.path.basename(path), stat.st_size, int(stat.st_mtime))
+
+def settings_hash(settings_file):
+    with open(settings_file, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def resolve(cluster_id, aliases):
+    """
+    Follows merged cluster ids to the cluster they were merged into
+    """
+    while cluster_id in aliases:
+        cluster_id = aliases[cluster_id]
+    return cluster_id
+
+def block_keys(d, blocker):
+    """
+    Returns a record_id: [block keys] dict for the records in d
+    """
+    return dict((record_id, list(blocker((record_id, record))))
+                for record_id, record in d.iteritems()
+                )
+
+def build_rep_index(prev_df, cluster_col, blocker):
+    """
+    Consolidates prev_df to one representative record per cluster and
+    blocks the representatives. Returns the representative index.
+    """
+    print 'Building representative index for %s clusters' % prev_df[cluster_col].nunique()
+    reps = patent_util.consolidate(prev_df, cluster_col, cluster_agg_dict)
+    rep_d = patent_util.readDataFrame(reps)
+    blocker.tfIdfBlocks(rep_d.iteritems())
+    blocks = collections.defaultdict(list)
+    for cluster_id, keys in block_keys(rep_d, blocker).iteritems():
+        for k in keys:
+            blocks[k].append(cluster_id)
+    return {'reps': reps, 'blocks': dict(blocks), 'aliases': {}}
+
+def load_rep_index(index_file, prev_output_file, settings_file):
+    """
+    Loads the representative index if it was written for
+    prev_output_file and settings_file; returns None otherwise
+    """
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, 'rb') as f:
+        rep_index = cPickle.load(f)
+    if rep_index['output_file'] != file_stamp(prev_output_file) or \
+       rep_index['settings'] != settings_hash(settings_file):
+        print 'Representative index is out of date'
+        return None
+    print 'Loaded representative index from %s' % index_file
+    return rep_index
+
+def recall_weight_for(country, config_file):
+    """
+    The recall weight of the country's last round in the dedupe_engine
+    config file, which produced the clusters of its output
+    """
+    country_settings = dedupe_engine.load_config(config_file)
+    if country not in country_settings:
+        raise ValueError('Country %s is not in %s; give the recall weight with -r'
+                         % (country, config_file))
+    return country_settings[country]['recall_weights'][-1]
+
+def candidate_pairs(delta_keys, rep_blocks, aliases):
+    """
+    Pairs each new record with the representatives and the other new
+    records that share a block key. Returns (id1, id2) arrays of
+    distinct pairs.
+    """
+    delta_blocks = collections.defaultdict(list)
+    for record_id, keys in delta_keys.iteritems():
+        for k in keys:
+            delta_blocks[k].append(record_id)
+    pairs = set()
+    for k, new_ids in delta_blocks.iteritems():
+        rep_ids = set(resolve(c, aliases) for c in rep_blocks.get(k, ()))
+        for i in new_ids:
+            for c in rep_ids:
+                pairs.add((c, i))
+        for i, j in itertools.combinations(sorted(new_ids), 2):
+            pairs.add((i, j))
+    pairs = sorted(pairs)
+    id1 = np.array([p[0] for p in pairs], dtype=np.int64)
+    id2 = np.array([p[1] for p in pairs], dtype=np.int64)
+    return id1, id2
+
+def assign_clusters(clusters, delta_ids, max_cluster_id):
+    """
+    Turns the clusters of representatives (ids <= max_cluster_id) and
+    new records into cluster ids for the new records and merges of
+    existing clusters. Returns (new_cluster, actions, merges): dicts
+    of new record id: cluster id and new record id: action, and a list
+    of (merged cluster id, target cluster id).
+    """
+    new_cluster = {}
+    actions = {}
+    merges = []
+    for cluster in clusters:
+        rep_ids = [i for i in cluster if i <= max_cluster_id]
+        new_ids = [i for i in cluster if i > max_cluster_id]
+        if len(new_ids) == 0:
+            continue
+        if len(rep_ids) == 0:
+            target = min(new_ids)
+            action = 'new'
+        else:
+            target = min(rep_ids)
+            action = 'attach'
+            merges.extend((c, target) for c in rep_ids if c != target)
+        for i in new_ids:
+            new_cluster[i] = target
+            actions[i] = action
+    for i in delta_ids:
+        if i not in new_cluster:
+            new_cluster[i] = i
+            actions[i] = 'new'
+    return new_cluster, actions, merges
+
+
+if __name__ == '__main__':
+    optp = optparse.OptionParser()
+    optp.add_option('-t', '--threshold', dest='threshold', type='float', default=None)
+    optp.add_option('-r', '--recall-weight', dest='recall_weight', type='float', default=None)
+    optp.add_option('--config', dest='config', default='dedupe_config.json')
+    optp.add_option('-c', '--column', dest='cluster_col', default='cluster_id')
+    optp.add_option('--ppc', dest='ppc', type='float', default=0.001)
+    optp.add_option('--dupes', dest='dupes', type='int', default=5)
+    (opts, args) = optp.parse_args()
+
+    country = args[0]
+    input_file = args[1]
+    prev_output_file = args[2]
+    settings_file = args[3]
+    output_dir = args[4]
+
+    this_date = datetime.datetime.now().strftime('%Y-%m-%d')
+    output_file = output_dir + '/' + 'patstat_output_' + this_date + '_incr_' + country + '.csv'
+    changes_file = output_dir + '/' + 'patstat_changes_' + this_date + '_' + country + '.csv'
+    index_file = output_dir + '/' + 'patstat_repindex_' + country + '.pkl'
+    cluster_col = opts.cluster_col
+
+    time_start = time.time()
+    prev_df = pd.read_csv(prev_output_file, index_col=0)
+    new_input = dedupe_engine.read_input(input_file)
+    delta = new_input[~new_input.Person.isin(prev_df.Person)].copy()
+    max_cluster_id = prev_df[cluster_col].max()
+    delta.index = max_cluster_id + 1 + np.arange(delta.shape[0])
+    print '%s existing records in %s clusters; %s new records' % (prev_df.shape[0],
+                                                                  prev_df[cluster_col].nunique(),
+                                                                  delta.shape[0]
+                                                                  )
+
+    # Learned model and blocking predicates
+    deduper = dedupe.Dedupe(settings_file)
+    deduper.blocker_types.update({'Custom': (dedupe.predicates.wholeSetPredicate,
+                                             dedupe.predicates.commonSetElementPredicate),
+                                  'LatLong' : (dedupe.predicates.latLongGridPredicate,)
+                                  }
+                                 )
+    blocker, ppc_final, ucd_final = patent_util.blockingSettingsWrapper(opts.ppc,
+                                                                        opts.dupes,
+                                                                        deduper
+                                                                        )
+    if not blocker:
+        print 'No valid blocking settings found'
+        sys.exit(1)
+
+    rep_index = load_rep_index(index_file, prev_output_file, settings_file)
+    if rep_index is None:
+        rep_index = build_rep_index(prev_df, cluster_col, blocker)
+    aliases = rep_index['aliases']
+
+    # Block and score the new records only
+    delta_d = patent_util.readDataFrame(delta)
+    blocker.tfIdfBlocks(delta_d.iteritems())
+    delta_keys = block_keys(delta_d, blocker)
+    id1, id2 = candidate_pairs(delta_keys, rep_index['blocks'], aliases)
+    print '%s candidate pairs' % len(id1)
+
+    rep_ids = np.unique(id1[id1 <= max_cluster_id])
+    data_d = patent_util.readDataFrame(pd.concat([rep_index['reps'].loc[rep_ids],
+                                                  delta[rep_index['reps'].columns]
+                                                  ],
+                                                 axis=0
+                                                 ))
+    sparse_cosine.attach_comparators(deduper, data_d)
+    scores = pair_scores.score_record_pairs(deduper, data_d, id1, id2)
+    threshold = opts.threshold
+    if threshold is None:
+        threshold = rep_index.get('threshold')
+    if threshold is None and len(scores) > 0:
+        recall_weight = opts.recall_weight
+        if recall_weight is None:
+            recall_weight = recall_weight_for(country, opts.config)
+        threshold = float(pair_scores.threshold_for_recall_weight(scores, recall_weight))
+        print 'Estimated threshold %s for recall weight %s' % (threshold, recall_weight)
+    print 'Threshold: %s' % threshold
+    clusters = []
+    if len(scores) > 0:
+        clusters = pair_scores.cluster_pair_scores(id1, id2, scores, threshold)
+    new_cluster, actions, merges = assign_clusters(clusters, delta.index, max_cluster_id)
+
+    # Apply merges to the existing records, then add the new ones
+    for merged, target in merges:
+        aliases[merged] = target
+    if len(aliases) > 0:
+        prev_df[cluster_col] = [resolve(c, aliases) for c in prev_df[cluster_col].values]
+    delta_ids = delta.index.values
+    delta[cluster_col] = [resolve(new_cluster[i], aliases) for i in delta_ids]
+    delta.index = prev_df.index.max() + 1 + np.arange(delta.shape[0])
+    output_df = pd.concat([prev_df, delta.reindex(columns=prev_df.columns)], axis=0)
+    output_df.to_csv(output_file)
+
+    changes = pd.DataFrame({'action': [actions[i] for i in delta_ids],
+                            'Person': delta.Person.values,
+                            'cluster_id': delta[cluster_col].values,
+                            'merged_cluster_id': ''
+                            })
+    if len(merges) > 0:
+        merge_changes = pd.DataFrame({'action': 'merge',
+                                      'Person': '',
+                                      'cluster_id': [resolve(t, aliases) for m, t in merges],
+                                      'merged_cluster_id': [m for m, t in merges]
+                                      })
+        changes = pd.concat([changes, merge_changes], axis=0)
+    changes[['action', 'Person', 'cluster_id', 'merged_cluster_id']].to_csv(changes_file, index=False)
+
+    # New clusters are represented by their first new record
+    for i in delta_ids:
+        if actions[i] == 'new' and new_cluster[i] == i:
+            for k in delta_keys[i]:
+                rep_index['blocks'].setdefault(k, []).append(i)
+    new_reps = delta.loc[[c == i for c, i in zip(delta[cluster_col].values, delta_ids)]]
+    new_reps.index = new_reps[cluster_col].values
+    rep_index['reps'] = pd.concat([rep_index['reps'], new_reps[rep_index['reps'].columns]], axis=0)
+    rep_index['output_file'] = file_stamp(output_file)
+    rep_index['settings'] = settings_hash(settings_file)
+    rep_index['threshold'] = threshold
+    with open(index_file, 'wb') as f:
+        cPickle.dump(rep_index, f, 2)
+
+    action_counts = changes.action.value_counts()
+    for a in ['new', 'attach', 'merge']:
+        print '%s: %s' % (a, action_counts.get(a, 0))
+    print 'Incremental dedupe complete, ran in %s seconds' % (time.time() - time_start)
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+## label_training.py
+## dedupe training pairs from benchmark person labels (Leuven / HAN)
+
+import json
+import numpy as np
+import optparse
+import pandas as pd
+
+import patent_util
+
+"""
+Without a training file, dedupe asks a person to label pairs at the
+console. The Leuven (hrm_l2_id) and HAN (han_id) tables already give
+ids to many PATSTAT persons. Here those ids are turned into labelled
+pairs, written as a dedupe training file:
+
+- matches: pairs of records with the same label. A label is picked with
+  weight equal to its number of pairs, capped at max_label_pairs, so a
+  few very common labels do not take up the whole sample. Then two of
+  its records are picked at random.
+- non-matches: the same number of pairs of labelled records with
+  different labels. hard_fraction of them share name initials
+  (patent_util.name_initials_key), so the model also sees non-matches
+  that look alike; the rest are random pairs.
+
+Everything is drawn with array operations over the labelled records,
+rather than one .ix lookup per pair as in
+archive/generate_leuven_dedupe_training_data.py. The labels file is a
+csv with a person_id column and a label column; persons not in the
+dedupe input are ignored.
+
+Run as a script to write one training file:
+
+python label_training.py [options] <input_file> <labels_file> <training_file>
+
+Options:
+-c, --label-column  label column of the labels file (default hrm_l2_id)
+-l, --level         keep only the labels file rows with this hrm_level
+-n, --pairs         number of match pairs, and of non-match pairs (default 5000)
+"""
+
+def read_labels(labels_file, label_column='hrm_l2_id', level=None):
+    """
+    person_id: label series from a Leuven or HAN labels file
+    """
+    df = pd.read_csv(labels_file)
+    if level is not None:
+        df = df[df.hrm_level == level]
+    df = df[df[label_column].notnull()].drop_duplicates('person_id')
+    return pd.Series(df[label_column].values, index=df.person_id.values)
+
+def group_pairs(codes, n_pairs, rng, max_group_pairs=100):
+    """
+    About n_pairs distinct random pairs (i, j), i < j, of positions with
+    equal codes. Groups are picked in proportion to their number of
+    pairs, capped at max_group_pairs.
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(codes)])
+    keep = sizes > 1
+    starts = starts[keep]
+    sizes = sizes[keep]
+    if len(sizes) == 0 or n_pairs <= 0:
+        return empty, empty
+
+    weights = np.minimum(sizes * (sizes - 1) / 2, max_group_pairs).astype(np.float64)
+    groups = np.searchsorted(np.cumsum(weights), rng.uniform(0, weights.sum(), 2 * n_pairs),
+                             side='right'
+                             )
+    group_sizes = sizes[groups]
+    i = (rng.uniform(size=len(groups)) * group_sizes).astype(np.int64)
+    j = (i + 1 + (rng.uniform(size=len(groups)) * (group_sizes - 1)).astype(np.int64)) % group_sizes
+    pos_1 = order[starts[groups] + i]
+    pos_2 = order[starts[groups] + j]
+    return distinct_pairs(pos_1, pos_2, len(codes), n_pairs)
+
+def distinct_pairs(pos_1, pos_2, n, n_pairs):
+    """
+    The first n_pairs distinct pairs of (pos_1, pos_2), in draw order,
+    as (smaller, larger) positions
+    """
+    pos_1, pos_2 = np.minimum(pos_1, pos_2), np.maximum(pos_1, pos_2)
+    keys = pos_1.astype(np.int64) * n + pos_2
+    first = np.sort(np.unique(keys, return_index=True)[1])[:n_pairs]
+    return pos_1[first], pos_2[first]
+
+def label_pairs(labels, n_pairs, name_keys=None, hard_fraction=0.5,
+                max_label_pairs=100, seed=0):
+    """
+    Draws match and non-match pairs of positions in the label array
+    labels, as described in the module docstring. name_keys holds the
+    name initials of each position, for the hard non-matches. Returns
+    ((match_1, match_2), (nonmatch_1, nonmatch_2)).
+    """
+    rng = np.random.RandomState(seed)
+    label_codes = pd.factorize(labels)[0]
+    n = len(label_codes)
+    matches = group_pairs(label_codes, n_pairs, rng, max_label_pairs)
+    if n < 2:
+        return matches, matches
+    n_nonmatches = len(matches[0])
+
+    nonmatch_1 = []
+    nonmatch_2 = []
+    if name_keys is not None and hard_fraction > 0:
+        key_codes = pd.factorize(name_keys)[0]
+        # Draw extra, since some of these pairs share a label
+        pos_1, pos_2 = group_pairs(key_codes, 4 * n_nonmatches, rng, max_label_pairs)
+        differ = label_codes[pos_1] != label_codes[pos_2]
+        n_hard = int(hard_fraction * n_nonmatches)
+        nonmatch_1.append(pos_1[differ][:n_hard])
+        nonmatch_2.append(pos_2[differ][:n_hard])
+
+    n_random = n_nonmatches - sum(len(p) for p in nonmatch_1)
+    pos_1 = rng.randint(0, n, 2 * n_random + 10)
+    pos_2 = rng.randint(0, n, 2 * n_random + 10)
+    differ = label_codes[pos_1] != label_codes[pos_2]
+    nonmatch_1.append(pos_1[differ])
+    nonmatch_2.append(pos_2[differ])
+    nonmatches = distinct_pairs(np.concatenate(nonmatch_1),
+                                np.concatenate(nonmatch_2),
+                                n,
+                                n_nonmatches
+                                )
+    return matches, nonmatches
+
+def to_json(o):
+    """
+    json default for dedupe training files: frozensets are written as
+    dedupe's serializer writes them
+    """
+    if isinstance(o, frozenset):
+        return {'__class__': 'frozenset', '__value__': list(o)}
+    raise TypeError(repr(o) + ' is not JSON serializable')
+
+def write_training(training_pairs, training_file):
+    """
+    Writes {0: [(record, record), ...], 1: [...]} as a dedupe training
+    file
+    """
+    with open(training_file, 'wt') as f:
+        json.dump(training_pairs, f, default=to_json)
+
+def label_training(input_df, data_d, labels, training_file, n_pairs=5000,
+                   hard_fraction=0.5, seed=0):
+    """
+    Writes a training file of n_pairs match and n_pairs non-match pairs
+    for the records of data_d, built from input_df by
+    patent_util.readDataFrame, using the person_id: label series labels.
+    Returns the number of (match, non-match) pairs written; nothing is
+    written if the labels give no match pairs.
+    """
+    labelled = input_df.Person.isin(labels.index).values
+    record_ids = input_df.index.values[labelled]
+    record_labels = labels.reindex(input_df.Person.values[labelled]).values
+    print 'Labelled records: %s of %s' % (len(record_ids), input_df.shape[0])
+
+    name_keys = [patent_util.name_initials_key(data_d[i]) for i in record_ids.tolist()]
+    matches, nonmatches = label_pairs(record_labels, n_pairs, name_keys, hard_fraction,
+                                      seed=seed
+                                      )
+
+    def record_pairs(positions):
+        return [(data_d[i].frozen(), data_d[j].frozen())
+                for i, j in zip(record_ids[positions[0]].tolist(),
+                                record_ids[positions[1]].tolist()
+                                )
+                ]
+
+    if len(matches[0]) == 0:
+        print 'No labelled match pairs; %s not written' % training_file
+        return 0, 0
+
+    training_pairs = {0: record_pairs(nonmatches), 1: record_pairs(matches)}
+    write_training(training_pairs, training_file)
+    print 'Wrote %s match and %s non-match pairs to %s' % (len(training_pairs[1]),
+                                                           len(training_pairs[0]),
+                                                           training_file
+                                                           )
+    return len(training_pairs[1]), len(training_pairs[0])
+
+if __name__ == '__main__':
+    optp = optparse.OptionParser()
+    optp.add_option('-c', '--label-column', dest='label_column', default='hrm_l2_id')
+    optp.add_option('-l', '--level', dest='level', type='int', default=None)
+    optp.add_option('-n', '--pairs', dest='pairs', type='int', default=5000)
+    (opts, args) = optp.parse_args()
+
+    input_file = args[0]
+    labels_file = args[1]
+    training_file = args[2]
+
+    input_df = pd.read_csv(input_file)
+    input_df.Class.fillna('', inplace=True)
+    input_df.Coauthor.fillna('', inplace=True)
+    input_df.Lat.fillna('0.0', inplace=True)
+    input_df.Lng.fillna('0.0', inplace=True)
+    input_df.Name.fillna('', inplace=True)
+    data_d = patent_util.readDataFrame(input_df)
+
+    labels = read_labels(labels_file, opts.label_column, opts.level)
+    label_training(input_df, data_d, labels, training_file, opts.pairs)
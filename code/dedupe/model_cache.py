@@ -0,0 +1,79 @@
+## model_cache.py
+## Settings cache keyed on what the learned model depends on
+
+import hashlib
+import json
+import os
+
+"""
+Dedupe settings files hold the learned data model and blocking
+predicates. They used to be named by the date of the run, so a run on a
+new day never found the previous day's settings and went back to active
+labelling. Here they are named by a hash of everything the model is
+learned from:
+
+- the country (and round, blocking parameters and other run settings)
+- the field definitions
+- the labelled training pairs, i.e. the training file contents
+- the input schema: column names and dtypes
+
+A run whose key matches a cached settings file reuses it (warm);
+otherwise the model is learned and written to the cache under the key
+(cold). Changing any of the inputs above gives a new key, so a stale
+model is never reused.
+"""
+
+def fields_signature(fields):
+    """
+    JSON-serialisable form of a dedupe field definition dict. Custom
+    comparators are represented by their function or class name.
+    """
+    signature = {}
+    for name, definition in fields.items():
+        sig = {}
+        for k, v in definition.items():
+            if callable(v):
+                v = getattr(v, '__name__', type(v).__name__)
+            sig[k] = v
+        signature[name] = sig
+    return signature
+
+def model_key(country, fields, training_file, input_df, run_settings=None):
+    """
+    Hex digest identifying the model learned for country from fields,
+    the pairs in training_file (if it exists) and the schema of
+    input_df. run_settings holds any other values the learned model
+    depends on, e.g. the round and blocking parameters.
+    """
+    description = {'country': country,
+                   'fields': fields_signature(fields),
+                   'schema': [(str(c), str(t)) for c, t in input_df.dtypes.iteritems()],
+                   'run_settings': run_settings
+                   }
+    h = hashlib.md5()
+    h.update(json.dumps(description, sort_keys=True))
+    if training_file and os.path.exists(training_file):
+        with open(training_file, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), ''):
+                h.update(block)
+    return h.hexdigest()
+
+def settings_file(cache_dir, country, key):
+    """
+    Path of the cached settings file for key. Creates cache_dir if needed.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir,
+                        'patstat_settings_' + country + '_' + key[:16] + '.json'
+                        )
+
+def lookup(cache_dir, country, key):
+    """
+    Returns (settings_file, warm), where warm is True if a settings file
+    for key is already in the cache
+    """
+    path = settings_file(cache_dir, country, key)
+    warm = os.path.exists(path)
+    print 'Model cache %s for %s: %s' % ('hit' if warm else 'miss', country, path)
+    return path, warm
@@ -0,0 +1,110 @@
+## name_index.py
+## q-gram inverted index for Levenshtein ratio searches over names
+
+import collections
+import numpy as np
+import pandas as pd
+import Levenshtein
+
+"""
+Finds all names within a Levenshtein.ratio threshold of a query without
+comparing the query against every name.
+
+Levenshtein.ratio(a, b) = 1 - D / (len(a) + len(b)), where D is the
+insert / delete edit distance between a and b. So ratio >= t requires
+
+  D <= (1 - t) * (len(a) + len(b)) = D_max
+
+Two filters follow from this, and neither drops a true match:
+- length: |len(a) - len(b)| <= D_max
+- count: each insert or delete destroys at most q of the q-grams of a
+  string, so a and b share at least max(g(a), g(b)) - q * D_max
+  distinct q-grams, where g() is the number of distinct q-grams
+
+Names passing both filters are verified with Levenshtein.ratio.
+"""
+
+def qgrams(s, q):
+    return set(s[i:i + q] for i in xrange(len(s) - q + 1))
+
+class NameIndex(object):
+    """
+    Inverted index from q-grams to the distinct names of a pandas Series.
+    query and query_batch return the index labels of the Series entries
+    whose name is within a Levenshtein ratio threshold of the query.
+    """
+
+    def __init__(self, names, q=2):
+        self.q = q
+        codes, uniques = pd.factorize(names)
+        self.uniques = [u if isinstance(u, basestring) else None for u in uniques]
+        self.lengths = np.array([len(u) if u is not None else -1 for u in self.uniques])
+
+        # Series labels grouped by distinct name
+        labels = np.asarray(names.index)
+        valid = codes >= 0
+        order = np.argsort(codes[valid], kind='mergesort')
+        self.labels = labels[valid][order]
+        self.label_offsets = np.searchsorted(codes[valid][order],
+                                             np.arange(len(self.uniques) + 1)
+                                             )
+
+        postings = collections.defaultdict(list)
+        n_grams = np.zeros(len(self.uniques), dtype=np.int64)
+        for i, u in enumerate(self.uniques):
+            if u is None:
+                continue
+            grams = qgrams(u, q)
+            n_grams[i] = len(grams)
+            for g in grams:
+                postings[g].append(i)
+        self.n_grams = n_grams
+        self.postings = dict((g, np.array(p, dtype=np.int64))
+                             for g, p in postings.iteritems()
+                             )
+
+    def query_names(self, s, threshold, exclude=None):
+        """
+        Positions of the distinct names within threshold of s. Names
+        flagged in the boolean array exclude are skipped.
+        """
+        n = len(self.uniques)
+        grams = qgrams(s, self.q)
+        lists = [self.postings[g] for g in grams if g in self.postings]
+        if len(lists) > 0:
+            common = np.bincount(np.concatenate(lists), minlength=n)
+        else:
+            common = np.zeros(n, dtype=np.int64)
+
+        d_max = np.floor((1 - threshold) * (len(s) + self.lengths) + 1e-9)
+        min_common = np.maximum(len(grams), self.n_grams) - self.q * d_max
+        candidates = (self.lengths >= 0) & \
+                     (np.abs(self.lengths - len(s)) <= d_max) & \
+                     (common >= min_common)
+        if exclude is not None:
+            candidates &= ~exclude
+
+        return [i for i in np.flatnonzero(candidates)
+                if Levenshtein.ratio(s, self.uniques[i]) >= threshold
+                ]
+
+    def query(self, s, threshold):
+        """
+        Index labels of the names within threshold of s
+        """
+        return self._labels(self.query_names(s, threshold))
+
+    def query_batch(self, queries, threshold):
+        """
+        Index labels of the names within threshold of any of queries.
+        Names already matched are not checked again.
+        """
+        matched = np.zeros(len(self.uniques), dtype=bool)
+        for s in set(q for q in queries if isinstance(q, basestring)):
+            matched[self.query_names(s, threshold, matched)] = True
+        return self._labels(np.flatnonzero(matched))
+
+    def _labels(self, name_positions):
+        return [l for i in name_positions
+                for l in self.labels[self.label_offsets[i]:self.label_offsets[i + 1]].tolist()
+                ]
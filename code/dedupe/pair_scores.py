@@ -0,0 +1,202 @@
+## pair_scores.py
+## Score candidate pairs once and cluster them at any threshold
+
+import itertools
+import numpy as np
+from scipy.cluster import hierarchy
+import time
+
+import batch_scoring
+import dedupe
+from record_store import RecordStore
+
+"""
+Scoring the candidate pairs is the expensive part of a dedupe run;
+choosing a threshold and clustering the scored pairs is cheap. The
+functions here score every candidate pair once, store the scores on disk
+as three aligned arrays (id1, id2, score), and then produce clusterings
+for any number of recall weights or thresholds from the stored scores.
+
+Thresholds for a recall weight are chosen as in Dedupe.goodThreshold.
+Clustering starts from the connected components of the pairs scoring
+above the threshold, found with an array-based union-find. By default
+the components are then split with centroid linkage at distance
+1 - threshold, as in dedupe's hierarchical clustering; the cheaper
+'components' method keeps them whole, splitting only components over a
+maximum size.
+"""
+
+def candidate_pairs(block_map, block_keys):
+    """
+    Returns the distinct record id pairs (id1 < id2) compared within
+    the blocks block_keys of block_map, as two integer arrays
+    """
+    pair_keys = []
+    max_id = 0
+    for block_key in block_keys:
+        ids = np.asarray(block_map[block_key], dtype=np.int64)
+        if len(ids) < 2:
+            continue
+        max_id = max(max_id, ids.max())
+        i, j = np.triu_indices(len(ids), 1)
+        pair_keys.append((ids[i], ids[j]))
+    if len(pair_keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    id1 = np.concatenate([p[0] for p in pair_keys])
+    id2 = np.concatenate([p[1] for p in pair_keys])
+    del pair_keys
+    lo = np.minimum(id1, id2)
+    hi = np.maximum(id1, id2)
+    keep = lo != hi
+    keys = np.unique(lo[keep] * (max_id + 1) + hi[keep])
+    return keys // (max_id + 1), keys % (max_id + 1)
+
+def score_record_pairs(deduper, d, id1, id2, batch_size=100000):
+    """
+    Scores the record pairs (d[id1], d[id2]) with the learned data model
+    of deduper, batch_size pairs at a time. Records in a RecordStore are
+    scored with batch_scoring.PairScorer when it reproduces dedupe's
+    scores, and through dedupe.core otherwise.
+    """
+    scorer = None
+    if isinstance(d, RecordStore):
+        scorer = batch_scoring.pair_scorer(deduper, d, id1, id2)
+    scores = np.zeros(len(id1), dtype=np.float32)
+    start_time = time.time()
+    for start in xrange(0, len(id1), batch_size):
+        end = min(start + batch_size, len(id1))
+        if scorer is not None:
+            scores[start:end] = scorer.score(id1[start:end], id2[start:end])
+        else:
+            pairs = ((d[i], d[j])
+                     for i, j in itertools.izip(id1[start:end].tolist(),
+                                                id2[start:end].tolist()
+                                                )
+                     )
+            field_distances = dedupe.core.fieldDistances(pairs, deduper.data_model)
+            scores[start:end] = dedupe.core.scorePairs(field_distances,
+                                                       deduper.data_model
+                                                       )
+        print 'Scored %s of %s pairs in %s seconds' % (end,
+                                                       len(id1),
+                                                       time.time() - start_time
+                                                       )
+    return scores
+
+def save_pair_scores(scores_file, id1, id2, scores):
+    np.savez(scores_file, id1=id1, id2=id2, score=scores)
+
+def load_pair_scores(scores_file):
+    """
+    Returns the (id1, id2, score) arrays written by save_pair_scores
+    """
+    f = np.load(scores_file)
+    return f['id1'], f['id2'], f['score']
+
+def threshold_for_recall_weight(scores, recall_weight):
+    """
+    The score threshold that maximises the weighted F-measure of
+    precision and recall, estimated from the pair scores as in
+    Dedupe.goodThreshold
+    """
+    probability = np.sort(scores)[::-1].astype(np.float64)
+    expected_dupes = np.cumsum(probability)
+    recall = expected_dupes / expected_dupes[-1]
+    precision = expected_dupes / np.arange(1, len(expected_dupes) + 1)
+    score = recall * precision / (recall + recall_weight ** 2 * precision)
+    return probability[np.argmax(score)]
+
+def union_find(code1, code2, n):
+    """
+    Connected components of the graph on nodes 0..n-1 with edges
+    (code1[k], code2[k]), by array-based union-find: each pass hooks the
+    larger root of every edge that still joins two components onto the
+    smaller one, then compresses paths by pointer jumping until every
+    node points at its root. Returns the root of each node, which is the
+    smallest node of its component.
+    """
+    parent = np.arange(n)
+    while True:
+        root1 = parent[code1]
+        root2 = parent[code2]
+        crossing = root1 != root2
+        if not crossing.any():
+            return parent
+        lo = np.minimum(root1[crossing], root2[crossing])
+        hi = np.maximum(root1[crossing], root2[crossing])
+        np.minimum.at(parent, hi, lo)
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+def _split_component(members, pairs, code1, code2, distances, threshold):
+    """
+    Splits one connected component (members, node codes; pairs, edge
+    positions) with centroid linkage at distance 1 - threshold. Returns
+    the parts with more than one member, as arrays of node codes.
+    """
+    # Condensed distance matrix over the component; unscored pairs
+    # are at distance 1
+    local = dict(itertools.izip(members.tolist(), itertools.count()))
+    n = len(members)
+    local1 = np.array([local[c] for c in code1[pairs].tolist()], dtype=np.int64)
+    local2 = np.array([local[c] for c in code2[pairs].tolist()], dtype=np.int64)
+    i = np.minimum(local1, local2)
+    j = np.maximum(local1, local2)
+    condensed = np.ones(n * (n - 1) / 2)
+    condensed[n * i - i * (i + 1) / 2 + j - i - 1] = distances[pairs]
+    linkage = hierarchy.linkage(condensed, method='centroid')
+    partition = hierarchy.fcluster(linkage, 1 - threshold, criterion='distance')
+    return [members[partition == p] for p in np.unique(partition)
+            if (partition == p).sum() > 1
+            ]
+
+def cluster_pair_scores(id1, id2, scores, threshold, method='hierarchical',
+                        max_cluster_size=None):
+    """
+    Clusters the records linked by pairs scoring above threshold.
+
+    With method 'hierarchical', each connected component of more than
+    two records is split with centroid linkage, as dedupe does. With
+    method 'components', the connected components are the clusters,
+    except that components of more than max_cluster_size records (if
+    set) are split with centroid linkage.
+
+    Returns the clusters as tuples of sorted record ids, ordered by
+    their smallest record id.
+    """
+    keep = scores > threshold
+    id1 = id1[keep]
+    id2 = id2[keep]
+    distances = 1 - scores[keep].astype(np.float64)
+    if len(id1) == 0:
+        return []
+    ids, codes = np.unique(np.concatenate([id1, id2]), return_inverse=True)
+    code1 = codes[:len(id1)]
+    code2 = codes[len(id1):]
+    roots, labels = np.unique(union_find(code1, code2, len(ids)), return_inverse=True)
+    n_components = len(roots)
+
+    # Group the records and the pairs by component
+    record_order = np.argsort(labels, kind='mergesort')
+    record_bounds = np.searchsorted(labels[record_order], np.arange(n_components + 1))
+    pair_labels = labels[code1]
+    pair_order = np.argsort(pair_labels, kind='mergesort')
+    pair_bounds = np.searchsorted(pair_labels[pair_order], np.arange(n_components + 1))
+
+    clusters = []
+    for c in xrange(n_components):
+        members = record_order[record_bounds[c]:record_bounds[c + 1]]
+        if method == 'components':
+            split = max_cluster_size is not None and len(members) > max_cluster_size
+        else:
+            split = len(members) > 2
+        if split:
+            pairs = pair_order[pair_bounds[c]:pair_bounds[c + 1]]
+            parts = _split_component(members, pairs, code1, code2, distances, threshold)
+        else:
+            parts = [members]
+        clusters.extend(tuple(sorted(ids[p].tolist())) for p in parts)
+    return sorted(clusters)
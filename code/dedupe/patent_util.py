@@ -0,0 +1,602 @@
+## patent_util.py
+## Author: Mark Huberty
+## Provides utility functions for the patent_example
+
+import re
+import random
+import AsciiDammit
+from block_index import BlockIndex, split_oversized_blocks
+import blocking_cache
+from name_index import NameIndex
+import pair_scores
+from record_store import RecordStore
+import sparse_cosine
+import csv
+import collections
+import dedupe
+import itertools
+import logging
+import multiprocessing
+import numpy as np
+import pandas as pd
+import collections
+import time
+import operator
+
+def preProcess(column):
+    """
+    Do a little bit of data cleaning with the help of
+    [AsciiDammit](https://github.com/tnajdek/ASCII--Dammit) and
+    Regex. Things like casing, extra spaces, quotes and new lines can
+    be ignored.
+    """
+
+    column = AsciiDammit.asciiDammit(column)
+    column = re.sub('  +', ' ', column)
+    column = re.sub('\n', ' ', column)
+    column = column.strip().strip('"').strip("'").lower().strip()
+    return column
+
+
+
+def preProcessCached(column):
+    """
+    preProcess with a module-level cache; tokens such as IPC classes and
+    coauthor names repeat across many records.
+    """
+    try:
+        return preprocess_cache[column]
+    except KeyError:
+        out = preProcess(column)
+        preprocess_cache[column] = out
+        return out
+
+preprocess_cache = {}
+
+def splitSetColumnTokens(col, set_delim='**'):
+    """
+    Factorises a column of set_delim-delimited strings. Returns the code
+    of each record's string and the distinct strings split into lists of
+    preprocessed tokens; each distinct string is split and preprocessed
+    once. Missing values get the last code, with the set [''].
+    """
+    codes, uniques = pd.factorize(col)
+    unique_tokens = [[preProcessCached(c) for c in u.split(set_delim)]
+                     if isinstance(u, str) else ['']
+                     for u in uniques
+                     ]
+    unique_tokens.append([''])
+    codes[codes < 0] = len(uniques)
+    return codes, unique_tokens
+
+def splitSetColumn(col, set_delim='**'):
+    """
+    Maps a column of set_delim-delimited strings to a list of frozensets
+    of preprocessed tokens. Records with the same string share the same
+    frozenset.
+    """
+    codes, unique_tokens = splitSetColumnTokens(col, set_delim)
+    unique_sets = [frozenset(t) for t in unique_tokens]
+    return [unique_sets[c] for c in codes]
+
+def readDataFrame(df, set_delim='**'):
+    """
+    Read in our data from a pandas DataFrame as an in-memory database.
+    Returns a record_store.RecordStore: a read-only dictionary of
+    records, where the key is a unique record ID (the df index) and each
+    value is a view of the row fields that behaves like a
+    [frozendict](http://code.activestate.com/recipes/414283-frozen-dictionaries/)
+    (hashable dictionary). The fields are held column-wise, not as one
+    dictionary per record.
+
+    Remap columns for the following cases:
+    - Lat and Long are mapped into a single LatLong tuple
+    - Class and Coauthor are stored as delimited strings but mapped into sets
+
+    Works column-wise: distinct Name, Class and Coauthor values are
+    factorised and preprocessed once, and LatLong / patent_ct are
+    converted as whole arrays. Produces the same records as
+    readDataFrameIterrows.
+
+    **Currently, dedupe depends upon records' unique ids being integers
+    with no integers skipped. The smallest valued unique id must be 0 or
+    1. Expect this requirement will likely be relaxed in the future.**
+    """
+
+    name_codes, name_uniques = pd.factorize(df['Name'])
+    unique_names = [preProcessCached(n) if isinstance(n, str) else ''
+                    for n in name_uniques
+                    ]
+    unique_names.append('')
+    name_codes[name_codes < 0] = len(name_uniques)
+
+    class_codes, unique_classes = splitSetColumnTokens(df['Class'], set_delim)
+    coauthor_codes, unique_coauthors = splitSetColumnTokens(df['Coauthor'], set_delim)
+    lats = np.asarray(df['Lat'], dtype=object).astype(float)
+    lngs = np.asarray(df['Lng'], dtype=object).astype(float)
+    patent_cts = np.asarray(df['patent_ct']).astype(int)
+
+    return RecordStore.from_columns(df.index.values,
+                                    name_codes, unique_names,
+                                    lats, lngs,
+                                    class_codes, unique_classes,
+                                    coauthor_codes, unique_coauthors,
+                                    patent_cts
+                                    )
+
+def readDataFrameIterrows(df, set_delim='**'):
+    """
+    Row-by-row version of readDataFrame. Kept as the reference
+    implementation for benchmark_read_dataframe.py.
+    """
+
+    data_d = {}
+
+    for idx, dfrow in df.iterrows():
+        # print type(dfrow)
+        row_out = {}
+        classes = dfrow['Class'].split(set_delim)
+        coauthors = dfrow['Coauthor'].split(set_delim)
+        classes = [preProcess(c) if isinstance(c, str) else '' for c in classes]
+        coauthors = [preProcess(c) if isinstance(c, str) else '' for c in coauthors]
+        if isinstance(dfrow['Name'], str):
+            name = preProcess(dfrow['Name'])
+        else:
+            name = ''
+        row_out['Class'] = frozenset(classes)
+        row_out['Coauthor'] = frozenset(coauthors)
+        # row_out['Coauthor_Count'] = len(coauthors)
+        # row_out['Class_Count'] = len(classes)
+        row_out['LatLong'] = (float(dfrow['Lat']), float(dfrow['Lng']))
+        row_out['Name'] = name
+        row_out['patent_ct'] = int(dfrow['patent_ct'])
+        row_tuple = [(k, v) for (k, v) in row_out.items()]
+        data_d[idx] = dedupe.core.frozendict(row_tuple)
+            
+    return data_d
+
+def return_block_map(d, b):
+    """
+    For data d and a blocker b, return a
+    block:[record_id] map as a BlockIndex
+    """
+    block_map = BlockIndex.from_blocker(d, b)
+
+    print 'Blocking done'
+    compute_block_summary(block_map)
+    return block_map
+
+
+def compute_block_summary(block):
+    """
+    Given a block map as returned from return_block_map,
+    compute some summary statistics
+    """
+    block_count = len(block)
+    if isinstance(block, BlockIndex):
+        block_len = block.sizes
+    else:
+        block_len = [len(v) for k,v in block.iteritems()]
+    max_block_len = np.max(block_len)
+    median_block_len = np.median(block_len)
+    mean_block_len = np.mean(block_len)
+    print 'Number of blocks: %s' % block_count
+    print 'Maximum block length: %s' % max_block_len
+    print 'Median block length: %s' % median_block_len
+    print 'Mean block length %s' % mean_block_len
+    if isinstance(block, BlockIndex):
+        print 'Block index size: %0.1f MB' % (block.nbytes / 2.0 ** 20)
+    return 0
+
+
+# Secondary predicates used to split oversized blocks, in the order
+# they are applied. Each maps a record to a single sub-block key.
+def name_initials_key(record):
+    """
+    Initials of the name tokens, in sorted order
+    """
+    return ''.join(sorted(t[0] for t in record['Name'].split()))
+
+def latlong_grid_key(record, precision=1):
+    """
+    Lat / lng rounded to precision decimal places; records with no
+    location share the (0.0, 0.0) cell
+    """
+    lat, lng = record['LatLong']
+    return '%.*f,%.*f' % (precision, lat, precision, lng)
+
+def name_ngram_key(record, n=3):
+    """
+    First n characters of each name token, in sorted order
+    """
+    return ' '.join(sorted(t[:n] for t in record['Name'].split()))
+
+sub_block_predicates = [name_initials_key,
+                        latlong_grid_key,
+                        name_ngram_key
+                        ]
+
+def limit_block_pairs(block_map, d, max_block_pairs, max_total_pairs=None):
+    """
+    Splits blocks of block_map holding more than max_block_pairs record
+    pairs with sub_block_predicates, and caps the total number of pairs
+    at max_total_pairs. See block_index.split_oversized_blocks.
+    """
+    block_map = split_oversized_blocks(block_map,
+                                       d,
+                                       max_block_pairs,
+                                       sub_block_predicates,
+                                       max_total_pairs
+                                       )
+    compute_block_summary(block_map)
+    return block_map
+
+
+def return_threshold_data(block_map, d, n_pairs=100000):
+    """
+    Given a block map and a corresponding data object, return about
+    n_pairs candidate pairs for Dedupe.goodThreshold, sampled
+    stratified by block size (see BlockIndex.sample_pairs). Each pair
+    is returned as a block of two (record_id, record) tuples, so
+    goodThreshold scores n_pairs pairs whatever the block sizes.
+    """
+    if not isinstance(block_map, BlockIndex):
+        block_map = BlockIndex.from_blocks(block_map.values(), block_map.keys())
+    id1, id2 = block_map.sample_pairs(n_pairs)
+    return tuple(((i, d[i]), (j, d[j])) for i, j in zip(id1.tolist(), id2.tolist()))
+
+
+def candidates_gen(block_map, block_keys, d, block_comparators=()) :
+    """
+    Builds a record generator by block ID for deduping.
+    block_map: the output from return_block_map
+    block_keys: the block IDs to be returned in the generator; useful for subsetting blocks
+    d: the data dict as used by dedupe, with keys as record IDs
+    block_comparators: comparators to load each block into before it is
+    yielded (see sparse_cosine.block_comparators)
+    """
+    start_time = time.time()
+    for i, block_key in enumerate(block_keys):
+        if i % 1000 == 0 :
+            print i, "blocks"
+            print time.time() - start_time, "seconds"
+            if i > 0:
+                print (time.time() - start_time) / i, "seconds per block"
+            
+        block_ids = block_map[block_key]
+        for comparator in block_comparators:
+            comparator.load_block(block_ids)
+        if isinstance(block_ids, np.ndarray):
+            block_ids = block_ids.tolist()
+        yield ((id, d[id]) for id in block_ids)
+
+
+# Set in the parent before the pool is created, so that the workers
+# inherit the learned model, the data and the candidate pairs through
+# fork rather than receiving a copy with every shard
+_score_state = {}
+
+def _score_shard(bounds):
+    """
+    Scores the candidate pairs start:end of _score_state with
+    pair_scores.score_record_pairs
+    """
+    start, end = bounds
+    return pair_scores.score_record_pairs(_score_state['deduper'],
+                                          _score_state['data'],
+                                          _score_state['id1'][start:end],
+                                          _score_state['id2'][start:end]
+                                          )
+
+def _serial_clusters(deduper, d, id_blocks, threshold, dict_blocks):
+    """
+    Runs deduper.duplicateClusters over id_blocks, given as lists of
+    record ids. Returns the clusters as sorted tuples of record ids.
+    """
+    id_blocks = [ids.tolist() if isinstance(ids, np.ndarray) else ids
+                 for ids in id_blocks
+                 if len(ids) > 1
+                 ]
+    if dict_blocks:
+        blocks = tuple(dict((i, d[i]) for i in ids) for ids in id_blocks)
+    else:
+        blocks = candidates_gen(id_blocks,
+                                xrange(len(id_blocks)),
+                                d,
+                                sparse_cosine.block_comparators(deduper)
+                                )
+    clusters = deduper.duplicateClusters(blocks, threshold)
+    return sorted(tuple(sorted(c)) for c in clusters)
+
+def merge_clusters(shard_clusters):
+    """
+    Merges per-shard clusters that share records, with a union-find
+    over record ids, so overlapping clusters are joined into one.
+    Returns the clusters as tuples of sorted record ids, ordered by
+    their smallest record id, so the result does not depend on the
+    order shards finished in.
+    """
+    parent = {}
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for clusters in shard_clusters:
+        for cluster in clusters:
+            for i in cluster:
+                parent.setdefault(i, i)
+            root = find(cluster[0])
+            for i in cluster[1:]:
+                other = find(i)
+                if other != root:
+                    if other < root:
+                        root, other = other, root
+                    parent[other] = root
+
+    members = collections.defaultdict(list)
+    for i in parent:
+        members[find(i)].append(i)
+    return sorted(tuple(sorted(m)) for m in members.values())
+
+def cluster_differences(clusters_1, clusters_2):
+    """
+    Number of records whose cluster is not the same in two clusterings,
+    each a list of tuples of record ids
+    """
+    cluster_of_1 = dict((i, tuple(sorted(c))) for c in clusters_1 for i in c)
+    cluster_of_2 = dict((i, tuple(sorted(c))) for c in clusters_2 for i in c)
+    return sum(1 for i in set(cluster_of_1) | set(cluster_of_2)
+               if cluster_of_1.get(i) != cluster_of_2.get(i)
+               )
+
+def parallelDuplicateClusters(deduper, d, id_blocks, threshold,
+                              processes=None, shards_per_process=4,
+                              method='hierarchical', max_cluster_size=None,
+                              dict_blocks=False, check_parity=False):
+    """
+    Parallel version of deduper.duplicateClusters. The distinct record
+    pairs compared in id_blocks, a list of lists of record ids into d,
+    are split into shards of equal pair count and scored on a pool of
+    processes with pair_scores.score_record_pairs. A pair found in
+    several blocks is scored once. The scores are then clustered once,
+    in this process, with pair_scores.cluster_pair_scores (method and
+    max_cluster_size as there), so every pair of a record is clustered
+    together, as in a serial run. The deduper, d and the pairs are
+    shared with the workers once, through fork.
+
+    With check_parity, the blocks are also clustered serially with
+    deduper.duplicateClusters and the number of records whose cluster
+    differs is printed (dict_blocks as for that run: set it if deduper
+    expects each block as a record_id:record dict, as returned by
+    dedupe.blockData).
+
+    Falls back to scoring the shards in this process if called from a
+    daemonic process (e.g. a run_dedupe_countries.py worker), which
+    cannot start a pool of its own.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    in_daemon = multiprocessing.current_process().daemon
+    if in_daemon:
+        processes = 1
+    id1, id2 = pair_scores.candidate_pairs(id_blocks, xrange(len(id_blocks)))
+    n_shards = max(min(processes * shards_per_process, len(id1)), 1)
+    bounds = np.linspace(0, len(id1), n_shards + 1).astype(np.int64).tolist()
+    shards = zip(bounds[:-1], bounds[1:])
+    print 'Scoring %s pairs from %s blocks in %s shards on %s processes' % (len(id1),
+                                                                            len(id_blocks),
+                                                                            len(shards),
+                                                                            processes
+                                                                            )
+    _score_state.update({'deduper': deduper,
+                         'data': d,
+                         'id1': id1,
+                         'id2': id2
+                         })
+    start_time = time.time()
+    try:
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                shard_scores = pool.map(_score_shard, shards, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            shard_scores = [_score_shard(s) for s in shards]
+    finally:
+        _score_state.clear()
+    scores = np.concatenate(shard_scores) if shard_scores else np.zeros(0, dtype=np.float32)
+    print 'Scored pairs in %s seconds' % (time.time() - start_time)
+    clustered_dupes = pair_scores.cluster_pair_scores(id1, id2, scores, threshold,
+                                                      method, max_cluster_size
+                                                      )
+    if check_parity:
+        serial = _serial_clusters(deduper, d, id_blocks, threshold, dict_blocks)
+        print 'Parallel and serial clusters differ for %s records' % \
+            cluster_differences(clustered_dupes, serial)
+    return clustered_dupes
+
+def cluster_index(df_index, clustered_dupes, index_map=None, start=0):
+    """
+    Maps each entry of df_index to a sequential cluster id, starting at
+    start. Records in the same cluster of clustered_dupes share an id;
+    every other distinct df_index value gets an id of its own. Ids are
+    assigned in order of first appearance in df_index.
+
+    If index_map (a dict or Series) is given, cluster members are record
+    ids to be mapped through it to df_index values (as in the twostage
+    rounds). If a record appears in several clusters, the last one wins.
+
+    Returns an integer array aligned with df_index.
+    """
+    codes, uniques = pd.factorize(np.asarray(df_index))
+    uniques = pd.Index(uniques)
+
+    sizes = np.array([len(c) for c in clustered_dupes], dtype=np.int64)
+    n_clusters = len(sizes)
+    members = np.array([m for c in clustered_dupes for m in c])
+    if index_map is not None and len(members) > 0:
+        members = pd.Series(index_map).reindex(members).values
+    cluster_ids = np.repeat(np.arange(n_clusters), sizes)
+
+    # Cluster of each distinct df_index value; the others get fresh ids
+    # past the cluster ids. A final slot covers missing index values.
+    keys = n_clusters + np.arange(len(uniques) + 1)
+    positions = uniques.get_indexer(members) if len(members) > 0 else np.zeros(0, dtype=np.int64)
+    found = positions >= 0
+    last, first_of_reversed = np.unique(positions[found][::-1], return_index=True)
+    keys[last] = cluster_ids[found][::-1][first_of_reversed]
+
+    labels, label_uniques = pd.factorize(keys[codes])
+    return labels + start
+
+
+# Consolidate functions
+# These are used for the two-stage disambiguation process
+# Each takes a pandas Series object and returns a scalar 
+def consolidate_unique(x):
+    """
+    Returns the first value in the series
+    """
+    return x.values[0]
+
+def consolidate_geo(x):
+    """
+    For x as a lat or long series, returns the
+    most frequent non-zero value
+    """
+    geo_counts = {}
+    for g in x.values:
+        g = float(g)
+        if g != 0.0:
+            if g in geo_counts:
+                geo_counts[g] += 1
+            else:
+                geo_counts[g] = 1
+    if len(geo_counts) > 0:
+        sorted_geo = sorted(geo_counts.iteritems(),
+                            key=operator.itemgetter(1),
+                            reverse=True
+                            )
+        return sorted_geo[0][0]
+    else:
+        return 0.0
+
+def consolidate_set(x, delim='**', maxlen=100):
+    """
+    Consolidates all multi-valued strings in x
+    into a unique set of maximum length maxlen.
+
+    Returns a multivalued string separated by delim
+    """
+    vals = [v.split(delim) for v in x.values if isinstance(v, str)]
+    val_set = [v for vset in vals for v in vset]
+    val_set = list(set(val_set))
+    if len(val_set) > 0:
+        if len(val_set) > maxlen:
+            rand_idx = random.sample(range(len(val_set)), maxlen)
+            val_set = [val_set[idx] for idx in rand_idx]
+        out = delim.join(val_set)
+    else:
+        out = ''
+    return out
+
+def consolidate(df, key, agg_dict):
+    """
+    Aggregates a pandas dataframe into a set of unique rows specified by
+    the key. Aggregation method should be specified by column in agg_dict,
+    which takes a column_name:function format.
+
+    Used in the _twostage method to consolidate the data based on the
+    unique record IDs assigned from the first stage of disambiguation
+    """
+    grouped = df.groupby(key)
+    records = grouped.agg(agg_dict)
+    return records
+
+def blockingSettingsWrapper(ppc, uncovered_dupes, dedupe_instance, maxtries=10, data_d=None,
+                            data_sample=None):
+    """
+    Wrapper around the dedupe blocker to tun the ppc / uncovered values in case
+    no valid blocking can be found. Assumes that the ppc is set too tightly, or the uncovered_dupes
+    too broadly, for effect.
+
+    The first attempt is dedupe's own blockingFunction. If it finds no
+    rules and the deduper is learning them from training pairs, the
+    predicates' coverage of the training pairs (and of semi-supervised
+    non-duplicates from data_sample) is computed once, and each retry
+    only solves for its ppc / uncovered values (see blocking_cache.py).
+    A warning is logged when a retry produces the rules, since that
+    cover is not dedupe's own. The rules in use are reported on every
+    run, with their estimated number of comparisons over data_d if it
+    is given (see blocking_cache.report_predicates).
+    """
+    learning = not getattr(dedupe_instance, 'predicates', None) and \
+               bool(getattr(dedupe_instance, 'training_pairs', None))
+    coverage = None
+    blockerError = True
+    try_count = 0
+    while blockerError:
+        if try_count > maxtries or uncovered_dupes < 1 or ppc > 0.5:
+            blocker = None
+            break
+        try: 
+            if coverage is not None:
+                dedupe_instance.predicates = coverage.learn(ppc, uncovered_dupes)
+            blocker = dedupe_instance.blockingFunction(ppc, uncovered_dupes)
+            blockerError = False
+        except ValueError:
+            ppc += ppc / 2
+            uncovered_dupes -= 1
+            try_count += 1
+            if learning and coverage is None:
+                coverage = blocking_cache.PredicateCoverage(dedupe_instance, data_sample)
+
+    if blocker is not None:
+        if coverage is not None:
+            logging.warning('Blocking rules for ppc %s, uncovered_dupes %s were learned '
+                            'by blocking_cache on retry %s, not by dedupe\'s blockTraining; '
+                            'they have no TF-IDF predicates and may differ from dedupe\'s'
+                            % (ppc, uncovered_dupes, try_count))
+        predicates = getattr(dedupe_instance, 'predicates', None) or \
+                     getattr(blocker, 'predicates', None) or []
+        print 'Blocking predicates for ppc %s, uncovered_dupes %s:' % (ppc, uncovered_dupes)
+        blocking_cache.report_predicates(predicates, data_d, coverage)
+    return (blocker, ppc, uncovered_dupes)
+
+
+def subset_nth_quantile(g, n):
+    """
+    given a grouped object, returns the indices corresponding
+    to the largest n group sizes
+    """
+    g_size = g.size()
+    g_size.sort()
+    idx_out = g_size.index[-n:]
+    g_tot = np.sum(g_size)
+    g_sub = np.sum(g_size.ix[idx_out])
+    print 'ratio = %f' % (float(g_sub) / g_tot)
+    return idx_out
+
+def find_potential_matches(s1, s2, threshold):
+    """
+    Given comparable fields in two DataFrames, returns
+    the indices of df2 whose field is within threshold of the field
+    in df1
+
+    Uses a q-gram index over s2 (see name_index.py) rather than
+    comparing every pair of names.
+    """
+    start_time = time.time()
+    index = NameIndex(s2)
+    print 'Built name index in %f seconds' % np.round(time.time() - start_time, 3)
+    df2_idx = index.query_batch(s1.drop_duplicates(), threshold)
+    iter_time = time.time() - start_time
+    print '%s potential matches' % len(df2_idx)
+    print 'Computed inventor matches in %f seconds' % np.round(iter_time, 3)
+    return df2_idx
@@ -14,27 +14,40 @@ readDataFrame in the patent_util.py file.
 The output will be a CSV with our clustered results.
 
 Input files are assumed to be of the form dedupe_input_<country_code>.csv
-Output files are written to patstat_output_<date>_<country_code>.csv
+Output files are written to patstat_output_<date>_<country_code>.csv,
+or to the file given with -o
 
 The script is invoked from the command line as:
 
-python patstat_dedupe.py <country_code> <input_dir> <output_dir>
+python patstat_dedupe.py [-p <processes>] [-s <sample_size>] [-l <labels_file>] [-o <output_file>] <country_code> <input_dir> <output_dir> <recall_weight>
+
+The training sample holds sample_size record pairs (default 100000),
+drawn as described in training_sample.py and cached in model_cache.
+
+With -l, a missing training file is built from the benchmark labels in
+labels_file (person_id and a --label-column column, hrm_l2_id by
+default; see label_training.py) and training runs without prompting.
 
 For details on how the dedupe algorithm works, see
 https://github.com/open-city/dedupe
 """
 
 import AsciiDammit
+from block_index import BlockIndex
 import collections
 import csv
 import datetime
+import label_training
 import logging
 import math
+import model_cache
 import numpy as np
 import optparse
 import os
 import pandas as pd
 import patent_util
+import sparse_cosine
+import training_sample
 import re
 import sys
 import time
@@ -63,6 +76,24 @@ optp = optparse.OptionParser()
 optp.add_option('-v', '--verbose', dest='verbose', action='count',
                 help='Increase verbosity (specify multiple times for more)'
                 )
+optp.add_option('-p', '--processes', dest='processes', type='int', default=1,
+                help='Number of processes used to score the blocked pairs'
+                )
+optp.add_option('--check-parity', dest='check_parity', action='store_true', default=False,
+                help='With -p, also cluster serially and compare the clusters'
+                )
+optp.add_option('-s', '--sample-size', dest='sample_size', type='int', default=100000,
+                help='Number of record pairs in the training sample'
+                )
+optp.add_option('-l', '--labels', dest='label_file', default=None,
+                help='Benchmark labels to build the training file from'
+                )
+optp.add_option('--label-column', dest='label_column', default='hrm_l2_id',
+                help='Label column of the labels file'
+                )
+optp.add_option('-o', '--output-file', dest='output_file', default=None,
+                help='Output file, instead of a dated file in output_dir'
+                )
 (opts, args) = optp.parse_args()
 log_level = logging.WARNING 
 if opts.verbose == 1:
@@ -80,7 +111,7 @@ logging.basicConfig(level=log_level)
 # 4. The precision-recall weight; larger numbers put greater weight on recall; values
 #    usually range from 0.75-3
 
-inputs = [i for idx, i in enumerate(sys.argv) if idx > 0]
+inputs = args
 country = inputs[0]
 input_file_dir = inputs[1]
 output_file_dir = inputs[2]
@@ -91,12 +122,12 @@ recall_weight = float(inputs[3])
 this_date = datetime.datetime.now().strftime('%Y-%m-%d')
 input_file = input_file_dir + '/' + 'dedupe_input_' + country + '.csv'
 output_file = output_file_dir + '/' + 'patstat_output_' + this_date + '_' + country + '.csv'
-settings_file = 'patstat_settings_' + this_date + '_' + country + '.json'
-training_file = 'patstat_training_' + this_date + '_' + country + '.json'
+if opts.output_file:
+    output_file = opts.output_file
+training_file = 'patstat_training_' + country + '.json'
 
 print input_file
 print output_file
-print settings_file
 print training_file
 print recall_weight
 
@@ -117,29 +148,49 @@ input_df.Name.fillna('', inplace=True)
 data_d = patent_util.readDataFrame(input_df)
 
 # Build the comparators for class and coauthor
-coauthors = [row['Coauthor'] for cidx, row in data_d.items()]
-classes = [row['Class'] for cidx, row in data_d.items()]
-class_comparator = dedupe.distance.cosine.CosineSimilarity(classes)
-coauthor_comparator = dedupe.distance.cosine.CosineSimilarity(coauthors)
+class_comparator = sparse_cosine.SparseCosine(data_d, 'Class')
+coauthor_comparator = sparse_cosine.SparseCosine(data_d, 'Coauthor')
+
+# Define the fields dedupe will pay attention to
+fields = {'Name': {'type': 'String', 'Has Missing':True},
+          'LatLong': {'type': 'LatLong', 'Has Missing':True},
+          'Class': {'type': 'Custom', 'comparator':class_comparator},
+          'Coauthor': {'type': 'Custom', 'comparator': coauthor_comparator},
+          'patent_ct':{'type': 'Custom', 'comparator': integer_diff},
+          'patent_ct_name': {'type': 'Interaction',
+                             'Interaction Fields': ['Name', 'patent_ct']
+                             }
+          }
+
+# Without a training file, label pairs from the benchmark ids
+if opts.label_file and not os.path.exists(training_file):
+    labels = label_training.read_labels(opts.label_file, opts.label_column)
+    label_training.label_training(input_df, data_d, labels, training_file)
+    del labels
+labelled = opts.label_file is not None and os.path.exists(training_file)
+
+# Learned settings are cached under a hash of the fields, the training
+# pairs, the input schema and the blocking constants, so any later run
+# with the same inputs reuses them
+run_settings = {'ppc': ppc, 'uncovered_dupes': dupes, 'sample_size': opts.sample_size}
+model_key = model_cache.model_key(country, fields, training_file, input_df, run_settings)
+settings_file, warm = model_cache.lookup('model_cache', country, model_key)
 
 # Training
-if os.path.exists(settings_file):
+data_sample = None
+if warm:
     print 'reading from', settings_file
     deduper = dedupe.Dedupe(settings_file)
+    sparse_cosine.attach_comparators(deduper, data_d)
 
 else:
-    # To train dedupe, we feed it a random sample of records.
-    data_sample = dedupe.dataSample(data_d, 10 * input_df.shape[0])
-    # Define the fields dedupe will pay attention to
-    fields = {'Name': {'type': 'String', 'Has Missing':True},
-              'LatLong': {'type': 'LatLong', 'Has Missing':True},
-              'Class': {'type': 'Custom', 'comparator':class_comparator},
-              'Coauthor': {'type': 'Custom', 'comparator': coauthor_comparator},
-              'patent_ct':{'type': 'Custom', 'comparator': integer_diff},
-              'patent_ct_name': {'type': 'Interaction',
-                                 'Interaction Fields': ['Name', 'patent_ct']
-                                 }
-              }
+    # To train dedupe, we feed it a sample of record pairs, mostly from
+    # within cheap blocking keys
+    data_sample = training_sample.training_sample(data_d,
+                                                  opts.sample_size,
+                                                  patent_util.sub_block_predicates,
+                                                  'model_cache/training_sample_' + country + '.npz'
+                                                  )
 
     # Create a new deduper object and pass our data model to it.
     deduper = dedupe.Dedupe(fields)
@@ -163,11 +214,15 @@ else:
 
     # use 'y', 'n' and 'u' keys to flag duplicates
     # press 'f' when you are finished
-    print 'starting active labeling...'
-    deduper.train(data_sample, dedupe.training.consoleLabel)
+    if not labelled:
+        print 'starting active labeling...'
+        deduper.train(data_sample, dedupe.training.consoleLabel)
 
-    # When finished, save our training away to disk
-    deduper.writeTraining(training_file)
+        # When finished, save our training away to disk, and cache the
+        # settings under the key for the new labels
+        deduper.writeTraining(training_file)
+        model_key = model_cache.model_key(country, fields, training_file, input_df, run_settings)
+        settings_file = model_cache.settings_file('model_cache', country, model_key)
 
 # Blocking
 deduper.blocker_types.update({'Custom': (dedupe.predicates.wholeSetPredicate,
@@ -181,7 +236,9 @@ print 'blocking...'
 # Initialize the blocker
 blocker, ppc_final, ucd_final = patent_util.blockingSettingsWrapper(ppc,
                                                                     dupes,
-                                                                    deduper
+                                                                    deduper,
+                                                                    data_d=data_d,
+                                                                    data_sample=data_sample
                                                                     )
 
 # Occassionally the blocker fails to find useful values. If so,
@@ -231,10 +288,12 @@ deduper.writeSettings(settings_file)
 # Find the threshold that will maximize a weighted average of our precision and recall. 
 # When we set the recall weight to 1, we are trying to balance recall and precision
 #
-# If we had more data, we would not pass in all the blocked data into
-# this function but a representative sample.
+# Rather than all the blocked data, goodThreshold scores a sample of
+# candidate pairs, stratified by block size.
 
-threshold_data = patent_util.return_threshold_data(blocked_data, 10000)
+threshold_data = patent_util.return_threshold_data(BlockIndex.from_blocks([block.keys() for block in blocked_data]),
+                                                   data_d
+                                                   )
 
 print 'Computing threshold'
 threshold = deduper.goodThreshold(threshold_data, recall_weight=recall_weight)
@@ -248,45 +307,30 @@ del threshold_data
 print 'clustering...'
 # Loop over each block separately and dedupe
 
-clustered_dupes = deduper.duplicateClusters(blocked_data,
-                                            threshold
-                                            ) 
+if opts.processes > 1:
+    clustered_dupes = patent_util.parallelDuplicateClusters(deduper,
+                                                            data_d,
+                                                            [block.keys() for block in blocked_data],
+                                                            threshold,
+                                                            opts.processes,
+                                                            dict_blocks=True,
+                                                            check_parity=opts.check_parity
+                                                            )
+else:
+    clustered_dupes = deduper.duplicateClusters(blocked_data,
+                                                threshold
+                                                )
 
 print '# duplicate sets', len(clustered_dupes)
 
-# Extract the new cluster membership
-max_cluster_id = 0
-cluster_membership = collections.defaultdict(lambda : 'x')
-for (cluster_id, cluster) in enumerate(clustered_dupes):
-    for record_id in cluster:
-        cluster_membership[record_id] = cluster_id
-        if max_cluster_id <= cluster_id:
-            max_cluster_id  = cluster_id + 1
-
-# Then write it into the data frame as a sequential index for later use
-# Here the cluster ID is either the dedupe ID (if a PATSTAT person belonged
-# to a block of 2 or more potential matches) or an integer ID placeholder.
-
-cluster_index = []
-clustered_cluster_map = {}
-excluded_cluster_map = {}
-for df_idx in input_df.index:
-    if df_idx in cluster_membership:
-        orig_cluster = cluster_membership[df_idx]
-        if orig_cluster in clustered_cluster_map:
-            cluster_index.append(clustered_cluster_map[orig_cluster])
-        else:
-            clustered_cluster_map[orig_cluster] = max_cluster_id
-            cluster_index.append(max_cluster_id) #cluster_counter)
-            max_cluster_id += 1
-            # print cluster_counter
-    else:
-        if df_idx in excluded_cluster_map:
-            cluster_index.append(excluded_cluster_map[df_idx])
-        else:
-            excluded_cluster_map[df_idx] = max_cluster_id
-            cluster_index.append(max_cluster_id)
-            max_cluster_id += 1
+# Write the cluster membership into the data frame as a sequential index
+# for later use. Here the cluster ID is either the dedupe ID (if a PATSTAT
+# person belonged to a block of 2 or more potential matches) or an integer
+# ID placeholder.
+cluster_index = patent_util.cluster_index(input_df.index,
+                                          clustered_dupes,
+                                          start=len(clustered_dupes)
+                                          )
 
 cluster_name = 'cluster_id'
 input_df[cluster_name] = cluster_index
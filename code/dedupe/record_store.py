@@ -0,0 +1,340 @@
+## record_store.py
+## Column-wise in-memory database of person records
+
+import array
+import collections
+import numpy as np
+import sys
+
+import dedupe
+
+"""
+readDataFrame used to build one dedupe.core.frozendict per record, with
+two frozensets, a tuple and three more Python objects behind it; across
+millions of persons that is several hundred bytes per record, paid again
+in every round. RecordStore keeps the same data in a few arrays:
+
+- Name: an object array of the preprocessed names, each distinct name
+  stored once
+- LatLong: two float64 arrays
+- Class, Coauthor: the distinct sets in compressed sparse row form (token
+  ids of set k in tokens[offsets[k]:offsets[k + 1]], over a vocabulary
+  of distinct tokens), plus one int32 set code per record
+- patent_ct: an int64 array
+
+store[record_id] returns a RecordView, a two-slot object that reads its
+fields from the arrays when they are asked for. Views compare and hash
+like the frozendicts they replace, and pickle as frozendicts.
+"""
+
+fields = ('Class', 'Coauthor', 'LatLong', 'Name', 'patent_ct')
+field_positions = dict((f, i) for i, f in enumerate(fields))
+
+class TokenSet(frozenset):
+    """
+    frozenset that also carries its set code in the TokenSets it was
+    read from, so comparators can look up values precomputed per set
+    (see sparse_cosine.py)
+    """
+    __slots__ = ('code', 'owner')
+
+    def __reduce__(self):
+        # Pickle as a plain frozenset, not with the owner's arrays
+        return (frozenset, (list(self),))
+
+def token_set(tokens, code, owner):
+    s = TokenSet(tokens)
+    s.code = code
+    s.owner = owner
+    return s
+
+class TokenSets(object):
+    """
+    Distinct token sets in compressed sparse row form, with one set code
+    per record. The frozensets built for the most recently read sets are
+    kept, up to cache_size of them, since the records of a block are
+    read once for every pair they are in.
+    """
+
+    def __init__(self, codes, token_lists, cache_size=100000):
+        vocab_positions = {}
+        vocab = []
+        tokens = array.array('i')
+        lengths = np.zeros(len(token_lists), dtype=np.int64)
+        for k, token_list in enumerate(token_lists):
+            token_list = set(token_list)
+            lengths[k] = len(token_list)
+            for t in token_list:
+                code = vocab_positions.get(t)
+                if code is None:
+                    code = len(vocab)
+                    vocab_positions[t] = code
+                    vocab.append(t)
+                tokens.append(code)
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.tokens = np.frombuffer(tokens, dtype=np.int32).copy()
+        self.vocab = vocab
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def get(self, pos):
+        k = int(self.codes[pos])
+        try:
+            return self.cache[k]
+        except KeyError:
+            pass
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        s = self.cache[k] = token_set([self.vocab[t] for t in
+                                       self.tokens[self.offsets[k]:self.offsets[k + 1]].tolist()
+                                       ], k, self)
+        return s
+
+    def column(self):
+        """
+        The set of every record, as a list; records with the same set
+        share one frozenset
+        """
+        sets = [token_set([self.vocab[t] for t in
+                           self.tokens[self.offsets[k]:self.offsets[k + 1]].tolist()
+                           ], k, self)
+                for k in xrange(len(self.offsets) - 1)
+                ]
+        return [sets[k] for k in self.codes.tolist()]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.offsets.nbytes + self.tokens.nbytes + \
+               sum(sys.getsizeof(t) for t in self.vocab)
+
+class RecordView(object):
+    """
+    Read-only mapping of field name to value for one record of a
+    RecordStore. The record's fields are read from the store on first
+    access and kept for the life of the view.
+    """
+    __slots__ = ('store', 'pos', 'row')
+
+    def __init__(self, store, pos):
+        self.store = store
+        self.pos = pos
+
+    def __getitem__(self, field):
+        try:
+            row = self.row
+        except AttributeError:
+            row = self.row = self.store.row(self.pos)
+        return row[field_positions[field]]
+
+    def __len__(self):
+        return len(fields)
+
+    def __iter__(self):
+        return iter(fields)
+
+    def __contains__(self, field):
+        return field in field_positions
+
+    def keys(self):
+        return list(fields)
+
+    def iterkeys(self):
+        return iter(fields)
+
+    def values(self):
+        return [self[f] for f in fields]
+
+    def items(self):
+        return [(f, self[f]) for f in fields]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def get(self, field, default=None):
+        if field in field_positions:
+            return self[field]
+        return default
+
+    def frozen(self):
+        """
+        The record as a dedupe.core.frozendict
+        """
+        return dedupe.core.frozendict(self.items())
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __reduce__(self):
+        return (dedupe.core.frozendict, (self.items(),))
+
+    def __repr__(self):
+        return 'RecordView(%r)' % dict(self.items())
+
+collections.Mapping.register(RecordView)
+
+class RecordStore(object):
+    """
+    Read-only record_id: record mapping over column arrays; see the
+    module docstring. Record ids are the integer index labels of the
+    data frame the store was built from.
+    """
+
+    def __init__(self, ids, names, lats, lngs, classes, coauthors, patent_cts):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = names
+        self.lats = lats
+        self.lngs = lngs
+        self.classes = classes
+        self.coauthors = coauthors
+        self.patent_cts = patent_cts
+
+        # Record ids are usually 0..n-1, so positions are an offset
+        # from the first id; otherwise look them up in the sorted ids
+        n = len(self.ids)
+        self.start = self.ids[0] if n > 0 else 0
+        self.contiguous = n == 0 or (self.ids == self.start + np.arange(n)).all()
+        if not self.contiguous:
+            self.order = np.argsort(self.ids, kind='mergesort')
+            self.sorted_ids = self.ids[self.order]
+
+
+    @classmethod
+    def from_columns(cls, ids, name_codes, unique_names, lats, lngs,
+                     class_codes, unique_classes, coauthor_codes, unique_coauthors,
+                     patent_cts):
+        """
+        Builds the store from factorised columns: for Name, Class and
+        Coauthor, the code of each record's value in the list of
+        distinct (preprocessed) values; for Class and Coauthor, the
+        distinct values are lists of tokens.
+        """
+        unique_names = np.array([intern(n) if type(n) is str else n for n in unique_names],
+                                dtype=object
+                                )
+        return cls(ids,
+                   unique_names[np.asarray(name_codes)],
+                   np.asarray(lats, dtype=np.float64),
+                   np.asarray(lngs, dtype=np.float64),
+                   TokenSets(class_codes, unique_classes),
+                   TokenSets(coauthor_codes, unique_coauthors),
+                   np.asarray(patent_cts, dtype=np.int64)
+                   )
+
+    def row(self, pos):
+        """
+        The field values of the record at pos, in the order of fields
+        """
+        return (self.classes.get(pos),
+                self.coauthors.get(pos),
+                (float(self.lats[pos]), float(self.lngs[pos])),
+                self.names[pos],
+                int(self.patent_cts[pos])
+                )
+
+    def position(self, record_id):
+        """
+        Position of record_id in the arrays; KeyError if it is not stored
+        """
+        if self.contiguous:
+            pos = record_id - self.start
+            if 0 <= pos < len(self.ids):
+                return int(pos)
+        else:
+            i = np.searchsorted(self.sorted_ids, record_id)
+            if i < len(self.sorted_ids) and self.sorted_ids[i] == record_id:
+                return int(self.order[i])
+        raise KeyError(record_id)
+
+    def positions(self, record_ids):
+        """
+        Positions of an array of stored record ids
+        """
+        record_ids = np.asarray(record_ids, dtype=np.int64)
+        if self.contiguous:
+            return record_ids - self.start
+        return self.order[np.searchsorted(self.sorted_ids, record_ids)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __contains__(self, record_id):
+        try:
+            self.position(record_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __getitem__(self, record_id):
+        return RecordView(self, self.position(record_id))
+
+    def get(self, record_id, default=None):
+        if record_id in self:
+            return self[record_id]
+        return default
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def iterkeys(self):
+        return iter(self)
+
+    def values(self):
+        return [RecordView(self, pos) for pos in xrange(len(self.ids))]
+
+    def items(self):
+        return zip(self.ids.tolist(), self.values())
+
+    def iteritems(self):
+        for pos, record_id in enumerate(self.ids.tolist()):
+            yield record_id, RecordView(self, pos)
+
+    def column(self, field):
+        """
+        The values of field for every record, in store order
+        """
+        if field == 'Class':
+            return self.classes.column()
+        if field == 'Coauthor':
+            return self.coauthors.column()
+        i = field_positions[field]
+        return [self.row(pos)[i] for pos in xrange(len(self.ids))]
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory held by the store, including the distinct
+        name and token strings
+        """
+        distinct_names = dict((id(n), n) for n in self.names)
+        return self.ids.nbytes + self.names.nbytes + \
+               sum(sys.getsizeof(n) for n in distinct_names.itervalues()) + \
+               self.lats.nbytes + self.lngs.nbytes + self.patent_cts.nbytes + \
+               self.classes.nbytes + self.coauthors.nbytes
+
+def freeze(records):
+    """
+    Replaces the RecordViews in a nested tuple / list of records (such
+    as the output of dedupe.dataSample) with frozendicts, so that they
+    can be written out with the training pairs
+    """
+    if isinstance(records, RecordView):
+        return records.frozen()
+    if isinstance(records, (tuple, list)):
+        return tuple(freeze(r) for r in records)
+    return records
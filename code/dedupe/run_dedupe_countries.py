@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""
+Runs dedupe_engine for several countries at once in a process pool.
+
+Countries are submitted largest input file first, so the long-running
+countries start early and the small ones fill in the remaining cores.
+dedupe, the comparators and patent_util are imported once in the parent
+process and shared with the workers through fork. Each worker reuses
+patent_util's preprocessing cache across the countries it processes.
+
+Workers cannot prompt for training labels, so with more than one
+process every country needs a saved settings or training file; countries
+without one are reported and skipped. With -l, training files are built
+from benchmark labels instead (see label_training.py), and the countries
+the labels cover train without prompting.
+
+The script is invoked from the command line as:
+
+python run_dedupe_countries.py [options] <path_to_root_psClean_directory> [<country> ...]
+
+Options:
+-p, --processes  number of countries to run at once (default 1)
+-c, --config     engine configuration file (default dedupe_config.json)
+-l, --labels     labels file (person_id and a label column, e.g. Leuven or
+                 HAN) for the countries without a training file
+--label-column   label column of the labels file (default hrm_l2_id)
+
+If no countries are given, all countries in the configuration file are
+run. It assumes the following:
+- Dedupe inputs are in psClean/data/dedupe_input
+- Dedupe output should go to psClean/data/dedupe_script_output
+"""
+
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+import dedupe_engine
+
+
+def run_country_star(args):
+    """
+    Pool.imap_unordered wrapper for dedupe_engine.run_country. Catches
+    errors so that one failed country does not stop the others.
+    """
+    country = args[0]
+    try:
+        return dedupe_engine.run_country(*args)
+    except Exception, e:
+        print 'Dedupe of %s failed: %r' % (country, e)
+        return {'country': country, 'status': 'failed: %r' % e}
+
+
+if __name__ == '__main__':
+    optp = optparse.OptionParser()
+    optp.add_option('-p', '--processes', dest='processes', type='int', default=1)
+    optp.add_option('-c', '--config', dest='config',
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         'dedupe_config.json'
+                                         )
+                    )
+    optp.add_option('-l', '--labels', dest='label_file', default=None)
+    optp.add_option('--label-column', dest='label_column', default=None)
+    (opts, args) = optp.parse_args()
+
+    rootdir = args[0]
+    input_file_dir = rootdir + '/data/dedupe_input/person_records'
+    patent_file_dir = rootdir + '/data/dedupe_input/person_patent'
+    output_file_dir = rootdir + '/data/dedupe_script_output'
+
+    country_settings = dedupe_engine.load_config(opts.config)
+    countries = [c.lower() for c in args[1:]] or sorted(country_settings.keys())
+    for settings in country_settings.values():
+        if opts.label_file:
+            settings['label_file'] = opts.label_file
+        if opts.label_column:
+            settings['label_column'] = opts.label_column
+
+    # Largest inputs first
+    input_sizes = {}
+    for c in countries:
+        input_file = input_file_dir + '/' + 'dedupe_input_' + c + '.csv'
+        if os.path.exists(input_file):
+            input_sizes[c] = os.path.getsize(input_file)
+        else:
+            print 'No input file for %s, skipping' % c
+    ordered_countries = sorted(input_sizes, key=lambda c: input_sizes[c], reverse=True)
+
+    interactive = opts.processes == 1
+    tasks = [(c, country_settings[c], input_file_dir, patent_file_dir,
+              output_file_dir, '.', interactive)
+             for c in ordered_countries
+             ]
+
+    time_start = time.time()
+    if opts.processes == 1:
+        summaries = [run_country_star(t) for t in tasks]
+    else:
+        pool = multiprocessing.Pool(opts.processes)
+        summaries = list(pool.imap_unordered(run_country_star, tasks, chunksize=1))
+        pool.close()
+        pool.join()
+
+    print 'All countries complete, ran in %s seconds' % (time.time() - time_start)
+    for s in sorted(summaries, key=lambda s: s['country']):
+        print '%s: %s (model cache: %s)' % (s['country'],
+                                             s['status'],
+                                             ', '.join(s.get('model_cache', [])) or 'n/a'
+                                             )
+    if any(s['status'] != 'done' for s in summaries):
+        sys.exit(1)
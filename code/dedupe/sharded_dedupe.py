@@ -0,0 +1,340 @@
+#!/usr/bin/python
+"""
+Sharded disambiguation for countries too large to block and cluster in
+one dedupe process (DE, FR, GB).
+
+Records are partitioned on a coarse key, the first letter of the name
+plus a lat / lng grid cell. Records within margin degrees of a cell
+boundary are also placed in the neighbouring cells, so near matches
+across a boundary still meet in some shard. A cell with more than
+max_records located records is split on a grid of half the size, down
+to min_grid degrees.
+
+Records with no location (0.0, 0.0) are placed in at most nogeo_cells
+cells: those with the most located records of the same name, or failing
+that of the same first 6, then 3, characters of name. So they are still
+compared with the located records most likely to be the same person,
+and each is held in a bounded number of shards. A cell takes no-location
+records only up to max_records in all, best matches first. No-location
+records left without a cell are sharded by name prefix, with longer
+prefixes for prefixes over max_records.
+
+Keys are packed into shards of at most max_records records, and the
+shards are deduped in parallel processes with the learned settings,
+each holding only its own shard in memory. If a key cannot be brought
+under max_records (a cell still too large at min_grid), sharding stops
+with an error rather than run an unbounded shard.
+
+Clusters from different shards that share a boundary record are then
+joined with a union-find pass (patent_util.merge_clusters).
+
+The script is invoked from the command line as:
+
+python sharded_dedupe.py [options] <country> <input_file> <settings_file> <output_dir>
+
+Options:
+-p, --processes    number of shards deduped at once (default 1)
+-m, --max-records  maximum records per shard (default 200000)
+-g, --grid         grid cell size in degrees (default 1.0)
+--margin           overlap margin in degrees (default 0.1)
+--min-grid         smallest cell size oversized cells are split to (default 0.125)
+--nogeo-cells      most cells a no-location record is placed in (default 3)
+-t, --threshold    score threshold; by default it is chosen per shard
+                   with goodThreshold and the recall weight
+-w, --recall-weight  recall weight for goodThreshold (default 1.5)
+--ppc, --dupes     blocking parameters, as in patstat_dedupe.py
+
+The output is written to
+<output_dir>/patstat_output_<date>_sharded_<country>.csv
+"""
+
+import datetime
+import multiprocessing
+import numpy as np
+import optparse
+import pandas as pd
+import sys
+import time
+
+import dedupe_engine
+import patent_util
+import sparse_cosine
+
+import dedupe
+from dedupe.distance import cosine
+sys.modules['cosine'] = cosine
+
+def cell_entries(pos, initials, lats, lngs, grid, margin):
+    """
+    Returns aligned arrays (rows, keys): the rows pos and the key of
+    each grid cell of size grid they belong to. A record within margin
+    of a cell boundary appears once for each cell it is near.
+    """
+    cell_lat = np.floor(lats[pos] / grid).astype(np.int64)
+    cell_lng = np.floor(lngs[pos] / grid).astype(np.int64)
+    offset_lat = lats[pos] - cell_lat * grid
+    offset_lng = lngs[pos] - cell_lng * grid
+    lat_shifts = [(0, np.ones(len(pos), dtype=bool)),
+                  (-1, offset_lat < margin),
+                  (1, offset_lat > grid - margin)
+                  ]
+    lng_shifts = [(0, np.ones(len(pos), dtype=bool)),
+                  (-1, offset_lng < margin),
+                  (1, offset_lng > grid - margin)
+                  ]
+
+    rows = []
+    keys = []
+    for d_lat, lat_mask in lat_shifts:
+        for d_lng, lng_mask in lng_shifts:
+            mask = np.flatnonzero(lat_mask & lng_mask)
+            rows.append(pos[mask])
+            keys.extend('%s|%g|%d|%d' % (i, grid, a, b)
+                        for i, a, b in zip(initials[pos[mask]],
+                                           cell_lat[mask] + d_lat,
+                                           cell_lng[mask] + d_lng
+                                           )
+                        )
+    return np.concatenate(rows), np.array(keys, dtype=object)
+
+nogeo_name_keys = [lambda n: n, lambda n: n[:6], lambda n: n[:3]]
+
+def place_nogeo(nogeo_rows, rows, keys, names, n_cells, max_records):
+    """
+    Places the no-location records nogeo_rows in the cells (rows, keys)
+    of the located records, as described in the module docstring.
+    Returns aligned arrays (rows, keys) of the placements, and the
+    no-location rows left without a cell.
+    """
+    candidates = []
+    left = pd.Series(names[nogeo_rows], index=nogeo_rows)
+    for level, name_key in enumerate(nogeo_name_keys):
+        if len(left) == 0:
+            break
+        matches = pd.DataFrame({'key': keys,
+                                'match': [name_key(n) for n in names[rows]]
+                                }).groupby(['match', 'key']).size().reset_index(name='count')
+        wanted = pd.DataFrame({'row': left.index.values,
+                               'match': [name_key(n) for n in left.values]
+                               })
+        found = wanted.merge(matches, on='match')
+        found = found.sort_values(['row', 'count', 'key'], ascending=[True, False, True])
+        found = found[found.groupby('row').cumcount() < n_cells]
+        found['level'] = level
+        candidates.append(found)
+        left = left[~left.index.isin(found.row.values)]
+
+    if not candidates:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object), nogeo_rows
+    placed = pd.concat(candidates, ignore_index=True)
+    # Best matches first into the room each cell has left
+    room = max_records - pd.Series(keys).value_counts()
+    placed = placed.sort_values(['level', 'count', 'row'], ascending=[True, False, True])
+    placed = placed[placed.groupby('key').cumcount().values <
+                    room.reindex(placed.key.values).fillna(0).values]
+    unplaced = np.setdiff1d(nogeo_rows, placed.row.values)
+    return placed.row.values.astype(np.int64), placed.key.values.astype(object), unplaced
+
+def shard_keys(df, grid, margin, max_records=None, min_grid=0.125, nogeo_cells=3):
+    """
+    Returns aligned arrays (rows, keys): the positions of the records of
+    df and the key of each shard cell they belong to, as described in
+    the module docstring. Raises ValueError if a key is left with more
+    than max_records records.
+    """
+    names = df.Name.fillna('').values
+    initials = np.array([n[:1] for n in names], dtype=object)
+    lats = np.asarray(df.Lat, dtype=object).astype(float)
+    lngs = np.asarray(df.Lng, dtype=object).astype(float)
+    no_geo = (lats == 0) & (lngs == 0)
+    if max_records is None:
+        max_records = len(df)
+
+    rows, keys = cell_entries(np.flatnonzero(~no_geo), initials, lats, lngs, grid, margin)
+    while grid / 2 >= min_grid:
+        sizes = pd.Series(keys).value_counts()
+        oversized = sizes.index[sizes.values > max_records]
+        if len(oversized) == 0:
+            break
+        grid = grid / 2
+        split = pd.Series(keys).isin(oversized).values
+        new_rows, new_keys = cell_entries(np.unique(rows[split]), initials, lats, lngs,
+                                          grid, margin
+                                          )
+        print 'Split %s cells over %s records on a %g degree grid' % (len(oversized),
+                                                                     max_records,
+                                                                     grid
+                                                                     )
+        rows = np.concatenate([rows[~split], new_rows])
+        keys = np.concatenate([keys[~split], new_keys])
+
+    nogeo_rows, nogeo_keys, unplaced_rows = place_nogeo(np.flatnonzero(no_geo), rows, keys,
+                                                        names, nogeo_cells, max_records
+                                                        )
+    print '%s records without location placed in %s cells, %s sharded by name only' % (
+        len(np.unique(nogeo_rows)), len(np.unique(nogeo_keys)), len(unplaced_rows))
+
+    # The rest by name prefix, lengthened for prefixes over max_records
+    length = 3
+    unplaced_keys = np.array(['%s|nogeo' % n[:length] for n in names[unplaced_rows]],
+                             dtype=object
+                             )
+    while len(unplaced_rows) > 0 and length < 20:
+        counts = pd.Series(unplaced_keys).value_counts()
+        oversized = pd.Series(unplaced_keys).isin(counts.index[counts.values > max_records]).values
+        if not oversized.any():
+            break
+        length += 1
+        unplaced_keys[oversized] = ['%s|nogeo' % n[:length]
+                                    for n in names[unplaced_rows[oversized]]
+                                    ]
+
+    rows = np.concatenate([rows, nogeo_rows, unplaced_rows.astype(np.int64)])
+    keys = np.concatenate([keys, nogeo_keys, unplaced_keys])
+    sizes = pd.Series(keys).value_counts()
+    if len(sizes) > 0 and sizes.iloc[0] > max_records:
+        raise ValueError('Key %s has %s records, over the shard limit of %s; '
+                         'use a larger --max-records (or, for a cell, a smaller --min-grid)'
+                         % (sizes.index[0], sizes.iloc[0], max_records))
+    print '%s shard entries for %s records' % (len(rows), len(df))
+    return rows, keys
+
+def pack_shards(keys, max_records):
+    """
+    Packs the distinct keys, in sorted order, into shards of at most
+    max_records entries. Returns the shard id of each entry of keys;
+    raises ValueError if a key has more entries than max_records.
+    """
+    key_codes, unique_keys = pd.factorize(keys, sort=True)
+    counts = np.bincount(key_codes, minlength=len(unique_keys))
+    key_shard = np.zeros(len(unique_keys), dtype=np.int64)
+    shard = 0
+    shard_size = 0
+    for i, c in enumerate(counts):
+        if shard_size > 0 and shard_size + c > max_records:
+            shard += 1
+            shard_size = 0
+        key_shard[i] = shard
+        shard_size += c
+        if c > max_records:
+            raise ValueError('Key %s has %s records, over the shard limit of %s'
+                             % (unique_keys[i], c, max_records))
+    return key_shard[key_codes]
+
+# Set in the parent before the pool is created, so that the workers
+# inherit the input through fork and each task only carries row positions
+_shard_state = {}
+
+def dedupe_shard(args):
+    """
+    Dedupes the rows shard_rows of the input with the learned settings.
+    Returns the shard id and its clusters as tuples of sorted df index
+    labels.
+    """
+    shard_id, shard_rows, settings_file, ppc, dupes, threshold, recall_weight = args
+    time_start = time.time()
+    shard_df = _shard_state['input_df'].iloc[shard_rows]
+
+    # dedupe expects sequential integer record ids
+    labels = shard_df.index.values
+    shard_df = shard_df.reset_index(drop=True)
+    data_d = patent_util.readDataFrame(shard_df)
+
+    deduper = dedupe.Dedupe(settings_file)
+    sparse_cosine.attach_comparators(deduper, data_d)
+    deduper.blocker_types.update({'Custom': (dedupe.predicates.wholeSetPredicate,
+                                             dedupe.predicates.commonSetElementPredicate),
+                                  'LatLong' : (dedupe.predicates.latLongGridPredicate,)
+                                  }
+                                 )
+    blocker, ppc_final, ucd_final = patent_util.blockingSettingsWrapper(ppc, dupes, deduper)
+    if not blocker:
+        print 'Shard %s: no valid blocking settings found' % shard_id
+        return shard_id, []
+    blocker.tfIdfBlocks(data_d.iteritems())
+    blocking_map = patent_util.return_block_map(data_d, blocker)
+    keys_to_block = blocking_map.keys_with_size(2)
+    if len(keys_to_block) == 0:
+        return shard_id, []
+
+    if threshold is None:
+        threshold_data = patent_util.return_threshold_data(blocking_map, data_d)
+        threshold = deduper.goodThreshold(threshold_data, recall_weight=recall_weight)
+    clustered_dupes = deduper.duplicateClusters(patent_util.candidates_gen(blocking_map,
+                                                                           keys_to_block,
+                                                                           data_d,
+                                                                           sparse_cosine.block_comparators(deduper)
+                                                                           ),
+                                                threshold
+                                                )
+    clusters = [tuple(sorted(labels[list(c)].tolist())) for c in clustered_dupes]
+    print 'Shard %s: %s records, %s duplicate sets in %s seconds' % (shard_id,
+                                                                     len(labels),
+                                                                     len(clusters),
+                                                                     time.time() - time_start
+                                                                     )
+    return shard_id, clusters
+
+
+if __name__ == '__main__':
+    optp = optparse.OptionParser()
+    optp.add_option('-p', '--processes', dest='processes', type='int', default=1)
+    optp.add_option('-m', '--max-records', dest='max_records', type='int', default=200000)
+    optp.add_option('-g', '--grid', dest='grid', type='float', default=1.0)
+    optp.add_option('--margin', dest='margin', type='float', default=0.1)
+    optp.add_option('--min-grid', dest='min_grid', type='float', default=0.125)
+    optp.add_option('--nogeo-cells', dest='nogeo_cells', type='int', default=3)
+    optp.add_option('-t', '--threshold', dest='threshold', type='float', default=None)
+    optp.add_option('-w', '--recall-weight', dest='recall_weight', type='float', default=1.5)
+    optp.add_option('--ppc', dest='ppc', type='float', default=0.001)
+    optp.add_option('--dupes', dest='dupes', type='int', default=5)
+    (opts, args) = optp.parse_args()
+
+    country = args[0]
+    input_file = args[1]
+    settings_file = args[2]
+    output_dir = args[3]
+
+    this_date = datetime.datetime.now().strftime('%Y-%m-%d')
+    output_file = output_dir + '/' + 'patstat_output_' + this_date + '_sharded_' + country + '.csv'
+
+    time_start = time.time()
+    input_df = dedupe_engine.read_input(input_file)
+
+    rows, keys = shard_keys(input_df, opts.grid, opts.margin, opts.max_records,
+                            opts.min_grid, opts.nogeo_cells
+                            )
+    shard_ids = pack_shards(keys, opts.max_records)
+    n_shards = shard_ids.max() + 1 if len(shard_ids) > 0 else 0
+    print '%s records in %s shards, %s shard entries' % (input_df.shape[0],
+                                                         n_shards,
+                                                         len(rows)
+                                                         )
+
+    def shard_tasks():
+        order = np.argsort(shard_ids, kind='mergesort')
+        bounds = np.searchsorted(shard_ids[order], np.arange(n_shards + 1))
+        for s in xrange(n_shards):
+            shard_rows = np.unique(rows[order[bounds[s]:bounds[s + 1]]])
+            yield (s, shard_rows, settings_file, opts.ppc,
+                   opts.dupes, opts.threshold, opts.recall_weight)
+
+    _shard_state['input_df'] = input_df
+    if opts.processes > 1:
+        pool = multiprocessing.Pool(opts.processes, maxtasksperchild=1)
+        results = list(pool.imap_unordered(dedupe_shard, shard_tasks(), chunksize=1))
+        pool.close()
+        pool.join()
+    else:
+        results = [dedupe_shard(t) for t in shard_tasks()]
+
+    # Join clusters across shards through the records they share
+    results.sort()
+    shard_clusters = [clusters for shard_id, clusters in results]
+    n_shard_clusters = sum(len(c) for c in shard_clusters)
+    clustered_dupes = patent_util.merge_clusters(shard_clusters)
+    print '%s shard clusters merged into %s clusters' % (n_shard_clusters, len(clustered_dupes))
+
+    input_df['cluster_id'] = patent_util.cluster_index(input_df.index, clustered_dupes)
+    input_df.to_csv(output_file)
+    print 'Sharded dedupe complete, ran in %s seconds' % (time.time() - time_start)
@@ -0,0 +1,179 @@
+## sparse_cosine.py
+## TF-IDF cosine comparator for the Class and Coauthor set fields
+
+import math
+import numpy as np
+import scipy.sparse as sp
+
+"""
+dedupe.distance.cosine.CosineSimilarity compares two sets in Python for
+every pair it is given. SparseCosine computes the same kind of cosine,
+over sets weighted by inverse document frequency:
+
+  cos(a, b) = sum(idf(t) ** 2, t in a & b) / (|a| * |b|),
+  |a| = sqrt(sum(idf(t) ** 2, t in a)), idf(t) = log(N / df(t))
+
+Attached to a record_store.RecordStore field, it also holds the
+L2-normalised TF-IDF row vector of every distinct set of the field as one
+sparse matrix. load_block then computes all pairwise cosines of a block
+with one sparse matrix product, and calls for pairs of that block are
+answered from the result; other pairs fall back to the Python formula.
+patent_util.candidates_gen loads each block before dedupe scores it.
+
+Only the idf weights are pickled with the learned settings. After
+loading settings, attach_comparators reattaches the comparators to the
+data being deduped.
+"""
+
+class SparseCosine(object):
+    """
+    Cosine comparator over the TF-IDF weighted sets of field in a
+    RecordStore. Document frequencies are counted over the records of
+    data_d.
+    """
+
+    def __init__(self, data_d, field, min_block_size=10, max_cached_pairs=5000000):
+        self.field = field
+        self.min_block_size = min_block_size
+        self.max_cached_pairs = max_cached_pairs
+        token_sets = self.token_sets_of(data_d)
+        set_lengths = np.diff(token_sets.offsets)
+        set_counts = np.bincount(token_sets.codes, minlength=len(set_lengths))
+        doc_freq = np.bincount(token_sets.tokens,
+                               weights=np.repeat(set_counts, set_lengths),
+                               minlength=len(token_sets.vocab)
+                               )
+        n_docs = float(len(token_sets.codes))
+        self.idf = dict((t, math.log(n_docs / df))
+                        for t, df in zip(token_sets.vocab, doc_freq.tolist()) if df > 0
+                        )
+        # Tokens not seen in the corpus are weighted as if seen once
+        self.default_idf = math.log(max(n_docs, 1.0))
+        self.attach(data_d)
+
+    def token_sets_of(self, data_d):
+        return {'Class': data_d.classes, 'Coauthor': data_d.coauthors}[self.field]
+
+    def attach(self, data_d):
+        """
+        Builds the TF-IDF row vectors of the distinct sets of the field
+        in data_d, with the idf weights of this comparator
+        """
+        self.token_sets = self.token_sets_of(data_d)
+        self.data_d = data_d
+        idf = np.array([self.idf.get(t, self.default_idf) for t in self.token_sets.vocab])
+        weights = idf[self.token_sets.tokens]
+        n_sets = len(self.token_sets.offsets) - 1
+        set_rows = np.repeat(np.arange(n_sets), np.diff(self.token_sets.offsets))
+        norms = np.sqrt(np.bincount(set_rows, weights=weights ** 2, minlength=n_sets))
+        norms[norms == 0] = 1.0
+        self.vectors = sp.csr_matrix((weights / norms[set_rows],
+                                      self.token_sets.tokens,
+                                      self.token_sets.offsets
+                                      ),
+                                     shape=(n_sets, len(idf))
+                                     )
+        self.n_sets = n_sets
+        self.pair_cache = {}
+
+    def __getstate__(self):
+        return {'field': self.field,
+                'min_block_size': self.min_block_size,
+                'max_cached_pairs': self.max_cached_pairs,
+                'idf': self.idf,
+                'default_idf': self.default_idf
+                }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.token_sets = None
+        self.pair_cache = {}
+
+    def __call__(self, field_1, field_2):
+        try:
+            if field_1.owner is self.token_sets and field_2.owner is self.token_sets:
+                code_1 = field_1.code
+                code_2 = field_2.code
+                if code_1 == code_2:
+                    return 1.0
+                if code_1 > code_2:
+                    code_1, code_2 = code_2, code_1
+                return self.pair_cache[code_1 * self.n_sets + code_2]
+        except (AttributeError, KeyError):
+            pass
+        return self.cosine(field_1, field_2)
+
+    def cosine(self, field_1, field_2):
+        """
+        Cosine of two sets, computed in Python from the idf weights
+        """
+        if field_1 == field_2:
+            return 1.0
+        idf = self.idf
+        default = self.default_idf
+        dot = sum(idf.get(t, default) ** 2 for t in field_1 & field_2)
+        if dot == 0:
+            return 0.0
+        norm_1 = math.sqrt(sum(idf.get(t, default) ** 2 for t in field_1))
+        norm_2 = math.sqrt(sum(idf.get(t, default) ** 2 for t in field_2))
+        return dot / (norm_1 * norm_2)
+
+    def block_cosines(self, positions):
+        """
+        Cosines between all records at positions of the attached store,
+        as a dense square array, from one sparse matrix product
+        """
+        block_vectors = self.vectors[self.token_sets.codes[positions]]
+        cosines = (block_vectors * block_vectors.T).toarray()
+        np.fill_diagonal(cosines, 1.0)
+        return cosines
+
+    def pair_cosines(self, positions_1, positions_2):
+        """
+        Cosines of the record pairs (positions_1[k], positions_2[k])
+        """
+        codes_1 = self.token_sets.codes[positions_1]
+        codes_2 = self.token_sets.codes[positions_2]
+        cosines = np.asarray(self.vectors[codes_1].multiply(self.vectors[codes_2]).sum(axis=1)).ravel()
+        cosines[codes_1 == codes_2] = 1.0
+        return cosines
+
+    def load_block(self, record_ids):
+        """
+        Computes the cosines between the distinct sets of a block of
+        records and keeps them for the calls that follow. Blocks under
+        min_block_size records are left to the Python formula.
+        """
+        if self.token_sets is None or len(record_ids) < self.min_block_size:
+            return
+        codes = np.unique(self.token_sets.codes[self.data_d.positions(record_ids)])
+        n_pairs = len(codes) * (len(codes) - 1) / 2
+        if n_pairs == 0 or n_pairs > self.max_cached_pairs:
+            return
+        if len(self.pair_cache) + n_pairs > self.max_cached_pairs:
+            self.pair_cache.clear()
+        block_vectors = self.vectors[codes]
+        cosines = (block_vectors * block_vectors.T).toarray()
+        i, j = np.triu_indices(len(codes), 1)
+        keys = codes[i].astype(np.int64) * self.n_sets + codes[j]
+        self.pair_cache.update(zip(keys.tolist(), cosines[i, j].tolist()))
+
+def block_comparators(deduper):
+    """
+    The attached SparseCosine comparators of a deduper's data model
+    """
+    return [definition['comparator']
+            for definition in deduper.data_model['fields'].values()
+            if isinstance(definition.get('comparator'), SparseCosine) and
+            definition['comparator'].token_sets is not None
+            ]
+
+def attach_comparators(deduper, data_d):
+    """
+    Attaches the SparseCosine comparators of a deduper's data model,
+    e.g. one read from a settings file, to the records in data_d
+    """
+    for definition in deduper.data_model['fields'].values():
+        comparator = definition.get('comparator')
+        if isinstance(comparator, SparseCosine):
+            comparator.attach(data_d)
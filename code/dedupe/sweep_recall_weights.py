@@ -0,0 +1,85 @@
+#!/usr/bin/python
+"""
+Produces clusterings for a list of recall weights (or thresholds) from
+the pair scores stored by a dedupe_engine run with score_cache set,
+without blocking or scoring again.
+
+The script is invoked from the command line as:
+
+python sweep_recall_weights.py [options] <scores_file> <input_file> <output_dir> <value> [<value> ...]
+
+Options:
+-t, --thresholds    treat the values as score thresholds rather than recall weights
+-i, --index-column  column of input_file holding the record ids that were
+                    deduped (for rounds after the first, the previous
+                    round's cluster id column of its output file)
+-m, --method        clustering method, hierarchical (default) or components
+-s, --max-cluster-size  with components, split components over this size
+
+For round 1, input_file is the dedupe_input_<cc>.csv file. One output
+file is written per value, to
+<output_dir>/<scores_file name>_w<value>.csv (or _t<value> for
+thresholds), with the cluster ids in a cluster_id column. Rounds run in
+twostage mode are not supported, since their record ids are not kept.
+"""
+
+import optparse
+import os
+import pandas as pd
+import time
+
+import pair_scores
+import patent_util
+
+if __name__ == '__main__':
+    optp = optparse.OptionParser()
+    optp.add_option('-t', '--thresholds', dest='thresholds',
+                    action='store_true', default=False
+                    )
+    optp.add_option('-i', '--index-column', dest='index_column', default=None)
+    optp.add_option('-m', '--method', dest='method', default='hierarchical',
+                    choices=['hierarchical', 'components']
+                    )
+    optp.add_option('-s', '--max-cluster-size', dest='max_cluster_size',
+                    type='int', default=None
+                    )
+    (opts, args) = optp.parse_args()
+
+    scores_file = args[0]
+    input_file = args[1]
+    output_dir = args[2]
+    values = [float(v) for v in args[3:]]
+
+    time_start = time.time()
+    id1, id2, scores = pair_scores.load_pair_scores(scores_file)
+    print 'Loaded %s scored pairs' % len(scores)
+
+    input_df = pd.read_csv(input_file)
+    if opts.index_column:
+        df_index = input_df[opts.index_column].values
+    else:
+        df_index = input_df.index
+
+    output_root = os.path.join(output_dir,
+                               os.path.splitext(os.path.basename(scores_file))[0]
+                               )
+    for v in values:
+        if opts.thresholds:
+            threshold = v
+            output_file = output_root + '_t' + str(v) + '.csv'
+        else:
+            threshold = pair_scores.threshold_for_recall_weight(scores, v)
+            output_file = output_root + '_w' + str(v) + '.csv'
+        clustered_dupes = pair_scores.cluster_pair_scores(id1, id2, scores, threshold,
+                                                          opts.method,
+                                                          opts.max_cluster_size
+                                                          )
+        input_df['cluster_id'] = patent_util.cluster_index(df_index, clustered_dupes)
+        input_df.to_csv(output_file)
+        print 'Value %s: threshold %0.4f, %s duplicate sets, %s clusters' % (v,
+                                                                             threshold,
+                                                                             len(clustered_dupes),
+                                                                             input_df['cluster_id'].max() + 1
+                                                                             )
+
+    print 'Sweep complete, ran in %s seconds' % (time.time() - time_start)
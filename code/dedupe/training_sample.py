@@ -0,0 +1,216 @@
+## training_sample.py
+## Bounded, stratified pair sample for training dedupe
+
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+import Levenshtein
+
+from block_index import BlockIndex
+
+"""
+dedupe.dataSample draws sample_size random record pairs. Almost all of
+them are obvious non-matches, so a useful sample has to be many times
+larger than the data, and it is held in memory and scored during active
+learning. This module draws a sample of fixed size with many more
+candidate matches in it:
+
+- within-block pairs (most of the sample): pairs of records that share
+  a key under one of the cheap blocking keys in
+  patent_util.sub_block_predicates (name initials, lat / lng grid, name
+  3-grams). Each key gets an equal share of max_candidates; its blocks
+  are visited in random order and each contributes at most
+  max_block_pairs random pairs, until the key's share of pairs has been
+  seen. Every pair is put into a name-similarity stratum by the
+  Levenshtein ratio of the names (strata split at name_strata). Each
+  stratum keeps a bottom-k reservoir: every pair gets a uniform random
+  priority, and the k pairs with the smallest priorities are kept, a
+  uniform sample of the stratum's pairs in bounded memory. The strata get
+  equal shares of the within-block sample; shares a stratum cannot fill go
+  to the others.
+- random pairs (random_fraction of the sample), as in dedupe.dataSample
+
+The pair ids are cached in an .npz file, stamped with a fingerprint of the
+records and the sampling parameters, so a later labelling session on the
+same data is shown the same sample.
+"""
+
+def reservoir_push(reservoir, items, priorities, k):
+    """
+    Adds items (a tuple of aligned arrays) with the given priorities to
+    the bottom-k reservoir (items, priorities) and returns the reservoir
+    """
+    if reservoir is not None:
+        items = tuple(np.concatenate([r, i]) for r, i in zip(reservoir[0], items))
+        priorities = np.concatenate([reservoir[1], priorities])
+    if len(priorities) > k:
+        keep = np.argpartition(priorities, k - 1)[:k]
+        items = tuple(i[keep] for i in items)
+        priorities = priorities[keep]
+    return items, priorities
+
+def block_pairs(block_ids, max_block_pairs, rng):
+    """
+    All pairs of a block, or max_block_pairs random distinct pairs of it
+    if it has more
+    """
+    n = len(block_ids)
+    if n * (n - 1) / 2 <= max_block_pairs:
+        i, j = np.triu_indices(n, 1)
+    else:
+        i = rng.randint(0, n, 2 * max_block_pairs)
+        j = rng.randint(0, n, 2 * max_block_pairs)
+        keep = i != j
+        i = i[keep][:max_block_pairs]
+        j = j[keep][:max_block_pairs]
+    return block_ids[i], block_ids[j]
+
+def name_ratios(data_d, id1, id2):
+    names_1 = data_d.names[data_d.positions(id1)]
+    names_2 = data_d.names[data_d.positions(id2)]
+    return np.array([Levenshtein.ratio(a, b) for a, b in zip(names_1, names_2)])
+
+def sample_pairs(data_d, sample_size, predicates, random_fraction=0.1,
+                 name_strata=(0.5, 0.75, 0.9), max_block_pairs=1000,
+                 max_candidates=None, seed=0):
+    """
+    Draws the sample described in the module docstring from the records
+    of the RecordStore data_d. Returns (id1, id2, stratum) arrays, where
+    stratum is the name-similarity stratum of a within-block pair (0 is
+    the least similar) and -1 for a random pair.
+    """
+    rng = np.random.RandomState(seed)
+    n_random = int(round(sample_size * random_fraction))
+    n_within = sample_size - n_random
+    n_strata = len(name_strata) + 1
+    if max_candidates is None:
+        max_candidates = 20 * sample_size
+
+    ids = np.asarray(data_d.keys(), dtype=np.int64)
+    reservoirs = [None] * n_strata
+
+    def push(chunk):
+        id1 = np.concatenate([c[0] for c in chunk])
+        id2 = np.concatenate([c[1] for c in chunk])
+        strata = np.searchsorted(name_strata, name_ratios(data_d, id1, id2), side='right')
+        priorities = rng.uniform(size=len(id1))
+        for s in np.unique(strata):
+            in_stratum = strata == s
+            reservoirs[s] = reservoir_push(reservoirs[s],
+                                           (id1[in_stratum], id2[in_stratum]),
+                                           priorities[in_stratum],
+                                           n_within
+                                           )
+
+    seen = 0
+    chunk = []
+    chunk_pairs = 0
+    predicate_candidates = max_candidates // max(len(predicates), 1)
+    for predicate in predicates:
+        keys = [predicate(record) for record in data_d.values()]
+        codes, uniques = pd.factorize(keys)
+        blocks = BlockIndex.from_codes(list(uniques), codes, ids)
+        predicate_seen = 0
+        for b in rng.permutation(blocks.positions(min_size=2)):
+            if predicate_seen >= predicate_candidates:
+                break
+            id1, id2 = block_pairs(blocks.block(b).astype(np.int64), max_block_pairs, rng)
+            chunk.append((np.minimum(id1, id2), np.maximum(id1, id2)))
+            chunk_pairs += len(id1)
+            predicate_seen += len(id1)
+            if chunk_pairs >= 100000:
+                push(chunk)
+                chunk = []
+                chunk_pairs = 0
+        seen += predicate_seen
+    if chunk_pairs > 0:
+        push(chunk)
+    print 'Training sample: %s within-block pairs seen' % seen
+
+    # Reservoir pairs in priority order, so that any prefix is a uniform
+    # sample. A pair can be drawn from several blocks; keep one copy.
+    strata_pairs = []
+    for r in reservoirs:
+        if r is None:
+            strata_pairs.append((np.zeros(0, dtype=np.int64),) * 2)
+            continue
+        (id1, id2), priorities = r
+        order = np.argsort(priorities)
+        id1 = id1[order]
+        id2 = id2[order]
+        unique_keys, first = np.unique(id1 * (ids.max() + 1) + id2, return_index=True)
+        first.sort()
+        strata_pairs.append((id1[first], id2[first]))
+
+    # Equal shares per stratum, with the shares of short strata passed on
+    available = np.array([len(p[0]) for p in strata_pairs])
+    quota = np.zeros(n_strata, dtype=np.int64)
+    remaining = n_within
+    while remaining > 0 and (available > quota).any():
+        open_strata = np.flatnonzero(available > quota)
+        share = max(remaining // len(open_strata), 1)
+        for s in open_strata:
+            take = min(share, available[s] - quota[s], remaining)
+            quota[s] += take
+            remaining -= take
+    n_random += remaining
+
+    id1 = [p[0][:q] for p, q in zip(strata_pairs, quota)]
+    id2 = [p[1][:q] for p, q in zip(strata_pairs, quota)]
+    strata = [np.repeat(s, q) for s, q in enumerate(quota)]
+
+    random_1 = ids[rng.randint(0, len(ids), n_random)]
+    random_2 = ids[rng.randint(0, len(ids), n_random)]
+    keep = random_1 != random_2
+    id1.append(random_1[keep])
+    id2.append(random_2[keep])
+    strata.append(np.repeat(-1, keep.sum()))
+    for s in range(n_strata):
+        print 'Stratum %s: %s pairs' % (s, quota[s])
+    print 'Random: %s pairs' % keep.sum()
+    return np.concatenate(id1), np.concatenate(id2), np.concatenate(strata)
+
+def fingerprint(data_d, params):
+    """
+    Hex digest of the records' ids, names and locations and of the
+    sampling parameters
+    """
+    h = hashlib.md5()
+    h.update(repr(sorted(params.items())))
+    h.update(data_d.ids.tobytes())
+    h.update(pd.util.hash_array(data_d.names).tobytes())
+    h.update(data_d.lats.tobytes())
+    h.update(data_d.lngs.tobytes())
+    return h.hexdigest()
+
+def training_sample(data_d, sample_size, predicates, cache_file=None, **params):
+    """
+    The sample of sample_pairs as a tuple of record pairs, in the form
+    dedupe.dataSample returns. If cache_file holds a sample drawn from the
+    same records with the same parameters, its pairs are reused;
+    otherwise the new sample is written to cache_file.
+    """
+    params['sample_size'] = sample_size
+    params['predicates'] = [p.__name__ for p in predicates]
+    key = fingerprint(data_d, params)
+    del params['sample_size'], params['predicates']
+
+    if cache_file and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        if str(cached['key']) == key:
+            print 'Reading training sample from %s' % cache_file
+            id1, id2 = cached['id1'], cached['id2']
+        else:
+            print 'Training sample in %s is out of date' % cache_file
+            cached = None
+    else:
+        cached = None
+    if cached is None:
+        id1, id2, strata = sample_pairs(data_d, sample_size, predicates, **params)
+        if cache_file:
+            np.savez(cache_file, id1=id1, id2=id2, stratum=strata, key=key)
+
+    return tuple((data_d[i].frozen(), data_d[j].frozen())
+                 for i, j in zip(id1.tolist(), id2.tolist())
+                 )
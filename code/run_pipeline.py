@@ -0,0 +1,434 @@
+#!/usr/bin/python
+"""
+Runs the psClean workflow as a dependency graph of stages. Each country
+gets its own chain:
+
+extract -> prepare_dedupe_input -> patstat_dedupe -> map_dedupe_han_leuven
+        -> compute_precision_recall
+
+extract and compute_precision_recall cover all countries at once, so they
+are shared by every chain; the three middle stages run once per country.
+Countries are independent of each other and run in parallel, within a
+budget of cores and memory.
+
+A stage is skipped if it ran successfully before with the same script,
+the same local modules and config files, the same parameters and the
+same input file contents (md5), and its outputs still exist. State is kept in <root>/data/pipeline/pipeline_state.json;
+every run writes a JSON report and one log file per stage to the same
+directory.
+
+The script is invoked from the command line as:
+
+python run_pipeline.py [options] <path_to_root_psClean_directory> <country> [<country> ...]
+
+Options:
+-c, --cores    number of stages to run at once (default 1)
+-m, --memory   memory budget in MB (default 8000)
+-w, --weights  JSON file of country: precision_recall_weight (default 1.5)
+--tsv-dir      directory of cleaned_output_<CC>.tsv files
+               (default <root>/data/cleaned_output/)
+--prepare-memory  memory budget in MB for each prepare_dedupe_input run
+               (default 2000); it reads its input in chunks to stay within it
+--extract      also run extract_patstat_data.py. Off by default, since
+               extract appends to the tsv files rather than replacing them.
+
+It assumes the directory layout used by generate_bash_dedupe.py:
+- Dedupe inputs are in psClean/data/dedupe_input
+- Dedupe output goes to psClean/data/dedupe_script_output, as
+  patstat_output_<cc>.csv (patstat_dedupe.py -o) rather than the dated
+  file of a manual run, so each stage has one exact output path
+- HAN / Leuven maps go to psClean/data/dedupe_han_leuven
+"""
+
+import glob
+import hashlib
+import json
+import optparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Memory estimate per stage, as a multiple of the stage's input size in
+# bytes, and the lower bound in MB
+stage_memory = {'extract': (0, 4000),
+                'patstat_dedupe': (25, 1000),
+                'map_dedupe_han_leuven': (3, 250),
+                'compute_precision_recall': (2, 250)
+                }
+
+
+class Stage(object):
+    """
+    One node of the pipeline graph. inputs and outputs are file paths;
+    an output may also be a glob pattern (only extract's is, since it
+    writes one file per country), which exists if anything matches.
+    args may refer to resolved inputs as {input_name}. depends lists the
+    other files the stage's output depends on (local modules, config and
+    training files); they are hashed into the stage key but, unlike
+    inputs, may be missing. The script's local imports are added to
+    depends (see local_imports).
+    """
+    def __init__(self, name, country, script, args, cwd,
+                 inputs=None, outputs=None, deps=None, interpreter='python',
+                 memory=None, depends=None):
+        self.name = name
+        self.country = country
+        self.script = script
+        self.args = args
+        self.cwd = cwd
+        self.inputs = inputs or {}
+        self.outputs = outputs or []
+        self.deps = deps or []
+        self.interpreter = interpreter
+        self.memory = memory
+        self.depends = local_imports(script) + (depends or [])
+        if country:
+            self.id = name + ':' + country
+        else:
+            self.id = name
+
+
+def resolve_path(path):
+    if os.path.exists(path):
+        return path
+    return None
+
+
+import_re = re.compile(r'^\s*(?:from\s+(\w+)\s+import|import\s+([\w \t,]+))', re.M)
+
+def local_imports(script):
+    """
+    The modules in the script's directory that it imports, directly or
+    through other local modules, as a sorted list of paths
+    """
+    script_dir = os.path.dirname(script)
+    found = set()
+    to_scan = [script]
+    while to_scan:
+        with open(to_scan.pop(), 'rt') as f:
+            source = f.read()
+        for from_name, import_names in import_re.findall(source):
+            names = [from_name] if from_name else import_names.split(',')
+            for name in names:
+                name = name.split()[0] if name.strip() else ''
+                path = os.path.join(script_dir, name + '.py')
+                if name and path not in found and os.path.exists(path):
+                    found.add(path)
+                    to_scan.append(path)
+    return sorted(found)
+
+
+def file_md5(path, hash_cache, blocksize=2 ** 20):
+    """
+    Returns the md5 of a file's contents. Hashes are cached on
+    (size, mtime) so that large unchanged files are read only once.
+    """
+    stat = os.stat(path)
+    cached = hash_cache.get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return cached[2]
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            md5.update(block)
+    digest = md5.hexdigest()
+    hash_cache[path] = [stat.st_size, stat.st_mtime, digest]
+    return digest
+
+
+def stage_key(stage, resolved, hash_cache):
+    """
+    Content hash of everything that determines a stage's output: the
+    script, its local modules and config files, its argument template
+    and the contents of its inputs
+    """
+    key_parts = [stage.id,
+                 file_md5(stage.script, hash_cache),
+                 stage.args
+                 ]
+    for path in stage.depends:
+        if os.path.exists(path):
+            key_parts.append([path, file_md5(path, hash_cache)])
+        else:
+            key_parts.append([path, None])
+    for input_name in sorted(resolved):
+        key_parts.append([input_name, file_md5(resolved[input_name], hash_cache)])
+    return hashlib.md5(json.dumps(key_parts)).hexdigest()
+
+
+def memory_estimate(stage, resolved):
+    if stage.memory:
+        return stage.memory
+    factor, floor = stage_memory[stage.name]
+    input_mb = sum(os.path.getsize(p) for p in resolved.values()) / 2.0 ** 20
+    return max(floor, factor * input_mb)
+
+
+def outputs_exist(stage):
+    return all(glob.glob(o) for o in stage.outputs)
+
+
+def remove_outputs(stage):
+    """
+    Removes the stage's outputs that are exact paths before it runs, so
+    that a file left by an earlier run is not taken for this run's output
+    """
+    for o in stage.outputs:
+        if not glob.has_magic(o) and os.path.exists(o):
+            os.remove(o)
+
+
+def build_stages(root_dir, countries, weights, tsv_dir, run_extract, cores,
+                 prepare_memory):
+    data_dir = root_dir + '/data/'
+    dedupe_input_dir = data_dir + 'dedupe_input/'
+    dedupe_output_dir = data_dir + 'dedupe_script_output/'
+    map_dir = data_dir + 'dedupe_han_leuven/'
+
+    stages = []
+    extract_deps = []
+    if run_extract:
+        stages.append(Stage('extract', None,
+                            code_dir + '/extract/extract_patstat_data.py',
+                            [tsv_dir, str(cores)],
+                            code_dir + '/extract',
+                            outputs=[tsv_dir + 'cleaned_output_*.tsv'],
+                            interpreter='ipython'
+                            )
+                      )
+        extract_deps = ['extract']
+
+    map_ids = []
+    map_outputs = {}
+    for c in countries:
+        tsv_file = tsv_dir + 'cleaned_output_' + c.upper() + '.tsv'
+        records_file = dedupe_input_dir + 'person_records/dedupe_input_' + c + '.csv'
+        patent_file = dedupe_input_dir + 'person_patent/' + c + '_person_patent_map.csv'
+        dedupe_output = dedupe_output_dir + 'patstat_output_' + c + '.csv'
+        leuven_map = map_dir + c + '_dedupe_leuven_map.csv'
+        han_map = map_dir + c + '_dedupe_han_map.csv'
+
+        prepare = Stage('prepare_dedupe_input', c,
+                        code_dir + '/clean/prepare_dedupe_input.py',
+                        ['-m', str(prepare_memory), tsv_dir, dedupe_input_dir, c],
+                        code_dir + '/clean',
+                        inputs={'tsv': tsv_file,
+                                'latlong': code_dir + '/clean/latlong_dict.csv'
+                                },
+                        outputs=[records_file, patent_file],
+                        deps=extract_deps,
+                        memory=prepare_memory
+                        )
+        dedupe = Stage('patstat_dedupe', c,
+                       code_dir + '/dedupe/patstat_dedupe.py',
+                       ['-o', dedupe_output,
+                        c, dedupe_input_dir + 'person_records', dedupe_output_dir,
+                        str(weights.get(c, 1.5))
+                        ],
+                       code_dir + '/dedupe',
+                       inputs={'records': records_file},
+                       outputs=[dedupe_output],
+                       deps=[prepare.id],
+                       depends=[code_dir + '/dedupe/patstat_training_' + c + '.json']
+                       )
+        postprocess = Stage('map_dedupe_han_leuven', c,
+                            code_dir + '/postprocess/map_dedupe_han_leuven.py',
+                            ['{dedupe_output}', c, map_dir],
+                            code_dir + '/postprocess',
+                            inputs={'dedupe_output': dedupe_output},
+                            outputs=[leuven_map, han_map],
+                            deps=[dedupe.id]
+                            )
+        stages.extend([prepare, dedupe, postprocess])
+        map_ids.append(postprocess.id)
+        map_outputs[c + '_leuven'] = leuven_map
+        map_outputs[c + '_han'] = han_map
+        map_outputs[c + '_person_patent'] = patent_file
+
+    stages.append(Stage('compute_precision_recall', None,
+                        code_dir + '/analyze/compute_precision_recall.py',
+                        [map_dir, dedupe_input_dir + 'person_patent/'],
+                        code_dir + '/analyze',
+                        inputs=map_outputs,
+                        outputs=[code_dir + '/analyze/patstat_country_precision_recall.csv'],
+                        deps=map_ids
+                        )
+                  )
+    return stages
+
+
+def run_stages(stages, state, cores, memory_mb, log_dir, state_file, poll=5):
+    """
+    Runs the stages in dependency order, launching any stage whose
+    dependencies are done as long as fewer than cores stages are running
+    and its memory estimate fits in what is left of memory_mb. A stage
+    that needs more than the whole budget runs only when nothing else is
+    running. Returns a list of per-stage report dicts.
+    """
+    pending = list(stages)
+    running = {}
+    status = {}
+    report = {}
+    used_memory = 0.0
+
+    while pending or running:
+        # Collect finished stages
+        for sid in running.keys():
+            stage, proc, log_f, start, mem, key = running[sid]
+            rc = proc.poll()
+            if rc is None:
+                continue
+            log_f.close()
+            del running[sid]
+            used_memory -= mem
+            runtime = time.time() - start
+            if rc == 0 and outputs_exist(stage):
+                status[sid] = 'done'
+                state['stages'][sid] = key
+                save_state(state, state_file)
+            else:
+                status[sid] = 'failed'
+            report[sid].update({'status': status[sid],
+                                'returncode': rc,
+                                'runtime': round(runtime, 1)
+                                }
+                               )
+            print '%s %s in %0.1f seconds' % (sid, status[sid], runtime)
+
+        # Launch whatever is ready and fits in the budget
+        for stage in list(pending):
+            dep_status = [status.get(d) for d in stage.deps]
+            if any(s in ('failed', 'blocked') for s in dep_status):
+                pending.remove(stage)
+                status[stage.id] = 'blocked'
+                report[stage.id] = {'stage': stage.name, 'country': stage.country,
+                                    'status': 'blocked'
+                                    }
+                continue
+            if not all(s in ('done', 'skipped') for s in dep_status):
+                continue
+
+            resolved = dict((k, resolve_path(v)) for k, v in stage.inputs.items())
+            missing = [v for k, v in stage.inputs.items() if resolved[k] is None]
+            if missing:
+                pending.remove(stage)
+                status[stage.id] = 'failed'
+                report[stage.id] = {'stage': stage.name, 'country': stage.country,
+                                    'status': 'failed', 'missing_inputs': missing
+                                    }
+                print '%s failed, missing inputs %s' % (stage.id, missing)
+                continue
+
+            key = stage_key(stage, resolved, state['hashes'])
+            if state['stages'].get(stage.id) == key and outputs_exist(stage):
+                pending.remove(stage)
+                status[stage.id] = 'skipped'
+                report[stage.id] = {'stage': stage.name, 'country': stage.country,
+                                    'status': 'skipped', 'key': key
+                                    }
+                print '%s up to date, skipping' % stage.id
+                continue
+
+            mem = memory_estimate(stage, resolved)
+            if len(running) >= cores:
+                break
+            if running and used_memory + mem > memory_mb:
+                continue
+
+            args = [a.format(**resolved) for a in stage.args]
+            log_file = log_dir + stage.id.replace(':', '_') + '.log'
+            log_f = open(log_file, 'w')
+            remove_outputs(stage)
+            proc = subprocess.Popen([stage.interpreter, stage.script] + args,
+                                    cwd=stage.cwd,
+                                    stdout=log_f,
+                                    stderr=subprocess.STDOUT
+                                    )
+            pending.remove(stage)
+            running[stage.id] = (stage, proc, log_f, time.time(), mem, key)
+            used_memory += mem
+            report[stage.id] = {'stage': stage.name, 'country': stage.country,
+                                'status': 'running', 'key': key, 'log': log_file,
+                                'memory_estimate_mb': round(mem, 0)
+                                }
+            print 'Started %s (est. %0.0f MB)' % (stage.id, mem)
+
+        if running:
+            time.sleep(poll)
+
+    return [report[s.id] for s in stages]
+
+
+def load_state(state_file):
+    if os.path.exists(state_file):
+        with open(state_file, 'rt') as f:
+            return json.load(f)
+    return {'stages': {}, 'hashes': {}}
+
+
+def save_state(state, state_file):
+    with open(state_file + '.tmp', 'wt') as f:
+        json.dump(state, f)
+    os.rename(state_file + '.tmp', state_file)
+
+
+if __name__ == '__main__':
+    optp = optparse.OptionParser()
+    optp.add_option('-c', '--cores', dest='cores', type='int', default=1)
+    optp.add_option('-m', '--memory', dest='memory', type='float', default=8000)
+    optp.add_option('-w', '--weights', dest='weights', default=None)
+    optp.add_option('--tsv-dir', dest='tsv_dir', default=None)
+    optp.add_option('--prepare-memory', dest='prepare_memory', type='float', default=2000)
+    optp.add_option('--extract', dest='extract', action='store_true', default=False)
+    (opts, args) = optp.parse_args()
+
+    root_dir = os.path.abspath(args[0])
+    countries = [c.lower() for c in args[1:]]
+    tsv_dir = opts.tsv_dir or root_dir + '/data/cleaned_output/'
+
+    weights = {}
+    if opts.weights:
+        with open(opts.weights, 'rt') as f:
+            weights = json.load(f)
+
+    pipeline_dir = root_dir + '/data/pipeline/'
+    for d in [pipeline_dir, root_dir + '/data/dedupe_script_output/',
+              root_dir + '/data/dedupe_han_leuven/']:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    state_file = pipeline_dir + 'pipeline_state.json'
+    this_run = time.strftime('%Y-%m-%d_%H%M%S')
+    log_dir = pipeline_dir + 'logs_' + this_run + '/'
+    os.makedirs(log_dir)
+
+    state = load_state(state_file)
+    stages = build_stages(root_dir, countries, weights, tsv_dir,
+                          opts.extract, opts.cores, opts.prepare_memory)
+
+    time_start = time.time()
+    stage_report = run_stages(stages, state, opts.cores, opts.memory,
+                              log_dir, state_file)
+    save_state(state, state_file)
+
+    report = {'started': this_run,
+              'runtime': round(time.time() - time_start, 1),
+              'cores': opts.cores,
+              'memory_mb': opts.memory,
+              'countries': countries,
+              'stages': stage_report
+              }
+    report_file = pipeline_dir + 'pipeline_report_' + this_run + '.json'
+    with open(report_file, 'wt') as f:
+        json.dump(report, f, indent=2)
+
+    status_counts = {}
+    for s in stage_report:
+        status_counts[s['status']] = status_counts.get(s['status'], 0) + 1
+    print 'Pipeline complete in %0.1f seconds: %s' % (report['runtime'], status_counts)
+    print 'Report written to ' + report_file
+    if status_counts.get('failed', 0) or status_counts.get('blocked', 0):
+        sys.exit(1)